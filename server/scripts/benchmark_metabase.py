@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+"""
+benchmark_metabase.py
+───────────────────────────────────────────────────────────────────────────────
+Benchmark de setup_metabase_dashboard.py y update_metabase_dashboard.py contra
+un servidor Metabase falso local, sin tocar la instancia de producción.
+
+El servidor falso corre en un proceso aparte (para que su memoria no se mezcle
+con la medición) e implementa los endpoints REST que usan los scripts:
+/api/session, /api/user/current, /api/database, /api/collection, /api/card,
+/api/dashboard, /api/dataset, sync_schema/rescan_values, etc. Permite simular:
+  - Latencia por request y latencia adicional por ejecución de card
+  - Respuestas 429 (rate limit) con Retry-After
+  - Respuestas 202 en la ejecución de cards (query que sigue en curso)
+
+Para cada tamaño de dashboard (por defecto 5, 50 y 500 cards) y escenario
+reporta tiempo total, requests recibidos por el servidor (por método, 429 y
+202) y pico de memoria del cliente (tracemalloc).
+
+Escenarios:
+  setup            setup_metabase_dashboard.main() sobre un Metabase vacío
+  setup-reconcile  setup_metabase_dashboard.main() --reconcile sin cambios
+  update           update_metabase_dashboard.refresh_dashboard_cards()
+  update-async     refresh_dashboard_cards_async() (requiere aiohttp)
+
+--codec ejecuta en cambio un micro-benchmark local de metabase_codec sobre un
+resultado de execute_card de 2.000 filas (o --codec-rows): tamaño en crudo,
+con gzip y con brotli, y tiempo de codificar/decodificar con json estándar
+y con orjson (si están instalados).
+
+Uso:
+  pip install requests
+  python benchmark_metabase.py
+  python benchmark_metabase.py --sizes 5,50 --scenarios update --concurrency 8
+  python benchmark_metabase.py --latency 20 --query-latency 200 --rate-429 0.05
+  python benchmark_metabase.py --json resultados.json
+  python benchmark_metabase.py --codec
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# El estado local de los scripts se aísla en un directorio temporal (debe
+# definirse antes de importar setup/update, que lo leen al importar)
+BENCH_DIR = tempfile.mkdtemp(prefix="metabase_bench_")
+os.environ["METABASE_STATE_FILE"] = os.path.join(BENCH_DIR, "state.json")
+
+DEFAULT_SIZES     = "5,50,500"
+DEFAULT_SCENARIOS = "setup,setup-reconcile,update,update-async"
+
+# Colores para la terminal (mismo estilo que setup_metabase_dashboard.py)
+GREEN  = "\033[92m"
+YELLOW = "\033[93m"
+BOLD   = "\033[1m"
+RESET  = "\033[0m"
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# SERVIDOR METABASE FALSO
+# ══════════════════════════════════════════════════════════════════════════════
+
+class FakeMetabase:
+    """Estado en memoria de una instancia Metabase mínima y sus contadores."""
+
+    DB_NAME = "ImagineCRM Producción"
+
+    def __init__(self, latency: float = 0.0, query_latency: float = 0.0,
+                 rate_429: float = 0.0, rate_202: float = 0.0,
+                 retry_after: int = 1, rows: int = 10, seed: int = 0):
+        self.latency       = latency
+        self.query_latency = query_latency
+        self.rate_429      = rate_429
+        self.rate_202      = rate_202
+        self.retry_after   = retry_after
+        self.rows          = rows
+        self.random        = random.Random(seed)
+        self.lock          = threading.Lock()
+        self.reset(0)
+
+    def reset(self, cards: int) -> None:
+        """Vacía la instancia; con cards > 0 crea la BD y un dashboard con esas cards."""
+        with self.lock:
+            self.next_id     = 1000
+            self.databases   = {}
+            self.collections = {}
+            self.cards       = {}
+            self.dashboards  = {}
+            self.stats       = {"total": 0, "by_method": {}, "status_429": 0, "status_202": 0}
+        if cards:
+            db = self.create("databases", {"name": self.DB_NAME, "engine": "mysql"})
+            col = self.create("collections", {"name": "ImagineCRM"})
+            dashcards = []
+            for i in range(cards):
+                card = self.create("cards", {
+                    "name": f"Card {i + 1}", "collection_id": col["id"],
+                    "database_id": db["id"], "display": "table",
+                    "visualization_settings": {},
+                    "dataset_query": {"type": "native", "database": db["id"],
+                                      "native": {"query": "SELECT 1 FROM critical_email_log"}}
+                })
+                dashcards.append({"id": self.new_id(), "card_id": card["id"], "card": card,
+                                  "row": (i // 3) * 6, "col": (i % 3) * 8,
+                                  "size_x": 8, "size_y": 6})
+            self.create("dashboards", {"name": "Emails Críticos — ImagineCRM",
+                                       "collection_id": col["id"], "parameters": [],
+                                       "dashcards": dashcards})
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def create(self, kind: str, body: Dict) -> Dict:
+        obj = dict(body or {})
+        obj["id"] = self.new_id()
+        obj.setdefault("updated_at", time.strftime("%Y-%m-%dT%H:%M:%S"))
+        if kind == "databases":
+            obj.setdefault("initial_sync_status", "complete")
+            obj["tables"] = [{"id": self.new_id(), "name": "critical_email_log",
+                              "initial_sync_status": "complete", "updated_at": obj["updated_at"]}]
+        if kind == "dashboards":
+            obj.setdefault("dashcards", [])
+        getattr(self, kind)[obj["id"]] = obj
+        return obj
+
+    def count(self, method: str, status: int) -> None:
+        with self.lock:
+            self.stats["total"] += 1
+            by_method = self.stats["by_method"]
+            by_method[method] = by_method.get(method, 0) + 1
+            if status in (429, 202):
+                self.stats[f"status_{status}"] += 1
+
+    def should_throttle(self, path: str) -> bool:
+        # La autenticación nunca se limita: sin ella el benchmark no arranca
+        if path in ("/api/session", "/api/user/current") or not self.rate_429:
+            return False
+        with self.lock:
+            return self.random.random() < self.rate_429
+
+    def query_result(self) -> Dict:
+        rows = [[i, f"tenant-{i}", "risk_alert", 1] for i in range(self.rows)]
+        return {"status": "completed", "row_count": len(rows), "running_time": 5,
+                "data": {"rows": rows, "cols": [{"name": c} for c in
+                                                ("id", "tenant", "emailType", "success")]}}
+
+    # ── Rutas ──────────────────────────────────────────────────────────────
+
+    def handle(self, method: str, path: str, body) -> tuple:
+        """Retorna (status, body) para un request ya contado y con la latencia aplicada."""
+        if method == "GET":
+            if path in ("/api/health", "/api/user/current"):
+                return 200, {"status": "ok", "email": "bench@imaginecrm.local"}
+            if path == "/api/database":
+                return 200, {"data": list(self.databases.values())}
+            if path == "/api/collection":
+                return 200, list(self.collections.values())
+            if path == "/api/card":
+                return 200, list(self.cards.values())
+            if path == "/api/dashboard":
+                return 200, [{k: v for k, v in d.items() if k != "dashcards"}
+                             for d in self.dashboards.values()]
+            m = re.match(r"^/api/(database|card|dashboard)/(\d+)$", path)
+            if m:
+                kind = {"database": "databases", "card": "cards", "dashboard": "dashboards"}[m[1]]
+                obj = getattr(self, kind).get(int(m[2]))
+                return (200, obj) if obj else (404, {"message": "Not found"})
+            return 404, {"message": "Not found"}
+
+        if method == "POST":
+            if path == "/api/session":
+                return 200, {"id": "bench-session"}
+            kind = {"/api/database": "databases", "/api/collection": "collections",
+                    "/api/card": "cards", "/api/dashboard": "dashboards"}.get(path)
+            if kind:
+                return 200, self.create(kind, body)
+            if re.match(r"^/api/card/\d+/query$", path):
+                if self.query_latency:
+                    time.sleep(self.query_latency)
+                with self.lock:
+                    status = 202 if self.random.random() < self.rate_202 else 200
+                return status, self.query_result()
+            if path == "/api/dataset":
+                return 202, {"status": "completed", "row_count": 0, "data": {"rows": [], "cols": []}}
+            if re.match(r"^/api/database/\d+/(sync_schema|rescan_values)$", path):
+                return 200, {"status": "ok"}
+            return 404, {"message": "Not found"}
+
+        if method == "PUT":
+            m = re.match(r"^/api/card/(\d+)$", path)
+            if m and int(m[1]) in self.cards:
+                self.cards[int(m[1])].update(body or {})
+                return 200, self.cards[int(m[1])]
+            m = re.match(r"^/api/dashboard/(\d+)(/cards)?$", path)
+            if m and int(m[1]) in self.dashboards:
+                dashboard = self.dashboards[int(m[1])]
+                body = dict(body or {})
+                dashcards = body.pop("cards" if m[2] else "dashcards", None)
+                if dashcards is not None:
+                    saved = []
+                    for dc in dashcards:
+                        dc = dict(dc)
+                        if not dc.get("id") or dc["id"] < 0:
+                            dc["id"] = self.new_id()
+                        dc["card"] = self.cards.get(dc.get("card_id"))
+                        saved.append(dc)
+                    dashboard["dashcards"] = saved
+                dashboard.update(body)
+                return 200, dashboard
+            return 404, {"message": "Not found"}
+
+        if method == "DELETE":
+            return 204, None
+        return 405, {"message": "Method not allowed"}
+
+
+def _make_handler(fake: FakeMetabase):
+    class FakeMetabaseHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, como Metabase detrás de un proxy
+
+        def log_message(self, *args):
+            pass
+
+        def _read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw) if raw else None
+            except ValueError:
+                return None  # Formularios (exportaciones): no se interpretan
+
+        def _send(self, status: int, body, headers: Optional[Dict] = None) -> None:
+            payload = json.dumps(body).encode("utf-8") if body is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _dispatch(self, method: str) -> None:
+            path = self.path.split("?")[0]
+            body = self._read_body()
+
+            # Endpoints de control del benchmark (no se cuentan)
+            if path == "/__bench/stats":
+                return self._send(200, fake.stats)
+            if path == "/__bench/reset":
+                fake.reset(int((body or {}).get("cards", 0)))
+                return self._send(200, {"status": "ok"})
+
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.should_throttle(path):
+                fake.count(method, 429)
+                return self._send(429, {"message": "Too many requests"},
+                                  {"Retry-After": str(fake.retry_after)})
+            status, response = fake.handle(method, path, body)
+            fake.count(method, status)
+            self._send(status, response)
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_PUT(self):
+            self._dispatch("PUT")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+    return FakeMetabaseHandler
+
+
+def serve_fake(port: int, options: Dict) -> None:
+    """Punto de entrada del proceso del servidor falso."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(FakeMetabase(**options)))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ESCENARIOS
+# ══════════════════════════════════════════════════════════════════════════════
+
+class Bench:
+    """Controla el servidor falso y mide cada escenario."""
+
+    def __init__(self, base_url: str):
+        import requests
+        self.base_url = base_url
+        self.control  = requests.Session()
+
+    def wait_ready(self, timeout: float = 10.0) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                self.control.get(f"{self.base_url}/__bench/stats", timeout=1)
+                return
+            except Exception:
+                time.sleep(0.1)
+        raise RuntimeError("El servidor Metabase falso no respondió")
+
+    def reset(self, cards: int) -> None:
+        self.control.post(f"{self.base_url}/__bench/reset", json={"cards": cards})
+
+    def stats(self) -> Dict:
+        return self.control.get(f"{self.base_url}/__bench/stats").json()
+
+    def measure(self, scenario: str, size: int, func) -> Dict:
+        before = self.stats()
+        tracemalloc.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            detail = func()
+        except Exception as e:  # El benchmark sigue con los demás escenarios
+            detail, error = {}, f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        after = self.stats()
+        by_method = {m: n - before["by_method"].get(m, 0)
+                     for m, n in after["by_method"].items()
+                     if n - before["by_method"].get(m, 0)}
+        return {
+            "scenario":   scenario,
+            "cards":      size,
+            "wall_s":     round(wall, 3),
+            "requests":   after["total"] - before["total"],
+            "by_method":  by_method,
+            "status_429": after["status_429"] - before["status_429"],
+            "status_202": after["status_202"] - before["status_202"],
+            "peak_mem_kb": round(peak / 1024, 1),
+            "detail":     detail,
+            "error":      error,
+        }
+
+
+def synthetic_cards_definition(setup, size: int) -> List[Dict]:
+    """Repite las 5 cards reales hasta completar `size`, con nombres y layout únicos."""
+    base  = setup.get_cards_definition()
+    cards = []
+    for i in range(size):
+        card = dict(base[i % len(base)])
+        if i >= len(base):
+            card["name"] = f"{card['name']} #{i + 1}"
+        card["layout"] = {"row": (i // 3) * 6, "col": (i % 3) * 8, "size_x": 8, "size_y": 6}
+        cards.append(card)
+    return cards
+
+
+def run_setup(setup, base_url: str, size: int, reconcile: bool) -> Dict:
+    """Ejecuta setup_metabase_dashboard.main() con `size` cards y la salida silenciada."""
+    setup.METABASE_URL     = base_url
+    setup.METABASE_API_KEY = "bench"
+    setup.DB_PASSWORD      = "bench"
+    cards_def = synthetic_cards_definition(setup, size)
+    original  = setup.get_cards_definition
+    setup.get_cards_definition = lambda *args, **kwargs: cards_def
+    argv, sys.argv = sys.argv, ["setup_metabase_dashboard.py"] + (["--reconcile"] if reconcile else [])
+    exit_code = 0
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            setup.main()
+    except SystemExit as e:
+        exit_code = e.code or 0
+    finally:
+        sys.argv = argv
+        setup.get_cards_definition = original
+    return {"exit_code": exit_code}
+
+
+def run_update(update, base_url: str, concurrency: int, use_async: bool) -> Dict:
+    """Refresca todas las cards del dashboard sembrado en el servidor falso."""
+    client = update.MetabaseClient(base_url, pool_size=concurrency)
+    update.METABASE_API_KEY = "bench"
+    if not update.authenticate(client):
+        raise RuntimeError("Autenticación rechazada por el servidor falso")
+    dashboard_id = client.find_dashboard_by_name(update.DASHBOARD_NAME)
+    if use_async:
+        results = update.run_async(
+            client, concurrency,
+            lambda ac: update.refresh_dashboard_cards_async(ac, dashboard_id, concurrency))
+    else:
+        results = update.refresh_dashboard_cards(client, dashboard_id, concurrency)
+    return {"success": results["success"], "errors": results["errors"],
+            "card_wall_s": results["wall_elapsed"]}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MICRO-BENCHMARK DEL CODEC
+# ══════════════════════════════════════════════════════════════════════════════
+
+def synthetic_query_result(rows: int) -> Dict:
+    """Resultado de /api/card/{id}/query con la forma de la card 5 (log detallado)."""
+    rnd = random.Random(0)
+    columns = ["fecha_envio", "tenant", "email_destinatario", "tipo_email", "estado", "error"]
+    types = ["Pago Fallido", "Trial Expirado", "Suscripción Expirada"]
+    data_rows = [[
+        f"2026-01-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00Z",
+        f"Tenant {rnd.randint(1, 500)}",
+        f"usuario{i}@cliente{rnd.randint(1, 500)}.com",
+        rnd.choice(types),
+        "Exitoso" if rnd.random() > 0.1 else "Fallido",
+        "—" if rnd.random() > 0.1 else "SMTP 451: temporary failure, try again later",
+    ] for i in range(rows)]
+    return {
+        "status": "completed", "row_count": rows, "running_time": 412,
+        "data": {
+            "rows": data_rows,
+            "cols": [{"name": c, "display_name": c, "base_type": "type/Text",
+                      "source": "native", "field_ref": ["field", c, {"base-type": "type/Text"}]}
+                     for c in columns],
+            "native_form": {"query": "SELECT ... FROM critical_email_log log ..."},
+            "results_timezone": "UTC",
+        },
+    }
+
+
+def _best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run_codec_benchmark(rows: int, repeat: int) -> List[Dict]:
+    """Mide tamaño transferido y tiempo de codificar/decodificar un resultado grande."""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import metabase_codec as codec
+
+    result = synthetic_query_result(rows)
+    raw = json.dumps(result, ensure_ascii=False).encode("utf-8")
+    gzipped = gzip.compress(raw, compresslevel=codec.GZIP_LEVEL)
+    report = [
+        {"item": "tamaño json", "value": len(raw) / 1024, "unit": "KB"},
+        {"item": "tamaño gzip", "value": len(gzipped) / 1024, "unit": "KB"},
+        {"item": "descomprimir gzip", "value": _best_of(lambda: gzip.decompress(gzipped), repeat),
+         "unit": "ms"},
+    ]
+    if codec.HAS_BROTLI:
+        try:
+            import brotli
+        except ImportError:
+            import brotlicffi as brotli
+        compressed = brotli.compress(raw)
+        report += [
+            {"item": "tamaño br", "value": len(compressed) / 1024, "unit": "KB"},
+            {"item": "descomprimir br",
+             "value": _best_of(lambda: brotli.decompress(compressed), repeat), "unit": "ms"},
+        ]
+    report += [
+        {"item": "decodificar json", "value": _best_of(lambda: json.loads(raw), repeat),
+         "unit": "ms"},
+        {"item": "codificar json",
+         "value": _best_of(lambda: json.dumps(result, ensure_ascii=False).encode("utf-8"), repeat),
+         "unit": "ms"},
+    ]
+    if codec.orjson is not None:
+        report += [
+            {"item": "decodificar orjson", "value": _best_of(lambda: codec.orjson.loads(raw), repeat),
+             "unit": "ms"},
+            {"item": "codificar orjson",
+             "value": _best_of(lambda: codec.orjson.dumps(result), repeat), "unit": "ms"},
+        ]
+    print(f"\n{BOLD}Resultado de execute_card con {rows:,} filas "
+          f"(codec activo: {codec.BACKEND}, Accept-Encoding: {codec.ACCEPT_ENCODING}){RESET}")
+    for entry in report:
+        print(f"  {entry['item']:<22} {entry['value']:>10.2f} {entry['unit']}")
+    print()
+    return report
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# REPORTE
+# ══════════════════════════════════════════════════════════════════════════════
+
+def print_report(rows: List[Dict]) -> None:
+    print(f"\n{BOLD}{'Escenario':<16} {'Cards':>6} {'Tiempo (s)':>11} {'Requests':>9} "
+          f"{'429':>5} {'202':>5} {'Mem. pico (KB)':>15}  Detalle{RESET}")
+    for row in rows:
+        methods = " ".join(f"{m}={n}" for m, n in sorted(row["by_method"].items()))
+        detail = row["error"] or " ".join(f"{k}={v}" for k, v in row["detail"].items())
+        color = YELLOW if row["error"] else GREEN
+        print(f"{row['scenario']:<16} {row['cards']:>6} {row['wall_s']:>11.3f} "
+              f"{row['requests']:>9} {row['status_429']:>5} {row['status_202']:>5} "
+              f"{row['peak_mem_kb']:>15.1f}  {color}{detail}{RESET}  [{methods}]")
+    print()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FUNCIÓN PRINCIPAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark de los scripts de Metabase contra un servidor falso local"
+    )
+    parser.add_argument("--sizes",         default=DEFAULT_SIZES,
+                        help=f"Cantidades de cards separadas por coma (default: {DEFAULT_SIZES})")
+    parser.add_argument("--scenarios",     default=DEFAULT_SCENARIOS,
+                        help=f"Escenarios a ejecutar (default: {DEFAULT_SCENARIOS})")
+    parser.add_argument("--concurrency",   type=int, default=4,
+                        help="Cards en paralelo para los escenarios de update (default: 4)")
+    parser.add_argument("--latency",       type=float, default=5.0,
+                        help="Latencia simulada por request, en ms (default: 5)")
+    parser.add_argument("--query-latency", type=float, default=50.0,
+                        help="Latencia adicional por ejecución de card, en ms (default: 50)")
+    parser.add_argument("--rate-429",      type=float, default=0.0,
+                        help="Fracción de requests respondidos con 429 (default: 0)")
+    parser.add_argument("--retry-after",   type=int, default=1,
+                        help="Valor de Retry-After en las respuestas 429, en segundos")
+    parser.add_argument("--rate-202",      type=float, default=0.0,
+                        help="Fracción de ejecuciones de card respondidas con 202 (default: 0)")
+    parser.add_argument("--rows",          type=int, default=10,
+                        help="Filas por resultado de card (default: 10)")
+    parser.add_argument("--seed",          type=int, default=0,
+                        help="Semilla para la inyección de 429/202")
+    parser.add_argument("--json",          metavar="ARCHIVO",
+                        help="Guardar los resultados en un archivo JSON")
+    parser.add_argument("--verbose",       action="store_true",
+                        help="Mostrar los logs de los scripts durante el benchmark")
+    parser.add_argument("--codec",         action="store_true",
+                        help="Solo el micro-benchmark de serialización y compresión")
+    parser.add_argument("--codec-rows",    type=int, default=2000,
+                        help="Filas del resultado del micro-benchmark del codec (default: 2000)")
+    args = parser.parse_args()
+
+    if args.codec:
+        report = run_codec_benchmark(args.codec_rows, repeat=20)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"options": vars(args), "codec": report}, f, indent=2)
+        return
+
+    sizes     = [int(s) for s in args.sizes.split(",") if s.strip()]
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import setup_metabase_dashboard as setup
+    import update_metabase_dashboard as update
+    if not args.verbose:
+        logging.getLogger("metabase_update").setLevel(logging.WARNING)
+
+    if "update-async" in scenarios:
+        from metabase_async_client import aiohttp
+        if aiohttp is None:
+            print(f"{YELLOW}aiohttp no está instalado: se omite el escenario update-async{RESET}")
+            scenarios.remove("update-async")
+
+    port = _free_port()
+    options = {"latency": args.latency / 1000, "query_latency": args.query_latency / 1000,
+               "rate_429": args.rate_429, "rate_202": args.rate_202,
+               "retry_after": args.retry_after, "rows": args.rows, "seed": args.seed}
+    server = multiprocessing.Process(target=serve_fake, args=(port, options), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port}"
+    bench = Bench(base_url)
+
+    rows = []
+    try:
+        bench.wait_ready()
+        for size in sizes:
+            for scenario in scenarios:
+                if scenario == "setup":
+                    bench.reset(0)
+                    func = lambda: run_setup(setup, base_url, size, reconcile=False)
+                elif scenario == "setup-reconcile":
+                    # Parte del estado que dejó un setup previo con el mismo tamaño
+                    bench.reset(0)
+                    run_setup(setup, base_url, size, reconcile=False)
+                    func = lambda: run_setup(setup, base_url, size, reconcile=True)
+                elif scenario in ("update", "update-async"):
+                    bench.reset(size)
+                    func = lambda: run_update(update, base_url, args.concurrency,
+                                              use_async=scenario == "update-async")
+                else:
+                    print(f"{YELLOW}Escenario desconocido: {scenario}{RESET}")
+                    continue
+                row = bench.measure(scenario, size, func)
+                rows.append(row)
+                print(f"  {scenario} ({size} cards): {row['wall_s']:.2f}s, "
+                      f"{row['requests']} requests")
+    finally:
+        server.terminate()
+        server.join()
+
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"options": vars(args), "results": rows}, f, indent=2)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -74,3 +74,27 @@ WHERE
     log.sentAt >= DATE_SUB(NOW(), INTERVAL 7 DAY)
 ORDER BY
     log.sentAt DESC;
+
+-- ====================================================================
+
+-- Consulta 1 (variante rollup): Resumen Ejecutivo desde critical_email_daily
+-- Mismo resultado que la Consulta 1, pero sumando la tabla agregada que
+-- mantiene rollup_critical_emails.py (una fila por día, tenant, tipo y
+-- éxito) en lugar de recorrer el log. Cuenta 7 días completos: el primer
+-- día de la ventana se incluye entero.
+
+SELECT
+    SUM(cantidad) AS total_emails_enviados,
+    SUM(CASE WHEN success = 1 THEN cantidad ELSE 0 END) AS emails_exitosos,
+    SUM(CASE WHEN success = 0 THEN cantidad ELSE 0 END) AS emails_fallidos,
+    CONCAT(ROUND(
+        (IFNULL(SUM(CASE WHEN success = 1 THEN cantidad ELSE 0 END), 0) / NULLIF(SUM(cantidad), 0)) * 100, 2
+    ),
+    '%') AS tasa_de_exito,
+    SUM(CASE WHEN emailType = 'PAYMENT_FAILED' THEN cantidad ELSE 0 END) AS total_pago_fallido,
+    SUM(CASE WHEN emailType = 'TRIAL_EXPIRED' THEN cantidad ELSE 0 END) AS total_trial_expirado,
+    SUM(CASE WHEN emailType = 'SUBSCRIPTION_EXP' THEN cantidad ELSE 0 END) AS total_suscripcion_expirada
+FROM
+    critical_email_daily
+WHERE
+    day >= DATE(DATE_SUB(NOW(), INTERVAL 7 DAY));
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+export_critical_emails.py
+───────────────────────────────────────────────────────────────────────────────
+Exporta el log detallado de emails críticos (las mismas columnas que la card
+"📋 Log Detallado de Envíos") para un período completo, sin el LIMIT 500 del
+dashboard, a CSV o JSON Lines comprimidos con gzip.
+
+Recorre critical_email_log directamente en MySQL con paginación por keyset
+sobre (sentAt, id) en orden descendente: cada página es una query corta que
+continúa donde terminó la anterior (WHERE sentAt < ? OR (sentAt = ? AND id < ?)),
+en lugar de un OFFSET que obliga a MySQL a recorrer y descartar todas las filas
+previas. La memoria queda acotada a una página y ninguna query es larga, así
+que un extracto de 90 días con millones de filas no sufre timeouts.
+
+Requiere un índice sobre sentAt, que ninguna migración crea: el operador debe
+crearlo antes de exportar períodos largos (sin él cada página recorre la tabla):
+
+  CREATE INDEX idx_critical_email_log_sentAt ON critical_email_log (sentAt);
+
+Ese índice alcanza: en InnoDB todo índice secundario incluye la PK (id), de
+modo que (sentAt, id) ya está ordenado en el índice.
+
+Uso:
+  pip install pymysql
+  python export_critical_emails.py --days 90
+  python export_critical_emails.py --since 2026-01-01 --until 2026-02-01 --format jsonl
+  python export_critical_emails.py --days 30 --tenant 42 --failed-only --output fallos.csv.gz
+
+Variables de entorno: ver metabase_mysql.py (DB_*).
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import csv
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Optional, List, Tuple
+
+# ── Carga de variables de entorno ──────────────────────────────────────────
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # python-dotenv opcional; se pueden pasar las vars directamente
+
+from metabase_mysql import connect
+
+# ── Configuración ──────────────────────────────────────────────────────────
+PAGE_SIZE   = 5000   # Filas por página (memoria acotada a una página)
+MAX_RETRIES = 3      # Reintentos por página ante errores de conexión
+LOG_EVERY   = 20     # Páginas entre cada línea de progreso
+
+COLUMNS = ["id", "fecha_envio", "tenant", "email_destinatario",
+           "tipo_email", "estado", "error"]
+
+# Mismo SELECT que la card 5, más log.id para la paginación por keyset
+EXPORT_SQL = """
+SELECT
+    log.id,
+    log.sentAt AS fecha_envio,
+    t.name AS tenant,
+    log.recipientEmail AS email_destinatario,
+    CASE log.emailType
+        WHEN 'PAYMENT_FAILED'   THEN 'Pago Fallido'
+        WHEN 'TRIAL_EXPIRED'    THEN 'Trial Expirado'
+        WHEN 'SUBSCRIPTION_EXP' THEN 'Suscripción Expirada'
+        ELSE log.emailType
+    END AS tipo_email,
+    CASE WHEN log.success = 1 THEN 'Exitoso' ELSE 'Fallido' END AS estado,
+    COALESCE(log.errorMessage, '—') AS error
+FROM critical_email_log log
+JOIN tenants t ON log.tenantId = t.id
+WHERE log.sentAt >= %s AND log.sentAt < %s
+{filters}
+ORDER BY log.sentAt DESC, log.id DESC
+LIMIT %s
+""".strip()
+
+KEYSET_FILTER = "AND (log.sentAt < %s OR (log.sentAt = %s AND log.id < %s))"
+
+# ── Logging ────────────────────────────────────────────────────────────────
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+log = logging.getLogger("metabase_export")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PAGINACIÓN POR KEYSET
+# ══════════════════════════════════════════════════════════════════════════════
+
+def build_page_query(after: Optional[Tuple], tenant_id: Optional[int],
+                     failed_only: bool) -> str:
+    filters = []
+    if tenant_id is not None:
+        filters.append("AND log.tenantId = %s")
+    if failed_only:
+        filters.append("AND log.success = 0")
+    if after is not None:
+        filters.append(KEYSET_FILTER)
+    return EXPORT_SQL.format(filters="\n".join(filters))
+
+
+def build_page_params(since: datetime, until: datetime, after: Optional[Tuple],
+                      tenant_id: Optional[int], page_size: int) -> list:
+    params = [since, until]
+    if tenant_id is not None:
+        params.append(tenant_id)
+    if after is not None:
+        sent_at, row_id = after
+        params += [sent_at, sent_at, row_id]
+    params.append(page_size)
+    return params
+
+
+class KeysetReader:
+    """Itera páginas de filas del período; se reconecta y repite la página ante errores."""
+
+    def __init__(self, since: datetime, until: datetime, tenant_id: Optional[int] = None,
+                 failed_only: bool = False, page_size: int = PAGE_SIZE):
+        self.since       = since
+        self.until       = until
+        self.tenant_id   = tenant_id
+        self.failed_only = failed_only
+        self.page_size   = page_size
+        self.conn        = None
+
+    def _fetch(self, after: Optional[Tuple]) -> List[tuple]:
+        sql = build_page_query(after, self.tenant_id, self.failed_only)
+        params = build_page_params(self.since, self.until, after, self.tenant_id,
+                                   self.page_size)
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                if self.conn is None:
+                    self.conn = connect()
+                with self.conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    return cur.fetchall()
+            except Exception as e:
+                log.warning(f"Error leyendo la página (intento {attempt}/{MAX_RETRIES}): {e}")
+                self.close()
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(attempt)
+        return []
+
+    def pages(self):
+        after = None
+        while True:
+            rows = self._fetch(after)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.page_size:
+                return
+            last = rows[-1]
+            after = (last[1], last[0])  # (sentAt, id) de la última fila
+
+    def close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ESCRITURA
+# ══════════════════════════════════════════════════════════════════════════════
+
+def _serialize(value):
+    return value.isoformat(sep=" ") if isinstance(value, datetime) else value
+
+
+class RowWriter:
+    """Escribe filas como CSV o JSON Lines, opcionalmente comprimidas con gzip."""
+
+    def __init__(self, path: str, export_format: str, compress: bool = True):
+        self.format = export_format
+        opener = gzip.open if compress else open
+        self.file = opener(path, "wt", encoding="utf-8", newline="")
+        if self.format == "csv":
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(COLUMNS)
+
+    def write(self, rows: List[tuple]) -> None:
+        if self.format == "csv":
+            self.csv.writerows([_serialize(v) for v in row] for row in rows)
+        else:
+            for row in rows:
+                record = dict(zip(COLUMNS, (_serialize(v) for v in row)))
+                self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def export(reader: KeysetReader, path: str, export_format: str) -> dict:
+    """
+    Vuelca todas las páginas al archivo (temporal + rename al terminar). Si la
+    exportación falla, borra el temporal y relanza el error.
+    """
+    tmp_path = f"{path}.partial"
+    results = {"rows": 0, "pages": 0}
+    start = time.time()
+    try:
+        writer = RowWriter(tmp_path, export_format, compress=path.endswith(".gz"))
+        try:
+            for rows in reader.pages():
+                writer.write(rows)
+                results["rows"] += len(rows)
+                results["pages"] += 1
+                if results["pages"] % LOG_EVERY == 0:
+                    rate = results["rows"] / max(time.time() - start, 0.001)
+                    log.info(f"  {results['rows']:,} filas exportadas (hasta {rows[-1][1]}, "
+                             f"{rate:,.0f} filas/s)")
+        finally:
+            writer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        reader.close()
+    results["elapsed"] = round(time.time() - start, 1)
+    return results
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FUNCIÓN PRINCIPAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exporta el log detallado de emails críticos de un período completo"
+    )
+    parser.add_argument("--days",        type=int, default=7,
+                        help="Últimos N días (default: 7; ignorado si se usa --since)")
+    parser.add_argument("--since",       type=parse_date, help="Desde (YYYY-MM-DD, inclusive)")
+    parser.add_argument("--until",       type=parse_date, help="Hasta (YYYY-MM-DD, exclusivo)")
+    parser.add_argument("--tenant",      type=int, help="Solo este tenantId")
+    parser.add_argument("--failed-only", action="store_true", help="Solo envíos fallidos")
+    parser.add_argument("--format",      choices=["csv", "jsonl"], default="csv",
+                        help="Formato de salida (default: csv)")
+    parser.add_argument("--output",      help="Archivo de salida (gzip si termina en .gz; "
+                                              "default: critical_emails_<fecha>.<formato>.gz)")
+    parser.add_argument("--page-size",   type=int, default=PAGE_SIZE,
+                        help=f"Filas por página (default: {PAGE_SIZE})")
+    args = parser.parse_args()
+
+    # La ventana se fija al inicio: las filas que lleguen durante la exportación no la alteran
+    until = args.until or datetime.now()
+    since = args.since or until - timedelta(days=args.days)
+    output = args.output or f"critical_emails_{until:%Y%m%d_%H%M}.{args.format}.gz"
+
+    log.info("=" * 60)
+    log.info("ImagineCRM — Exportación del log de emails críticos")
+    log.info(f"Período: {since} → {until}  |  Salida: {output}")
+    log.info("=" * 60)
+
+    reader = KeysetReader(since, until, args.tenant, args.failed_only, args.page_size)
+    try:
+        results = export(reader, output, args.format)
+    except Exception as e:
+        log.error(f"La exportación falló: {e}")
+        sys.exit(1)
+
+    log.info("=" * 60)
+    log.info(f"Filas exportadas: {results['rows']:,} en {results['pages']} páginas")
+    log.info(f"Tiempo total: {results['elapsed']}s")
+    log.info(f"Archivo: {output} ({os.path.getsize(output) / 1024:,.0f} KB)")
+    log.info("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -96,11 +96,24 @@ cat > "${CRON_FILE}" << EOF
 # Actualización completa cada hora (re-sync BD + re-ejecutar cards)
 0 * * * * root ${PYTHON_BIN} ${SCRIPT_PATH} >> ${LOG_FILE} 2>&1
 
-# Sincronización de esquema de BD una vez al día (a las 2:00 AM)
+# Sincronización de esquema de BD una vez al día (a las 2:00 AM; solo si cambió
+# la huella del esquema de las tablas del dashboard)
 0 2 * * * root ${PYTHON_BIN} ${SCRIPT_PATH} --sync-only >> ${LOG_FILE} 2>&1
 
+# Sincronización completa de la BD una vez por semana (domingo 3:00 AM)
+0 3 * * 0 root ${PYTHON_BIN} ${SCRIPT_PATH} --sync-only --full-sync >> ${LOG_FILE} 2>&1
+
 # Verificación de estado cada 6 horas (sin modificar nada)
 0 */6 * * * root ${PYTHON_BIN} ${SCRIPT_PATH} --status >> ${LOG_FILE} 2>&1
+
+# Rollup diario de critical_email_log (solo si las cards usan --source rollup;
+# requiere pymysql y credenciales DB_WRITE_* en el .env)
+# */15 * * * * root cd ${SCRIPT_DIR} && ${PYTHON_BIN} ${SCRIPT_DIR}/rollup_critical_emails.py >> ${LOG_FILE} 2>&1
+
+# Particiones mensuales de critical_email_log: crea las de los próximos meses y
+# aplica CRITICAL_EMAIL_RETENTION_MONTHS (requiere convertir antes la tabla con
+# partition_critical_emails.py --init; pymysql y DB_WRITE_* con permiso ALTER)
+# 30 4 * * * root cd ${SCRIPT_DIR} && ${PYTHON_BIN} ${SCRIPT_DIR}/partition_critical_emails.py >> ${LOG_FILE} 2>&1
 EOF
 
 chmod 644 "${CRON_FILE}"
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+metabase_api.py
+───────────────────────────────────────────────────────────────────────────────
+Lógica de la API de Metabase compartida por los tres clientes (el de
+setup_metabase_dashboard.py, el de update_metabase_dashboard.py y el
+asíncrono de metabase_async_client.py), sin depender del transporte HTTP:
+
+  - SyncPoller: criterio y backoff para esperar a que termine la
+    sincronización de una base de datos. El cliente hace el GET y la espera
+    (time.sleep o asyncio.sleep); el poller decide si la BD está lista, si
+    venció el plazo y cuánto esperar antes de la próxima consulta.
+  - build_card_payload: cuerpo de POST/PUT /api/card para una card con SQL
+    nativo, con sus template tags.
+
+Así el criterio de "sincronización terminada" y la forma de las cards no
+pueden divergir entre los clientes.
+
+Uso:
+  poller = SyncPoller(timeout=600)
+  while True:
+      db = client.get_database_status(db_id, include_tables=True, cached=False)
+      if poller.observe(db) is not None:
+          break
+      time.sleep(poller.next_delay())
+
+Autor: ImagineCRM Automation
+"""
+
+import time
+from typing import Dict, Optional
+
+SYNC_POLL_INITIAL   = 1.0    # Primera espera entre consultas de estado (segundos)
+SYNC_POLL_MAX_DELAY = 30.0   # Tope del backoff exponencial
+
+# Slug del modelo base (ver setup_metabase_dashboard.py --model): forma parte
+# de la referencia {{#id-slug}} que usan las cards construidas sobre él
+BASE_MODEL_SLUG = "base-emails-criticos"
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ESPERA DE SINCRONIZACIÓN
+# ══════════════════════════════════════════════════════════════════════════════
+
+def sync_progress(db: Dict) -> tuple:
+    """
+    Resume el estado de sync de /api/database/{id}?include=tables como
+    (lista, snapshot, tablas_completas, tablas_totales).
+    """
+    tables = db.get("tables") or []
+    done = sum(1 for t in tables if t.get("initial_sync_status", "complete") == "complete")
+    ready = db.get("initial_sync_status") == "complete" and done == len(tables)
+    snapshot = tuple(sorted(
+        (t.get("id"), t.get("updated_at"), t.get("initial_sync_status")) for t in tables
+    ))
+    return ready, snapshot, done, len(tables)
+
+
+class SyncPoller:
+    """
+    Decide cuándo terminó la sincronización de una BD. La considera lista
+    cuando ella y todas sus tablas tienen initial_sync_status = 'complete' y
+    la metadata de las tablas no cambió entre dos consultas consecutivas.
+    Entre consultas el backoff es exponencial (SYNC_POLL_INITIAL →
+    SYNC_POLL_MAX_DELAY).
+    """
+
+    def __init__(self, timeout: float, initial: float = SYNC_POLL_INITIAL,
+                 max_delay: float = SYNC_POLL_MAX_DELAY):
+        self.timeout   = timeout
+        self.delay     = initial
+        self.max_delay = max_delay
+        self.start     = time.time()
+        self.elapsed   = 0.0
+        self.done      = 0
+        self.total     = 0
+        self._previous = None
+
+    def observe(self, db: Optional[Dict]) -> Optional[bool]:
+        """
+        Registra una consulta de estado (None si falló). Retorna True si la BD
+        está lista, False si vence el plazo antes de la próxima consulta y
+        None si hay que seguir esperando.
+        """
+        self.elapsed = round(time.time() - self.start, 1)
+        if db:
+            ready, snapshot, self.done, self.total = sync_progress(db)
+            if ready and snapshot == self._previous:
+                return True
+            self._previous = snapshot if ready else None
+        if self.elapsed + self.delay > self.timeout:
+            return False
+        return None
+
+    def next_delay(self) -> float:
+        """Segundos a esperar antes de la próxima consulta (y duplica la siguiente)."""
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.max_delay)
+        return delay
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PAYLOAD DE CARDS
+# ══════════════════════════════════════════════════════════════════════════════
+
+def build_card_payload(name: str, description: str, sql: str, db_id: int,
+                       display: str, viz_settings: dict,
+                       collection_id: Optional[int] = None,
+                       card_type: str = "question", model_id: Optional[int] = None) -> dict:
+    """
+    Construye el payload de /api/card para una pregunta con SQL nativo.
+    card_type="model" crea un modelo (sin variables); model_id agrega la
+    referencia {{#id-...}} al modelo base como template tag de tipo card.
+    {{tenant_id}} es obligatorio y sin default: las cards por tenant son
+    compartidas y no deben ejecutarse sin fijar un tenant.
+    """
+    template_tags = {}
+    if card_type != "model":
+        template_tags["periodo_dias"] = {
+            "id": "periodo_dias",
+            "name": "periodo_dias",
+            "display-name": "Período (días)",
+            "type": "number",
+            "default": "7"
+        }
+    if "{{tenant_id}}" in sql:
+        template_tags["tenant_id"] = {
+            "id": "tenant_id",
+            "name": "tenant_id",
+            "display-name": "Tenant",
+            "type": "number",
+            "required": True
+        }
+    if model_id:
+        tag = f"#{model_id}-{BASE_MODEL_SLUG}"
+        template_tags[tag] = {
+            "id": f"card-{model_id}",
+            "name": tag,
+            "display-name": tag,
+            "type": "card",
+            "card-id": model_id
+        }
+    payload = {
+        "name": name,
+        "description": description,
+        "display": display,
+        "visualization_settings": viz_settings,
+        "dataset_query": {
+            "database": db_id,
+            "type": "native",
+            "native": {
+                "query": sql,
+                "template-tags": template_tags
+            }
+        },
+        "collection_id": collection_id
+    }
+    if card_type == "model":
+        payload["type"]    = "model"  # Metabase >= 0.49
+        payload["dataset"] = True     # Versiones anteriores
+    return payload
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+metabase_async_client.py
+───────────────────────────────────────────────────────────────────────────────
+Cliente asíncrono (asyncio) para la API REST de Metabase.
+
+Expone la misma superficie que los clientes síncronos de
+setup_metabase_dashboard.py y update_metabase_dashboard.py, pero sobre un
+pool de conexiones keep-alive de aiohttp, de modo que varias llamadas HTTP
+independientes (refresco de cards, estado de la BD y del dashboard, etc.)
+se solapan en un único proceso sin un hilo por request.
+
+Uso:
+  pip install aiohttp
+
+  async with AsyncMetabaseClient(METABASE_URL, pool_size=16) as client:
+      await client.auth_with_api_key(API_KEY)
+      results = await asyncio.gather(*(client.execute_card(cid) for cid in ids))
+
+Autor: ImagineCRM Automation
+"""
+
+import asyncio
+import logging
+import time
+from typing import Optional, List, Dict, Any
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # Dependencia opcional; solo necesaria para el modo --async
+
+from metabase_api import SyncPoller, build_card_payload
+from metabase_codec import ACCEPT_ENCODING, encode_body, loads
+from metabase_metrics import HTTP_REQUESTS, HTTP_RETRIES, RATE_LIMIT_RATE, RATE_LIMIT_WAIT
+from metabase_ratelimit import AdaptiveRateLimiter, THROTTLE_STATUSES, endpoint_key
+
+MAX_RETRIES     = 3
+RETRY_DELAY_SEC = 5
+REQUEST_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 16
+SYNC_WAIT_TIMEOUT = 600
+QUERY_TIMEOUT     = 900   # Plazo de extremo a extremo de una ejecución de card
+# Métodos que se pueden reenviar tras un timeout o un corte de conexión: un
+# POST que ya llegó a Metabase (p. ej. /api/card/{id}/query) se ejecutaría otra vez
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+log = logging.getLogger("metabase_update")
+
+
+class AsyncResponse:
+    """Respuesta ya leída del servidor, con la misma forma que requests.Response."""
+
+    def __init__(self, status_code: int, content: bytes, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.content     = content
+        self.headers     = headers
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        # Se decodifica desde los bytes: orjson evita la copia intermedia a str
+        return loads(self.content) if self.content else None
+
+
+class AsyncMetabaseClient:
+    """Cliente asíncrono para la API REST de Metabase con reintentos automáticos."""
+
+    def __init__(self, base_url: str, pool_size: int = DEFAULT_POOL_SIZE):
+        if aiohttp is None:
+            raise RuntimeError("El modo asíncrono requiere aiohttp: pip install aiohttp")
+        self.base_url  = base_url
+        self.pool_size = max(pool_size, 1)
+        self.headers   = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Accept-Encoding": ACCEPT_ENCODING
+        }
+        self._session: Optional["aiohttp.ClientSession"] = None
+        # Metadata de cards por ID, válida durante la ejecución actual
+        self._card_cache: Dict[int, Dict] = {}
+        # Limitador de tasa compartido por todas las corrutinas del cliente
+        self.limiter = AdaptiveRateLimiter()
+
+    # ── Ciclo de vida ──────────────────────────────────────────────────────
+
+    async def __aenter__(self) -> "AsyncMetabaseClient":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        """Crea la sesión con un pool keep-alive dimensionado para uso concurrente."""
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # ── Autenticación ──────────────────────────────────────────────────────
+
+    async def auth_with_api_key(self, api_key: str) -> bool:
+        self.headers["x-api-key"] = api_key
+        r = await self._get("/api/user/current")
+        if r and r.status_code == 200:
+            user = r.json()
+            log.info(f"Autenticado como: {user.get('email')} (API Key)")
+            return True
+        log.error(f"API Key inválida. Status: {r.status_code if r else 'N/A'}")
+        return False
+
+    async def auth_with_credentials(self, email: str, password: str) -> bool:
+        r = await self._post("/api/session", {"username": email, "password": password})
+        if r and r.status_code == 200:
+            self.headers["X-Metabase-Session"] = r.json().get("id")
+            log.info(f"Autenticado como: {email} (session token)")
+            return True
+        log.error(f"Credenciales inválidas. Status: {r.status_code if r else 'N/A'}")
+        return False
+
+    # ── HTTP con reintentos ────────────────────────────────────────────────
+
+    async def _request(self, method: str, path: str, raise_timeout: bool = False,
+                       **kwargs) -> Optional[AsyncResponse]:
+        """
+        Request con reintentos. Los 429/503 se reintentan siempre (Metabase no
+        procesó el request). Los timeouts y cortes de conexión solo se
+        reintentan en métodos idempotentes o si la conexión no llegó a
+        establecerse; un POST no se reenvía y retorna None, o con
+        raise_timeout=True relanza asyncio.TimeoutError.
+        """
+        await self.open()
+        idempotent = method in IDEMPOTENT_METHODS
+        url = f"{self.base_url}{path}"
+        key = endpoint_key(method, path)
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        for attempt in range(1, MAX_RETRIES + 1):
+            RATE_LIMIT_WAIT.inc(await self.limiter.acquire_async())
+            start = time.monotonic()
+            try:
+                async with self._session.request(method, url, headers=headers,
+                                                 **kwargs) as resp:
+                    content = await resp.read()
+                    self.limiter.record(key, resp.status, time.monotonic() - start,
+                                        resp.headers.get("Retry-After"))
+                    RATE_LIMIT_RATE.set(round(self.limiter.rate, 2))
+                    HTTP_REQUESTS.inc(method=method, status=resp.status)
+                    if resp.status in THROTTLE_STATUSES:  # Rate limit / sobrecarga
+                        log.warning(f"Metabase respondió {resp.status}. Tasa reducida a "
+                                    f"{self.limiter.rate:.1f} req/s")
+                        HTTP_RETRIES.inc(reason="rate_limit")
+                        continue
+                    return AsyncResponse(resp.status, content, dict(resp.headers))
+            except asyncio.TimeoutError:
+                # Va antes que ClientConnectionError: el timeout de sock_read
+                # (ServerTimeoutError) hereda de ambas
+                log.warning(f"Timeout (intento {attempt}/{MAX_RETRIES})")
+                HTTP_REQUESTS.inc(method=method, status="timeout")
+                if not idempotent:
+                    log.warning(f"No se reenvía {method} {path}")
+                    if raise_timeout:
+                        raise
+                    return None
+                if attempt < MAX_RETRIES:
+                    HTTP_RETRIES.inc(reason="timeout")
+                    await asyncio.sleep(RETRY_DELAY_SEC)
+            except aiohttp.ClientConnectionError as e:
+                log.warning(f"Error de conexión (intento {attempt}/{MAX_RETRIES}): {e}")
+                HTTP_REQUESTS.inc(method=method, status="connection_error")
+                if not idempotent and not isinstance(e, aiohttp.ClientConnectorError):
+                    # El request pudo llegar a Metabase antes del corte
+                    log.warning(f"No se reenvía {method} {path}")
+                    return None
+                if attempt < MAX_RETRIES:
+                    HTTP_RETRIES.inc(reason="connection_error")
+                    await asyncio.sleep(RETRY_DELAY_SEC * attempt)
+        log.error(f"Falló después de {MAX_RETRIES} intentos: {method} {path}")
+        return None
+
+    async def _get(self, path: str, **kwargs):
+        return await self._request("GET", path, **kwargs)
+
+    async def _post(self, path: str, data: dict = None, **kwargs):
+        return await self._request("POST", path, **self._json_body(data), **kwargs)
+
+    async def _put(self, path: str, data: dict = None, **kwargs):
+        return await self._request("PUT", path, **self._json_body(data), **kwargs)
+
+    def _json_body(self, data: Optional[dict]) -> Dict:
+        """Cuerpo JSON serializado con el codec (y gzip si está activado)."""
+        if data is None:
+            return {}
+        body, headers = encode_body(data)
+        return {"data": body, "headers": headers}
+
+    async def _delete(self, path: str, **kwargs):
+        return await self._request("DELETE", path, **kwargs)
+
+    # ── Base de datos ──────────────────────────────────────────────────────
+
+    async def find_database(self, name: str) -> Optional[Dict]:
+        """Busca una base de datos por nombre."""
+        r = await self._get("/api/database")
+        if not r or r.status_code != 200:
+            return None
+        dbs = r.json()
+        if isinstance(dbs, dict):
+            dbs = dbs.get("data", [])
+        for db in dbs:
+            if db.get("name") == name:
+                return db
+        return None
+
+    async def sync_database_schema(self, db_id: int) -> bool:
+        """Fuerza la re-sincronización del esquema de la base de datos."""
+        log.info(f"Re-sincronizando esquema de la base de datos ID: {db_id}...")
+        r = await self._post(f"/api/database/{db_id}/sync_schema")
+        if r and r.status_code in (200, 204):
+            log.info("Sincronización de esquema iniciada correctamente")
+            return True
+        log.warning(f"Error al sincronizar esquema: {r.status_code if r else 'N/A'}")
+        return False
+
+    async def rescan_database_values(self, db_id: int) -> bool:
+        """Re-escanea los valores de los campos para actualizar los filtros."""
+        log.info(f"Re-escaneando valores de la base de datos ID: {db_id}...")
+        r = await self._post(f"/api/database/{db_id}/rescan_values")
+        if r and r.status_code in (200, 204):
+            log.info("Re-escaneo de valores iniciado correctamente")
+            return True
+        log.warning(f"Error al re-escanear valores: {r.status_code if r else 'N/A'}")
+        return False
+
+    async def get_database_status(self, db_id: int, include_tables: bool = False) -> Optional[Dict]:
+        """Obtiene el estado actual de la base de datos (opcionalmente con sus tablas)."""
+        params = {"include": "tables"} if include_tables else None
+        r = await self._get(f"/api/database/{db_id}", params=params)
+        if r and r.status_code == 200:
+            return r.json()
+        return None
+
+    async def wait_for_sync(self, db_id: int, timeout: float = SYNC_WAIT_TIMEOUT) -> bool:
+        """
+        Espera a que Metabase termine de sincronizar la base de datos, con el
+        criterio y el backoff de SyncPoller (metabase_api.py).
+        """
+        poller = SyncPoller(timeout)
+        while True:
+            db = await self.get_database_status(db_id, include_tables=True)
+            result = poller.observe(db)
+            if result:
+                log.info(f"Sincronización completa ({poller.total} tablas, {poller.elapsed}s)")
+                return True
+            if db:
+                log.info(f"Sincronización en curso: {poller.done}/{poller.total} tablas completas "
+                         f"({poller.elapsed}s)")
+            if result is False:
+                log.warning(f"La sincronización no terminó en {timeout}s; se continúa igualmente")
+                return False
+            await asyncio.sleep(poller.next_delay())
+
+    # ── Colección ──────────────────────────────────────────────────────────
+
+    async def get_or_create_collection(self, name: str) -> Optional[int]:
+        """Obtiene o crea una colección para organizar el dashboard."""
+        r = await self._get("/api/collection")
+        if r and r.status_code == 200:
+            collections = r.json()
+            if isinstance(collections, dict):
+                collections = collections.get("data", [])
+            for col in collections:
+                if col.get("name") == name:
+                    return col["id"]
+        r = await self._post("/api/collection", {"name": name, "color": "#509EE3"})
+        if r and r.status_code in (200, 201):
+            return r.json()["id"]
+        log.warning(f"No se pudo crear la colección '{name}'")
+        return None
+
+    # ── Dashboard ──────────────────────────────────────────────────────────
+
+    async def get_dashboard(self, dashboard_id: int) -> Optional[Dict]:
+        """Obtiene los datos completos del dashboard incluyendo sus cards."""
+        r = await self._get(f"/api/dashboard/{dashboard_id}")
+        if r and r.status_code == 200:
+            return r.json()
+        log.error(f"No se pudo obtener el dashboard {dashboard_id}: {r.status_code if r else 'N/A'}")
+        return None
+
+    async def get_dashboard_cards(self, dashboard_id: int) -> List[Dict]:
+        """Obtiene la lista de cards (preguntas) del dashboard."""
+        dashboard = await self.get_dashboard(dashboard_id)
+        if not dashboard:
+            return []
+        cards = dashboard.get("ordered_cards", dashboard.get("dashcards", []))
+        cards = [c for c in cards if c.get("card_id")]  # Excluir text cards
+        self.remember_cards(cards)
+        return cards
+
+    def remember_cards(self, dashcards: List[Dict]) -> None:
+        """
+        Guarda en el caché la card embebida en cada dashcard de /api/dashboard/{id},
+        evitando un GET /api/card/{id} por card solo para leer nombre y updated_at.
+        """
+        for dc in dashcards:
+            card = dc.get("card")
+            if dc.get("card_id") and card:
+                self._card_cache[dc["card_id"]] = card
+
+    async def find_dashboard_by_name(self, name: str) -> Optional[int]:
+        """Busca un dashboard por nombre y retorna su ID."""
+        r = await self._get("/api/dashboard", params={"f": "all"})
+        if r and r.status_code == 200:
+            dashboards = r.json()
+            if isinstance(dashboards, dict):
+                dashboards = dashboards.get("data", [])
+            for d in dashboards:
+                if d.get("name") == name:
+                    return d["id"]
+        return None
+
+    async def create_dashboard(self, name: str, description: str,
+                               collection_id: Optional[int] = None) -> int:
+        """Crea un dashboard vacío."""
+        r = await self._post("/api/dashboard", {
+            "name": name,
+            "description": description,
+            "collection_id": collection_id,
+            "parameters": []
+        })
+        if r and r.status_code in (200, 201):
+            return r.json()["id"]
+        raise RuntimeError(f"Error al crear dashboard: {r.status_code if r else 'N/A'}")
+
+    async def update_dashboard_layout(self, dashboard_id: int, dashcards: list,
+                                      parameters: list) -> None:
+        """Envía el layout completo (dashcards con ID negativo si son nuevos + filtros) en un PUT."""
+        r = await self._put(f"/api/dashboard/{dashboard_id}",
+                            {"dashcards": dashcards, "parameters": parameters})
+        if not r or r.status_code != 200:
+            raise RuntimeError(
+                f"Error al guardar el layout del dashboard: {r.status_code if r else 'N/A'}"
+            )
+
+    async def set_dashboard_auto_refresh(self, dashboard_id: int,
+                                         interval_seconds: int = 3600) -> bool:
+        """Configura el auto-refresh del dashboard (mismos intervalos que el cliente síncrono)."""
+        valid_intervals = [60, 300, 600, 1800, 3600, 10800, 21600, 86400]
+        if interval_seconds not in valid_intervals:
+            interval_seconds = min(valid_intervals, key=lambda x: abs(x - interval_seconds))
+            log.warning(f"Intervalo ajustado al válido más cercano: {interval_seconds}s")
+        r = await self._put(f"/api/dashboard/{dashboard_id}", {"cache_ttl": interval_seconds})
+        if r and r.status_code == 200:
+            log.info(f"Auto-refresh configurado a cada {interval_seconds // 60} minutos")
+            return True
+        log.warning(f"No se pudo configurar auto-refresh: {r.status_code if r else 'N/A'}")
+        return False
+
+    # ── Cards (Preguntas) ──────────────────────────────────────────────────
+
+    async def create_card(self, name: str, description: str, sql: str,
+                          db_id: int, display: str, viz_settings: dict,
+                          collection_id: Optional[int] = None) -> int:
+        """Crea una pregunta (card) con SQL nativo en Metabase."""
+        r = await self._post("/api/card", build_card_payload(
+            name, description, sql, db_id, display, viz_settings, collection_id))
+        if r and r.status_code in (200, 201):
+            return r.json()["id"]
+        raise RuntimeError(f"Error al crear card '{name}': {r.status_code if r else 'N/A'}")
+
+    async def get_card_info(self, card_id: int) -> Optional[Dict]:
+        """Obtiene información de una card (desde el caché de la ejecución si ya se leyó)."""
+        if card_id in self._card_cache:
+            return self._card_cache[card_id]
+        r = await self._get(f"/api/card/{card_id}")
+        if r and r.status_code == 200:
+            self._card_cache[card_id] = r.json()
+            return self._card_cache[card_id]
+        return None
+
+    async def execute_card(self, card_id: int, parameters: list = None,
+                           timeout: float = QUERY_TIMEOUT) -> Dict:
+        """
+        Fuerza la re-ejecución de una card, ignorando el caché, y espera su
+        resultado final. Una 202 se lee hasta el final del cuerpo, donde
+        Metabase envía el resultado cuando la query termina. Si no termina en
+        `timeout` segundos el request se cancela (Metabase cancela la query
+        al cerrarse la conexión).
+        """
+        payload = {
+            "parameters": parameters or [],
+            "ignore_cache": True
+        }
+        start_time = time.monotonic()
+        try:
+            # Sin límite total por request: el plazo lo marca wait_for; sock_read
+            # sigue detectando conexiones colgadas (Metabase envía keepalives)
+            r = await asyncio.wait_for(
+                self._post(f"/api/card/{card_id}/query", payload, raise_timeout=True,
+                           timeout=aiohttp.ClientTimeout(total=None, sock_read=REQUEST_TIMEOUT)),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            elapsed = round(time.monotonic() - start_time, 2)
+            log.warning(f"  Card {card_id}: sin resultado tras {elapsed}s; se cancela la query")
+            return {"card_id": card_id, "status": "timeout", "elapsed": elapsed}
+        elapsed = round(time.monotonic() - start_time, 2)
+
+        if not r or r.status_code not in (200, 202):
+            status = r.status_code if r else "N/A"
+            log.warning(f"  Card {card_id}: error al ejecutar (status {status}, {elapsed}s)")
+            return {"card_id": card_id, "status": "error", "http_status": status,
+                    "elapsed": elapsed}
+
+        is_async = r.status_code == 202
+        try:
+            data = r.json() or {}
+        except ValueError as e:
+            # Cuerpo truncado o no JSON (p. ej. la conexión se cortó en una 202)
+            log.warning(f"  Card {card_id}: no se pudo leer el resultado ({elapsed}s): {e}")
+            return {"card_id": card_id, "status": "error", "http_status": r.status_code,
+                    "error": str(e)[:200], "async": is_async, "elapsed": elapsed}
+        if data.get("status") not in (None, "completed"):
+            error = str(data.get("error") or "")[:200]
+            log.warning(f"  Card {card_id}: la query terminó en estado {data['status']} "
+                        f"({elapsed}s): {error}")
+            return {"card_id": card_id, "status": "error", "query_status": data["status"],
+                    "error": error, "async": is_async, "elapsed": elapsed}
+
+        row_count = data.get("row_count")
+        if row_count is None:
+            row_count = len((data.get("data") or {}).get("rows", []))
+        log.info(f"  Card {card_id}: {row_count} filas ({elapsed}s)")
+        return {"card_id": card_id, "status": "ok", "rows": row_count, "elapsed": elapsed,
+                "async": is_async, "running_time_ms": data.get("running_time")}
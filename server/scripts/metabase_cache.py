@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+metabase_cache.py
+───────────────────────────────────────────────────────────────────────────────
+Caché de respuestas GET para los clientes de la API REST de Metabase.
+
+La metadata que leen los scripts (dashboard, base de datos, colecciones,
+listados) cambia poco, pero se pedía completa varias veces por ejecución y
+en cada ciclo del daemon. El caché guarda las respuestas 200 por ruta y
+parámetros:
+  - Dentro del TTL la respuesta se sirve desde memoria, sin request.
+  - Vencida, se revalida con If-None-Match / If-Modified-Since si el servidor
+    envió ETag o Last-Modified: un 304 renueva la entrada sin re-descargarla.
+    Sin validadores se vuelve a pedir completa.
+  - LRU: por encima de max_entries se descartan las menos usadas.
+  - Cualquier POST/PUT/DELETE invalida las entradas del mismo recurso
+    (/api/dashboard/5 invalida /api/dashboard y /api/dashboard/...), salvo
+    las ejecuciones de consultas, que no modifican metadata.
+  - Opcionalmente se persiste a disco (JSON, escritura atómica) para que las
+    ejecuciones de cron sucesivas revaliden en lugar de descargar.
+
+Variables de entorno:
+  METABASE_CACHE_TTL          Segundos de validez de una respuesta (default: 300)
+  METABASE_CACHE_MAX_ENTRIES  Entradas máximas en memoria (default: 256)
+  METABASE_CACHE_FILE         Archivo de persistencia (default: vacío = solo memoria)
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Callable
+
+from metabase_codec import loads
+
+CACHE_TTL         = float(os.getenv("METABASE_CACHE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("METABASE_CACHE_MAX_ENTRIES", "256"))
+CACHE_FILE        = os.getenv("METABASE_CACHE_FILE", "")
+
+# POSTs que solo leen datos: no invalidan la metadata cacheada
+READ_ONLY_POST_RE = re.compile(r"^/api/(dataset|card/\d+/query)")
+RESOURCE_RE       = re.compile(r"^/api/[^/?]+")
+KEPT_HEADERS      = ("ETag", "Last-Modified", "Content-Type")
+
+
+def cache_key(path: str, params: Optional[Dict] = None) -> str:
+    if not params:
+        return path
+    query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+    return f"{path}?{query}"
+
+
+class CachedResponse:
+    """Respuesta servida desde el caché, con la misma forma que requests.Response."""
+
+    def __init__(self, status_code: int, text: str, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.text        = text
+        self.headers     = headers
+        self.from_cache  = True
+
+    def __bool__(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> Any:
+        return loads(self.text) if self.text else None
+
+    def close(self) -> None:
+        pass
+
+
+class ResponseCache:
+    """Caché LRU con TTL y validadores HTTP, thread-safe."""
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES,
+                 path: str = CACHE_FILE):
+        self.ttl         = ttl
+        self.max_entries = max(max_entries, 1)
+        self.path        = path
+        self._lock       = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Contadores para reportes y métricas
+        self.hits         = 0
+        self.revalidated  = 0
+        self.misses       = 0
+        if path:
+            self._load()
+
+    # ── Lectura ────────────────────────────────────────────────────────────
+
+    def lookup(self, key: str) -> tuple:
+        """
+        Retorna (respuesta, headers_condicionales): la respuesta si la entrada
+        está vigente; si no, los headers para revalidarla (vacíos si no hay entrada).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, {}
+            self._entries.move_to_end(key)
+            if time.time() - entry["stored_at"] < self.ttl:
+                return self._response(entry), {}
+            conditional = {}
+            if entry["headers"].get("ETag"):
+                conditional["If-None-Match"] = entry["headers"]["ETag"]
+            if entry["headers"].get("Last-Modified"):
+                conditional["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+            return None, conditional
+
+    def revalidate(self, key: str) -> Optional[CachedResponse]:
+        """El servidor respondió 304: renueva la entrada y la retorna."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry["stored_at"] = time.time()
+            return self._response(entry)
+
+    def fetch(self, key: str, send: Callable[[Dict[str, str]], Any]) -> tuple:
+        """
+        Resuelve un GET con el caché. `send(headers)` hace el request real con
+        los headers condicionales dados. Retorna (respuesta, resultado) con
+        resultado "hit", "revalidated" o "miss".
+        """
+        cached, conditional = self.lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached, "hit"
+        r = send(conditional)
+        if r is not None and r.status_code == 304:
+            revalidated = self.revalidate(key)
+            if revalidated is not None:
+                self.revalidated += 1
+                return revalidated, "revalidated"
+            r = send({})  # Entrada descartada mientras tanto: pedir la respuesta completa
+        if r is not None:
+            self.store(key, r)
+        self.misses += 1
+        return r, "miss"
+
+    @staticmethod
+    def _response(entry: Dict[str, Any]) -> CachedResponse:
+        return CachedResponse(entry["status"], entry["text"], dict(entry["headers"]))
+
+    # ── Escritura e invalidación ───────────────────────────────────────────
+
+    def store(self, key: str, response) -> None:
+        if response.status_code != 200:
+            return
+        headers = {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers}
+        with self._lock:
+            self._entries[key] = {"status": response.status_code, "text": response.text,
+                                  "headers": headers, "stored_at": time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_for(self, method: str, path: str) -> None:
+        """Invalida las entradas del recurso afectado por un request mutante."""
+        if method == "GET" or (method == "POST" and READ_ONLY_POST_RE.match(path)):
+            return
+        match = RESOURCE_RE.match(path)
+        prefix = match.group(0) if match else path
+        with self._lock:
+            for key in [k for k in self._entries
+                        if k == prefix or k.startswith((f"{prefix}/", f"{prefix}?"))]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    # ── Persistencia ───────────────────────────────────────────────────────
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Sin archivo o corrupto: se empieza con el caché vacío
+        if isinstance(data, dict):
+            for key, entry in data.items():
+                self._entries[key] = entry
+
+    def save(self) -> None:
+        """Escribe el caché a disco (archivo temporal propio + rename). No-op sin path."""
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            # Temporal propio: el cron y el sync de las 02:00 pueden guardar a la vez
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metabase_cache.",
+                                            suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self._entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
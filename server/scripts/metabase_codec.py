@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+metabase_codec.py
+───────────────────────────────────────────────────────────────────────────────
+Serialización JSON y negociación de compresión para los clientes de Metabase.
+
+  - JSON: usa orjson si está instalado (decodifica los resultados grandes de
+    /api/card/{id}/query varias veces más rápido que el json estándar) y, si
+    no, el módulo json de la biblioteca estándar. Ambos producen los mismos
+    objetos Python, así que los llamadores no notan la diferencia.
+  - Respuestas comprimidas: ACCEPT_ENCODING anuncia gzip y deflate, y br
+    solo si hay un decodificador brotli instalado (requests/urllib3 y aiohttp
+    lo usan automáticamente); anunciarlo sin poder decodificarlo rompería
+    las respuestas.
+  - Cuerpos comprimidos: con METABASE_GZIP_REQUESTS=1 los cuerpos JSON de
+    más de GZIP_MIN_BYTES (SQL de cards, PUT del layout del dashboard) se
+    envían con Content-Encoding: gzip. Es opcional porque Metabase no
+    descomprime cuerpos por sí mismo: solo sirve si un proxy delante
+    (p. ej. un módulo de nginx/Envoy) los descomprime.
+
+Variables de entorno:
+  METABASE_GZIP_REQUESTS   1 para comprimir cuerpos grandes (default: 0)
+  METABASE_GZIP_MIN_BYTES  Tamaño mínimo del cuerpo a comprimir (default: 8192)
+
+Uso:
+  pip install orjson brotli    # Ambos opcionales
+  from metabase_codec import dumps, loads, decode_json, encode_body
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import gzip
+import json
+from typing import Any, Dict, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Dependencia opcional; sin ella se usa json estándar
+
+try:
+    import brotli  # noqa: F401  (solo se comprueba que exista el decodificador)
+    HAS_BROTLI = True
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        HAS_BROTLI = True
+    except ImportError:
+        HAS_BROTLI = False
+
+GZIP_REQUESTS  = os.getenv("METABASE_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+GZIP_MIN_BYTES = int(os.getenv("METABASE_GZIP_MIN_BYTES", "8192"))
+GZIP_LEVEL     = 6
+
+ACCEPT_ENCODING = "gzip, deflate, br" if HAS_BROTLI else "gzip, deflate"
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def dumps(obj: Any) -> bytes:
+    """Serializa a JSON en UTF-8."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data) -> Any:
+    """Decodifica JSON desde bytes o str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_json(response) -> Any:
+    """
+    Equivalente a response.json() con el codec: lee los bytes de un
+    requests.Response, o delega en .json() de las respuestas propias
+    (caché, cliente asíncrono), que ya usan loads().
+    """
+    content = getattr(response, "content", None)
+    if content is None:
+        return response.json()
+    return loads(content) if content else None
+
+
+def encode_body(obj: Any, compress: bool = GZIP_REQUESTS) -> Tuple[bytes, Dict[str, str]]:
+    """Serializa un cuerpo JSON; lo comprime con gzip si está activado y supera el mínimo."""
+    body = dumps(obj)
+    headers = {"Content-Type": "application/json"}
+    if compress and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+metabase_metrics.py
+───────────────────────────────────────────────────────────────────────────────
+Métricas en formato de texto de Prometheus para los scripts de Metabase.
+
+Registro mínimo de counters, gauges e histogramas con labels (sin dependencias
+externas), que se puede volcar a un archivo .prom para el textfile collector
+de node-exporter o servir en /metrics desde el modo daemon.
+
+Variables de entorno:
+  METABASE_METRICS_HOST  Interfaz en la que se sirve /metrics (default: 127.0.0.1)
+
+Uso:
+  from metabase_metrics import REGISTRY
+  REQUESTS = REGISTRY.counter("metabase_http_requests_total", "Requests HTTP", ("method",))
+  REQUESTS.inc(method="GET")
+  REGISTRY.write_textfile("/var/lib/node_exporter/textfile/metabase.prom")
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, List
+
+METRICS_HOST    = os.getenv("METABASE_METRICS_HOST", "127.0.0.1")
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name   = name
+        self.help   = help_text
+        self.labels = tuple(labels)
+        self._lock  = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: Tuple, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total, n = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, n + 1)
+
+    def _render_value(self, key: Tuple, value) -> List[str]:
+        counts, total, n = value
+        lines = []
+        for bound, count in list(zip(self.buckets, counts)) + [("+Inf", n)]:
+            le = 'le="%s"' % bound
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {n}")
+        return lines
+
+
+class MetricsRegistry:
+    """Conjunto de métricas con exportación a archivo de texto y endpoint HTTP."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Escribe las métricas de forma atómica (node-exporter nunca lee un archivo
+        a medias). Cada llamada usa su propio temporal: en modo daemon varias
+        tareas terminan a la vez y escriben el mismo .prom desde hilos distintos.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        # El textfile collector solo lee *.prom: el temporal no se recoge a medias
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metabase_metrics.",
+                                        suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            # mkstemp crea el archivo con 0600 y node-exporter suele correr con otro usuario
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def serve(self, port: int, host: str = METRICS_HOST) -> ThreadingHTTPServer:
+        """
+        Sirve /metrics en un hilo de fondo y retorna el servidor (para shutdown()).
+        Por defecto solo en loopback: las métricas incluyen IDs y tiempos de las
+        cards. Para que Prometheus las lea desde otra máquina hay que indicar
+        la interfaz (METABASE_METRICS_HOST).
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Sin ruido en el log por cada scrape
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+REGISTRY = MetricsRegistry()
+
+# ── Métricas HTTP compartidas por los clientes síncrono y asíncrono ─────────
+HTTP_REQUESTS = REGISTRY.counter(
+    "metabase_http_requests_total", "Requests HTTP a Metabase por método y status",
+    ("method", "status"))
+HTTP_RETRIES = REGISTRY.counter(
+    "metabase_http_retries_total", "Reintentos HTTP por motivo", ("reason",))
+RATE_LIMIT_WAIT = REGISTRY.counter(
+    "metabase_rate_limit_wait_seconds_total",
+    "Segundos esperados por el limitador de tasa (incluye pausas por 429/503)")
+RATE_LIMIT_RATE = REGISTRY.gauge(
+    "metabase_rate_limit_requests_per_second", "Tasa actual del limitador adaptativo")
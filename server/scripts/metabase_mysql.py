@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+metabase_mysql.py
+───────────────────────────────────────────────────────────────────────────────
+Conexión directa a la base de datos MySQL de ImagineCRM para los scripts de
+Metabase que necesitan leer o escribir tablas sin pasar por la API REST
+(por ejemplo, el rollup diario de critical_email_log).
+
+Usa las mismas variables DB_* que setup_metabase_dashboard.py. Como el usuario
+de Metabase es de solo lectura, las escrituras pueden usar credenciales
+propias con DB_WRITE_* (si no se definen, se usan las DB_*). Las lecturas
+pesadas (snapshot_critical_emails.py) pueden ir a una read replica con
+DB_REPLICA_* (ver docs/BACKUP_PITR_REPLICA.md).
+
+También incluye:
+  - ConnectionPool: pool de conexiones reutilizables para varios hilos.
+  - render_native_query: convierte el SQL nativo de una card de Metabase
+    ({{variable}}, [[ ... ]]) en SQL con placeholders de pymysql.
+
+Variables de entorno:
+  DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD      Conexión de lectura
+  DB_WRITE_HOST, DB_WRITE_USER, DB_WRITE_PASSWORD      Conexión de escritura (opcional)
+  DB_REPLICA_HOST, DB_REPLICA_PORT,
+  DB_REPLICA_USER, DB_REPLICA_PASSWORD                 Read replica (opcional, default: DB_*)
+  DB_POOL_SIZE                                         Conexiones del pool (default: 4)
+
+Uso:
+  pip install pymysql
+  from metabase_mysql import connect
+  with connect(write=True) as conn:
+      ...
+
+  with ConnectionPool(replica=True) as pool, pool.connection() as conn:
+      sql, args = render_native_query(card_sql, {"periodo_dias": 30})
+      with conn.cursor() as cur:
+          cur.execute(sql, args)
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Tuple
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None  # Dependencia opcional; solo la necesitan los scripts con acceso directo
+
+DB_HOST     = os.getenv("DB_HOST", "localhost")
+DB_PORT     = int(os.getenv("DB_PORT", "3306"))
+DB_NAME     = os.getenv("DB_NAME", "imaginecrm")
+DB_USER     = os.getenv("DB_USER", "root")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "")
+
+DB_WRITE_HOST     = os.getenv("DB_WRITE_HOST", DB_HOST)
+DB_WRITE_USER     = os.getenv("DB_WRITE_USER", DB_USER)
+DB_WRITE_PASSWORD = os.getenv("DB_WRITE_PASSWORD", DB_PASSWORD)
+
+DB_REPLICA_HOST     = os.getenv("DB_REPLICA_HOST", DB_HOST)
+DB_REPLICA_PORT     = int(os.getenv("DB_REPLICA_PORT", str(DB_PORT)))
+DB_REPLICA_USER     = os.getenv("DB_REPLICA_USER", DB_USER)
+DB_REPLICA_PASSWORD = os.getenv("DB_REPLICA_PASSWORD", DB_PASSWORD)
+
+CONNECT_TIMEOUT = 10
+POOL_SIZE       = int(os.getenv("DB_POOL_SIZE", "4"))
+
+
+def connect(write: bool = False, autocommit: bool = True, replica: bool = False,
+            read_timeout: float = None):
+    """
+    Abre una conexión a MySQL. Con write=True usa las credenciales DB_WRITE_*;
+    con replica=True, las DB_REPLICA_*. read_timeout (segundos) corta las
+    queries que no responden. La conexión se puede usar como context manager
+    (se cierra al salir).
+    """
+    if pymysql is None:
+        raise RuntimeError("Falta la dependencia 'pymysql'. Instálala con: pip install pymysql")
+    if write:
+        host, port, user, password = DB_WRITE_HOST, DB_PORT, DB_WRITE_USER, DB_WRITE_PASSWORD
+    elif replica:
+        host, port = DB_REPLICA_HOST, DB_REPLICA_PORT
+        user, password = DB_REPLICA_USER, DB_REPLICA_PASSWORD
+    else:
+        host, port, user, password = DB_HOST, DB_PORT, DB_USER, DB_PASSWORD
+    return pymysql.connect(
+        host=host,
+        port=port,
+        user=user,
+        password=password,
+        database=DB_NAME,
+        charset="utf8mb4",
+        autocommit=autocommit,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=read_timeout,
+    )
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# POOL DE CONEXIONES
+# ══════════════════════════════════════════════════════════════════════════════
+
+class ConnectionPool:
+    """
+    Pool de conexiones pymysql thread-safe. Abre conexiones a demanda hasta
+    `size` y las reutiliza entre hilos. Antes de entregar una conexión ociosa
+    le hace ping (reconecta si el servidor la cerró por wait_timeout). Una
+    conexión que falló durante su uso se descarta en lugar de volver al pool.
+    Los argumentos extra se pasan a connect() (write, replica, read_timeout).
+    """
+
+    def __init__(self, size: int = POOL_SIZE, **connect_kwargs):
+        self.size     = max(size, 1)
+        self._kwargs  = connect_kwargs
+        self._idle    = queue.LifoQueue()
+        self._slots   = threading.BoundedSemaphore(self.size)
+        self.created  = 0  # Conexiones abiertas en total (para reportes)
+
+    def __enter__(self) -> "ConnectionPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @contextmanager
+    def connection(self):
+        """Presta una conexión; si no hay ninguna libre espera a que se devuelva una."""
+        self._slots.acquire()
+        conn = None
+        try:
+            try:
+                conn = self._idle.get_nowait()
+                conn.ping(reconnect=True)
+            except queue.Empty:
+                conn = connect(**self._kwargs)
+                self.created += 1
+            yield conn
+        except Exception:
+            if conn is not None:
+                _close_quietly(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._idle.put(conn)
+            self._slots.release()
+
+    def close(self) -> None:
+        while True:
+            try:
+                _close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass  # La conexión ya estaba rota: no hay nada que cerrar
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# SQL NATIVO DE METABASE
+# ══════════════════════════════════════════════════════════════════════════════
+
+TEMPLATE_TAG_RE = re.compile(r"\{\{\s*([#\w-]+)\s*\}\}")
+OPTIONAL_CLAUSE_RE = re.compile(r"\[\[(.*?)\]\]", re.DOTALL)
+
+
+def render_native_query(sql: str, params: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Convierte el SQL nativo de una card en (sql, args) para cursor.execute(),
+    con las reglas de Metabase:
+      - {{variable}} pasa a ser el placeholder %(variable)s: el driver escapa
+        el valor, que nunca se interpola como texto en el SQL.
+      - [[ ... ]] se incluye solo si todas sus variables tienen valor.
+      - Los % literales (p. ej. CONCAT(..., '%')) se duplican para que pymysql
+        no los tome como placeholders.
+    Lanza ValueError ante una variable sin valor fuera de [[ ]] o una
+    referencia a otra card ({{#12-modelo}}), que solo Metabase sabe expandir.
+    """
+    def optional(match) -> str:
+        body = match.group(1)
+        names = TEMPLATE_TAG_RE.findall(body)
+        return body if all(params.get(name) is not None for name in names) else ""
+
+    sql = OPTIONAL_CLAUSE_RE.sub(optional, sql)
+    parts, args, last = [], {}, 0
+    for match in TEMPLATE_TAG_RE.finditer(sql):
+        name = match.group(1)
+        if name.startswith("#"):
+            raise ValueError(f"La referencia {{{{{name}}}}} solo se puede ejecutar en Metabase")
+        if params.get(name) is None:
+            raise ValueError(f"La variable {{{{{name}}}}} no tiene valor")
+        parts.append(sql[last:match.start()].replace("%", "%%"))
+        parts.append(f"%({name})s")
+        args[name] = params[name]
+        last = match.end()
+    parts.append(sql[last:].replace("%", "%%"))
+    return "".join(parts), args
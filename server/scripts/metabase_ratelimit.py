@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+metabase_ratelimit.py
+───────────────────────────────────────────────────────────────────────────────
+Limitador de tasa adaptativo compartido por los clientes de Metabase.
+
+Token bucket cuya tasa (requests/s) se ajusta con AIMD, como el control de
+congestión de TCP:
+  - Arranque lento: hasta la primera señal de congestión cada respuesta sana
+    suma 1 req/s (la tasa se duplica aprox. cada segundo), para que una
+    ejecución corta no quede limitada por la tasa inicial.
+  - Aumento aditivo: cada respuesta sana suma ~RATE_INCREASE req/s por segundo
+    de tráfico, hasta RATE_MAX.
+  - Disminución multiplicativa: un 429/503, o una latencia muy por encima de
+    la habitual para ese endpoint, multiplica la tasa por RATE_DECREASE (como
+    mucho una vez por DECREASE_COOLDOWN, para que una ráfaga de respuestas de
+    requests ya en vuelo no la derrumbe).
+  - Retry-After (o THROTTLE_PAUSE si no viene) pausa el bucket completo:
+    ningún worker envía hasta que vence.
+
+Así los scripts van tan rápido como Metabase lo tolera cuando está tranquilo,
+y frenan solos cuando está ocupado, sin pausas fijas entre requests.
+
+La latencia de referencia es por endpoint (ruta con los IDs normalizados):
+ejecutar una card tarda segundos y listar cards milisegundos, así que cada
+uno se compara con su propio mínimo reciente.
+
+Variables de entorno:
+  METABASE_RATE_LIMIT      Tasa inicial en req/s (default: 10)
+  METABASE_RATE_LIMIT_MIN  Tasa mínima (default: 0.5)
+  METABASE_RATE_LIMIT_MAX  Tasa máxima (default: 50)
+
+Uso:
+  limiter = AdaptiveRateLimiter()
+  limiter.acquire()                        # o: await limiter.acquire_async()
+  start = time.monotonic()
+  r = session.get(url)
+  limiter.record("GET /api/card", r.status_code, time.monotonic() - start,
+                 r.headers.get("Retry-After"))
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import time
+import asyncio
+import threading
+from typing import Optional, Dict
+
+RATE_INITIAL = float(os.getenv("METABASE_RATE_LIMIT", "10"))
+RATE_MIN     = float(os.getenv("METABASE_RATE_LIMIT_MIN", "0.5"))
+RATE_MAX     = float(os.getenv("METABASE_RATE_LIMIT_MAX", "50"))
+BURST        = 5.0    # Tokens acumulables: ráfaga permitida tras un período inactivo
+
+RATE_INCREASE     = 1.0   # req/s sumados por cada segundo de respuestas sanas
+RATE_DECREASE     = 0.5   # Factor ante 429/503
+LATENCY_DECREASE  = 0.8   # Factor ante latencia degradada (señal más suave)
+DECREASE_COOLDOWN = 1.0   # Segundos mínimos entre dos disminuciones
+
+LATENCY_FACTOR = 3.0   # Latencia > FACTOR × referencia del endpoint = congestión
+LATENCY_FLOOR  = 0.5   # Por debajo de esta latencia (s) nunca se considera congestión
+BASELINE_DRIFT = 0.01  # Cuánto sube la referencia hacia latencias mayores por muestra
+
+THROTTLE_STATUSES = (429, 503)
+THROTTLE_PAUSE    = 1.0   # Pausa del bucket ante 429/503 sin Retry-After (segundos)
+ID_RE = re.compile(r"/\d+")
+
+
+def endpoint_key(method: str, path: str) -> str:
+    """Clave de latencia por endpoint: 'POST /api/card/{id}/query'."""
+    return f"{method} {ID_RE.sub('/{id}', path.split('?')[0])}"
+
+
+def parse_retry_after(value) -> Optional[float]:
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None  # Ausente o en formato fecha HTTP: se usa la espera por defecto
+
+
+class AdaptiveRateLimiter:
+    """Token bucket thread-safe con tasa AIMD; sirve a hilos y a corrutinas."""
+
+    def __init__(self, rate: float = RATE_INITIAL, min_rate: float = RATE_MIN,
+                 max_rate: float = RATE_MAX, burst: float = BURST):
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.rate     = min(max(rate, min_rate), self.max_rate)
+        self.burst    = max(burst, 1.0)
+        self._lock    = threading.Lock()
+        self._tokens  = self.burst
+        self._updated = time.monotonic()
+        self._paused_until  = 0.0
+        self._last_decrease = 0.0
+        self._slow_start    = True
+        self._baselines: Dict[str, float] = {}
+        # Contadores expuestos para reportes y métricas
+        self.throttled = 0
+        self.waited    = 0.0
+
+    # ── Token bucket ───────────────────────────────────────────────────────
+
+    def reserve(self) -> float:
+        """Reserva un token y retorna los segundos que hay que esperar antes de usarlo."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1.0
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            wait = max(wait, self._paused_until - now)
+            self.waited += wait
+            return wait
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    # ── AIMD ───────────────────────────────────────────────────────────────
+
+    def record(self, key: str, status: Optional[int], latency: float,
+               retry_after=None) -> None:
+        """Ajusta la tasa según el resultado de un request (status None = error de red)."""
+        with self._lock:
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                pause = parse_retry_after(retry_after)
+                if pause is None:
+                    pause = THROTTLE_PAUSE
+                self._paused_until = max(self._paused_until, now + pause)
+                self._decrease(now, RATE_DECREASE)
+                return
+            if status is None:
+                return
+
+            baseline = self._baselines.get(key)
+            if baseline is None or latency < baseline:
+                self._baselines[key] = latency
+            else:
+                self._baselines[key] = baseline + (latency - baseline) * BASELINE_DRIFT
+            if (baseline is not None and latency > LATENCY_FLOOR
+                    and latency > baseline * LATENCY_FACTOR):
+                self._decrease(now, LATENCY_DECREASE)
+            elif self._slow_start:
+                self.rate = min(self.max_rate, self.rate + 1.0)
+            else:
+                # +RATE_INCREASE por cada `rate` respuestas ≈ +RATE_INCREASE req/s por segundo
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+    def _decrease(self, now: float, factor: float) -> None:
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self._slow_start    = False
+        self.rate = max(self.min_rate, self.rate * factor)
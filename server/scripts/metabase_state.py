@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+metabase_state.py
+───────────────────────────────────────────────────────────────────────────────
+Estado local persistente compartido por los scripts de Metabase.
+
+Guarda en un archivo JSON los IDs ya resueltos (dashboard, base de datos,
+colección) y la metadata de las cards (nombre y updated_at), cada entrada con
+la marca de tiempo en que se registró. setup_metabase_dashboard.py lo escribe
+al terminar y update_metabase_dashboard.py lo consulta en cada ejecución, de
+modo que el cron horario no necesita listar todos los dashboards y bases de
+datos de Metabase salvo que el estado esté vencido o ya no sea válido.
+
+Varios procesos comparten el archivo (setup, el cron, el daemon): cada save()
+toma un flock sobre <archivo>.lock, relee el archivo y lo combina por clave
+con el estado en memoria antes de escribir, así que un proceso de larga vida
+no pisa las entradas que otro escribió después de que él cargara el estado.
+
+Variables de entorno:
+  METABASE_STATE_FILE     Ruta del archivo (default: .metabase_state.json junto al script)
+  METABASE_STATE_MAX_AGE  Segundos antes de re-validar una entrada (default: 86400)
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo el lock entre hilos
+    fcntl = None
+
+STATE_FILE = os.getenv(
+    "METABASE_STATE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".metabase_state.json")
+)
+STATE_MAX_AGE = int(os.getenv("METABASE_STATE_MAX_AGE", "86400"))
+
+
+def _file_mode(path: str, default: int = 0o644) -> int:
+    try:
+        return os.stat(path).st_mode & 0o777
+    except OSError:
+        return default
+
+
+class StateStore:
+    """Almacén clave/valor en JSON con marca de tiempo por entrada y escritura atómica."""
+
+    def __init__(self, path: str = STATE_FILE):
+        self.path  = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, Any]] = self._load()
+        # Claves con valor nuevo (set) en este proceso desde la última lectura del archivo
+        self._changed: set = set()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            # Sin archivo o corrupto: se empieza con estado vacío
+            return {}
+
+    @contextmanager
+    def _file_lock(self):
+        """flock exclusivo sobre <archivo>.lock (entre procesos)."""
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # Cerrar el descriptor libera el flock
+
+    def _merge(self, disk: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Combina por clave el archivo actual con el estado en memoria. Una clave
+        que este proceso no cambió toma el valor del archivo si otro proceso lo
+        cambió (aunque aquí se haya re-validado con touch); si ambos la
+        cambiaron, gana la de stored_at más reciente.
+        """
+        merged = dict(disk)
+        for key, mine in self._data.items():
+            theirs = disk.get(key)
+            if not isinstance(theirs, dict) or "stored_at" not in theirs:
+                merged[key] = mine
+            elif key in self._changed:
+                if mine["stored_at"] >= theirs["stored_at"]:
+                    merged[key] = mine
+            elif theirs.get("value") == mine.get("value"):
+                merged[key] = mine if mine["stored_at"] >= theirs["stored_at"] else theirs
+        return merged
+
+    def save(self) -> None:
+        """
+        Escribe el estado a disco bajo el flock: relee el archivo, lo combina
+        por clave con el estado en memoria (ver _merge) y lo reemplaza con un
+        archivo temporal propio + rename, así que nunca queda a medias ni
+        pierde las entradas que otro proceso (setup, el cron, el daemon)
+        escribió mientras tanto. El estado en memoria queda con lo combinado.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock, self._file_lock():
+            merged = self._merge(self._load())
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metabase_state.",
+                                            suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(merged, f, ensure_ascii=False, indent=2, sort_keys=True)
+                # mkstemp crea el archivo con 0600: conservar los permisos del estado actual
+                os.chmod(tmp_path, _file_mode(self.path))
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+            self._data = merged
+            self._changed.clear()
+
+    # ── Entradas ───────────────────────────────────────────────────────────
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        return entry["value"] if entry else default
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = {"value": value, "stored_at": time.time()}
+            self._changed.add(key)
+
+    def touch(self, key: str) -> None:
+        """Marca una entrada como re-validada sin cambiar su valor."""
+        with self._lock:
+            if key in self._data:
+                self._data[key]["stored_at"] = time.time()
+
+    def age(self, key: str) -> Optional[float]:
+        """Segundos desde que la entrada se registró o re-validó (None si no existe)."""
+        entry = self._data.get(key)
+        return time.time() - entry["stored_at"] if entry else None
+
+    def is_fresh(self, key: str, max_age: float = STATE_MAX_AGE) -> bool:
+        age = self.age(key)
+        return age is not None and age < max_age
+
+    # ── Metadata de cards ──────────────────────────────────────────────────
+
+    def remember_cards(self, cards: List[Dict]) -> None:
+        """Registra id → {name, updated_at} de cards tal como las devuelve la API."""
+        known = dict(self.get("cards", {}))
+        for card in cards:
+            if card and card.get("id"):
+                known[str(card["id"])] = {
+                    "name": card.get("name"),
+                    "updated_at": card.get("updated_at")
+                }
+        self.set("cards", known)
+
+    def card(self, card_id: int) -> Optional[Dict]:
+        return self.get("cards", {}).get(str(card_id))
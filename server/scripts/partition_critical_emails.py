@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""
+partition_critical_emails.py
+───────────────────────────────────────────────────────────────────────────────
+Particionado mensual y retención de critical_email_log.
+
+Todas las cards, el informe semanal y las exportaciones filtran el log por
+rangos de sentAt, pero la tabla crece sin límite y cada consulta recorre (o
+indexa) también los meses que no pide. Con particiones mensuales
+RANGE COLUMNS(sentAt) MySQL descarta las particiones fuera de la ventana
+(partition pruning), así que el costo de las cards depende del período y no
+de cuántos meses de historia se acumularon. La retención se vuelve un
+DROP PARTITION instantáneo en lugar de un DELETE masivo.
+
+Particiones: p_start (filas anteriores al primer mes, normalmente vacía),
+una pYYYY_MM por mes y p_future (MAXVALUE) para lo que llegue más allá de
+las particiones creadas. En cada ejecución de mantenimiento el script:
+  1. Crea por adelantado las particiones de los próximos --months-ahead meses
+     (REORGANIZE PARTITION p_future, casi instantáneo si p_future está vacía)
+  2. Con --retention-months, elimina en un único ALTER TABLE los meses que
+     quedaron fuera de la ventana; con --archive antes los mueve a tablas
+     critical_email_log_archive_pYYYY_MM con EXCHANGE PARTITION (solo
+     metadata, sin copiar filas)
+
+--init convierte la tabla la primera vez. MySQL exige que toda clave única,
+incluida la PK, contenga la columna de particionado: si la PK es (id), pasa a
+ser (id, sentAt) en el mismo ALTER TABLE. Las tablas particionadas no admiten
+claves foráneas; si existen, el script se detiene sin modificar nada.
+
+--check ejecuta EXPLAIN sobre el SQL de cada card y verifica que solo lea las
+particiones de su ventana de {{periodo_dias}}.
+
+Uso:
+  pip install pymysql
+  python partition_critical_emails.py --init --dry-run         # Ver el ALTER TABLE
+  python partition_critical_emails.py --init                   # Convertir la tabla (una vez)
+  python partition_critical_emails.py                          # Mantenimiento (cron diario)
+  python partition_critical_emails.py --retention-months 12 --archive
+  python partition_critical_emails.py --check --periods 7,30,90
+
+Variables de entorno: ver metabase_mysql.py (DB_* y DB_WRITE_*).
+  CRITICAL_EMAIL_PARTITION_AHEAD    Meses futuros con partición propia (default: 3)
+  CRITICAL_EMAIL_RETENTION_MONTHS   Meses completos que se conservan además del
+                                    actual (default: 0 = conservar todo)
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+from datetime import date, datetime
+from typing import List, Dict, Optional
+
+# ── Carga de variables de entorno ──────────────────────────────────────────
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # python-dotenv opcional; se pueden pasar las vars directamente
+
+from metabase_mysql import connect, render_native_query
+from setup_metabase_dashboard import CARD_SOURCE, PERIOD_FILTER, get_cards_definition
+
+# ── Configuración ──────────────────────────────────────────────────────────
+LOG_TABLE        = "critical_email_log"
+PARTITION_COLUMN = "sentAt"
+ARCHIVE_PREFIX   = "critical_email_log_archive"
+LOCK_NAME        = "imaginecrm_critical_email_partitions"
+MONTHS_AHEAD     = int(os.getenv("CRITICAL_EMAIL_PARTITION_AHEAD", "3"))
+RETENTION_MONTHS = int(os.getenv("CRITICAL_EMAIL_RETENTION_MONTHS", "0"))
+
+FIRST_PARTITION = "p_start"
+LAST_PARTITION  = "p_future"
+MONTH_PARTITION_RE = re.compile(r"^p(\d{4})_(\d{2})$")
+
+# RANGE COLUMNS no admite TIMESTAMP: en ese caso se particiona por UNIX_TIMESTAMP()
+COLUMNS_TYPES   = ("date", "datetime")
+TIMESTAMP_TYPES = ("timestamp",)
+
+# ── Logging ────────────────────────────────────────────────────────────────
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+log = logging.getLogger("metabase_partitions")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MESES Y DEFINICIONES DE PARTICIONES
+# ══════════════════════════════════════════════════════════════════════════════
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"p{month.year}_{month.month:02d}"
+
+
+def partition_month(name: str) -> Optional[date]:
+    """Mes de una partición pYYYY_MM (None para p_start, p_future u otras)."""
+    match = MONTH_PARTITION_RE.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def partition_by(data_type: str) -> str:
+    if data_type in TIMESTAMP_TYPES:
+        return f"RANGE (UNIX_TIMESTAMP({PARTITION_COLUMN}))"
+    return f"RANGE COLUMNS({PARTITION_COLUMN})"
+
+
+def less_than(month: date, data_type: str) -> str:
+    """Límite superior (exclusivo) de la partición anterior a `month`."""
+    if data_type in TIMESTAMP_TYPES:
+        return f"UNIX_TIMESTAMP('{month.isoformat()} 00:00:00')"
+    return f"'{month.isoformat()}'"
+
+
+def month_definitions(months: List[date], data_type: str) -> List[str]:
+    return [f"PARTITION {partition_name(m)} VALUES LESS THAN "
+            f"({less_than(add_months(m, 1), data_type)})" for m in months]
+
+
+def month_range(first: date, last: date) -> List[date]:
+    months = []
+    while first <= last:
+        months.append(first)
+        first = add_months(first, 1)
+    return months
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ESTADO DE LA TABLA
+# ══════════════════════════════════════════════════════════════════════════════
+
+def list_partitions(cur) -> List[str]:
+    """Particiones de la tabla en orden (vacía si la tabla no está particionada)."""
+    cur.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION",
+        (LOG_TABLE,)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def current_month(cur) -> date:
+    cur.execute("SELECT CURDATE()")
+    today = cur.fetchone()[0]
+    return date(today.year, today.month, 1)
+
+
+def partition_column_type(cur) -> str:
+    cur.execute(
+        "SELECT DATA_TYPE FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (LOG_TABLE, PARTITION_COLUMN)
+    )
+    row = cur.fetchone()
+    if not row:
+        raise RuntimeError(f"{LOG_TABLE}.{PARTITION_COLUMN} no existe")
+    return row[0].lower()
+
+
+def unique_keys(cur) -> Dict[str, List[str]]:
+    """Claves únicas de la tabla (incluida PRIMARY) → columnas en orden."""
+    cur.execute(
+        "SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 0 "
+        "ORDER BY INDEX_NAME, SEQ_IN_INDEX",
+        (LOG_TABLE,)
+    )
+    keys: Dict[str, List[str]] = {}
+    for index_name, column in cur.fetchall():
+        keys.setdefault(index_name, []).append(column)
+    return keys
+
+
+def foreign_keys(cur) -> List[str]:
+    cur.execute(
+        "SELECT DISTINCT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE "
+        "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL "
+        "AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)",
+        (LOG_TABLE, LOG_TABLE)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def execute_ddl(cur, statement: str, dry_run: bool) -> None:
+    log.info(f"  {' '.join(statement.split())}")
+    if not dry_run:
+        cur.execute(statement)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# CONVERSIÓN INICIAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def init_partitioning(conn, months_ahead: int = MONTHS_AHEAD, dry_run: bool = False) -> bool:
+    """
+    Convierte critical_email_log a particiones mensuales desde el mes de su
+    fila más antigua hasta months_ahead meses en el futuro. Retorna False si
+    la tabla ya estaba particionada.
+    """
+    with conn.cursor() as cur:
+        if list_partitions(cur):
+            log.info(f"{LOG_TABLE} ya está particionada; se omite la conversión")
+            return False
+
+        data_type = partition_column_type(cur)
+        if data_type not in COLUMNS_TYPES + TIMESTAMP_TYPES:
+            raise RuntimeError(f"{PARTITION_COLUMN} es {data_type}: se necesita DATE, DATETIME o TIMESTAMP")
+        fks = foreign_keys(cur)
+        if fks:
+            raise RuntimeError("las tablas particionadas no admiten claves foráneas; "
+                               f"eliminar antes: {', '.join(fks)}")
+
+        keys = unique_keys(cur)
+        blocking = [name for name, cols in keys.items()
+                    if name != "PRIMARY" and PARTITION_COLUMN not in cols]
+        if blocking:
+            raise RuntimeError(f"las claves únicas {', '.join(blocking)} no incluyen "
+                               f"{PARTITION_COLUMN}; agregarla o convertirlas en índices normales")
+        alter = ""
+        primary = keys.get("PRIMARY", [])
+        if primary and PARTITION_COLUMN not in primary:
+            # Toda clave única debe contener la columna de particionado
+            columns = ", ".join(f"`{c}`" for c in primary + [PARTITION_COLUMN])
+            alter = f"DROP PRIMARY KEY, ADD PRIMARY KEY ({columns})\n"
+            log.info(f"La PK ({', '.join(primary)}) pasa a ({', '.join(primary)}, {PARTITION_COLUMN})")
+
+        cur.execute(f"SELECT MIN({PARTITION_COLUMN}) FROM {LOG_TABLE}")
+        oldest = cur.fetchone()[0]
+        now = current_month(cur)
+        first = date(oldest.year, oldest.month, 1) if oldest else now
+        months = month_range(first, add_months(now, months_ahead))
+
+        definitions = ([f"PARTITION {FIRST_PARTITION} VALUES LESS THAN ({less_than(first, data_type)})"]
+                       + month_definitions(months, data_type)
+                       + [f"PARTITION {LAST_PARTITION} VALUES LESS THAN MAXVALUE"])
+        statement = (f"ALTER TABLE {LOG_TABLE}\n{alter}"
+                     f"PARTITION BY {partition_by(data_type)} (\n    "
+                     + ",\n    ".join(definitions) + "\n)")
+        log.info(f"Particionando {LOG_TABLE}: {len(months)} meses "
+                 f"({partition_name(months[0])} a {partition_name(months[-1])}). "
+                 f"El ALTER TABLE copia la tabla completa y puede tardar")
+        execute_ddl(cur, statement, dry_run)
+    return True
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MANTENIMIENTO: PARTICIONES FUTURAS Y RETENCIÓN
+# ══════════════════════════════════════════════════════════════════════════════
+
+def ensure_future_partitions(conn, months_ahead: int = MONTHS_AHEAD,
+                             dry_run: bool = False) -> List[str]:
+    """Crea las particiones que falten hasta months_ahead meses en el futuro."""
+    with conn.cursor() as cur:
+        partitions = list_partitions(cur)
+        months = [m for m in map(partition_month, partitions) if m]
+        now = current_month(cur)
+        start = add_months(max(months), 1) if months else now
+        missing = month_range(start, add_months(now, months_ahead))
+        if not missing:
+            return []
+        definitions = month_definitions(missing, partition_column_type(cur))
+        if LAST_PARTITION in partitions:
+            # Partir p_future: solo mueve las filas que ya tenga (normalmente ninguna)
+            statement = (f"ALTER TABLE {LOG_TABLE} REORGANIZE PARTITION {LAST_PARTITION} INTO (\n    "
+                         + ",\n    ".join(definitions
+                                          + [f"PARTITION {LAST_PARTITION} VALUES LESS THAN MAXVALUE"])
+                         + "\n)")
+        else:
+            statement = (f"ALTER TABLE {LOG_TABLE} ADD PARTITION (\n    "
+                         + ",\n    ".join(definitions) + "\n)")
+        execute_ddl(cur, statement, dry_run)
+    return [partition_name(m) for m in missing]
+
+
+def _has_rows(cur, table: str, partition: Optional[str] = None) -> bool:
+    selector = f" PARTITION ({partition})" if partition else ""
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table}{selector} LIMIT 1)")
+    return bool(cur.fetchone()[0])
+
+
+def archive_partition(cur, partition: str, dry_run: bool = False) -> str:
+    """
+    Mueve las filas de una partición a critical_email_log_archive_pYYYY_MM con
+    EXCHANGE PARTITION (intercambio de archivos, sin copiar filas). Si una
+    ejecución anterior ya hizo el intercambio, no lo repite.
+    """
+    archive = f"{ARCHIVE_PREFIX}_{partition}"
+    cur.execute(
+        "SELECT COUNT(*) FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (archive,)
+    )
+    exists = cur.fetchone()[0] > 0
+    if exists and not dry_run and _has_rows(cur, archive):
+        if _has_rows(cur, LOG_TABLE, partition):
+            raise RuntimeError(f"{archive} y la partición {partition} tienen filas; revisar a mano")
+        log.info(f"  {partition}: ya archivada en {archive}")
+        return archive
+    if not exists:
+        execute_ddl(cur, f"CREATE TABLE {archive} LIKE {LOG_TABLE}", dry_run)
+        execute_ddl(cur, f"ALTER TABLE {archive} REMOVE PARTITIONING", dry_run)
+    execute_ddl(cur, f"ALTER TABLE {LOG_TABLE} EXCHANGE PARTITION {partition} "
+                     f"WITH TABLE {archive} WITHOUT VALIDATION", dry_run)
+    return archive
+
+
+def expire_partitions(conn, retention_months: int, archive: bool = False,
+                      dry_run: bool = False) -> List[str]:
+    """
+    Elimina las particiones mensuales anteriores a la ventana de retención
+    (los últimos retention_months meses completos más el actual), todas en un
+    único DROP PARTITION. Con archive=True antes las mueve a tablas de archivo.
+    """
+    with conn.cursor() as cur:
+        cutoff = add_months(current_month(cur), -retention_months)
+        expired = [p for p in list_partitions(cur)
+                   if partition_month(p) and partition_month(p) < cutoff]
+        if not expired:
+            return []
+        log.info(f"Retención de {retention_months} meses: {len(expired)} particiones "
+                 f"anteriores a {cutoff.isoformat()} ({', '.join(expired)})")
+        if archive:
+            for partition in expired:
+                archive_partition(cur, partition, dry_run)
+        execute_ddl(cur, f"ALTER TABLE {LOG_TABLE} DROP PARTITION {', '.join(expired)}", dry_run)
+    return expired
+
+
+def acquire_lock(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+        return cur.fetchone()[0] == 1
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# VERIFICACIÓN DE PODA (EXPLAIN)
+# ══════════════════════════════════════════════════════════════════════════════
+
+def expected_partitions(partitions: List[str], window_start: datetime) -> set:
+    """Particiones que se solapan con [window_start, ∞); p_start se tolera (vacía)."""
+    expected = {FIRST_PARTITION, LAST_PARTITION}
+    for name in partitions:
+        month = partition_month(name)
+        if month and datetime.combine(add_months(month, 1), datetime.min.time()) > window_start:
+            expected.add(name)
+    return expected & set(partitions)
+
+
+def check_pruning(conn, cards: List[Dict], periods: List[int]) -> List[Dict]:
+    """
+    Ejecuta EXPLAIN sobre el SQL de cada card y período y compara las
+    particiones de critical_email_log que lee con las de su ventana.
+    Estado por entrada: "ok", "no_pruning", "skipped" (no lee la tabla
+    particionada o solo se puede ejecutar en Metabase) o "error".
+    """
+    entries = []
+    with conn.cursor() as cur:
+        partitions = list_partitions(cur)
+        if not partitions:
+            raise RuntimeError(f"{LOG_TABLE} no está particionada; ejecutar antes con --init")
+        for periodo in periods:
+            cur.execute("SELECT DATE_SUB(NOW(), INTERVAL %s DAY)", (periodo,))
+            expected = expected_partitions(partitions, cur.fetchone()[0])
+            for card in cards:
+                entry = {"name": card["name"], "periodo_dias": periodo, "status": "error"}
+                entries.append(entry)
+                try:
+                    sql, args = render_native_query(card["sql"], {"periodo_dias": periodo})
+                    cur.execute(f"EXPLAIN {sql}", args)
+                    columns = [c[0].lower() for c in cur.description]
+                    rows = cur.fetchall()
+                except ValueError as e:
+                    entry["status"], entry["error"] = "skipped", str(e)
+                    continue
+                except Exception as e:
+                    entry["error"] = str(e)[:200]
+                    log.warning(f"  {card['name'][:50]} ({periodo}d): error en EXPLAIN: {entry['error']}")
+                    continue
+
+                # Solo las filas de tablas particionadas traen la columna partitions
+                scanned = set()
+                for row in rows:
+                    value = dict(zip(columns, row)).get("partitions")
+                    if value:
+                        scanned.update(value.split(","))
+                if not scanned:
+                    entry["status"] = "skipped"
+                    continue
+                extra = scanned - expected
+                entry.update({"scanned": len(scanned), "expected": len(expected),
+                              "status": "no_pruning" if extra else "ok"})
+                if extra:
+                    log.warning(f"  {card['name'][:50]} ({periodo}d): lee {len(scanned)}/"
+                                f"{len(partitions)} particiones, fuera de la ventana: "
+                                f"{', '.join(sorted(extra))}")
+                else:
+                    log.info(f"  {card['name'][:50]} ({periodo}d): {len(scanned)}/"
+                             f"{len(partitions)} particiones")
+    return entries
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FUNCIÓN PRINCIPAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def run_check(args) -> None:
+    try:
+        conn = connect()
+    except Exception as e:
+        log.error(f"No se pudo conectar a MySQL: {e}")
+        sys.exit(1)
+    try:
+        entries = check_pruning(conn, get_cards_definition(args.source), args.periods)
+    except Exception as e:
+        log.error(f"Error durante la verificación: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    counts = {status: sum(1 for e in entries if e["status"] == status)
+              for status in ("ok", "no_pruning", "skipped", "error")}
+    log.info("=" * 60)
+    log.info(f"Poda de particiones: {counts['ok']} correctas, {counts['no_pruning']} sin poda, "
+             f"{counts['skipped']} omitidas, {counts['error']} con errores")
+    log.info("=" * 60)
+    sys.exit(2 if counts["no_pruning"] or counts["error"] else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Particionado mensual y retención de {LOG_TABLE}"
+    )
+    parser.add_argument("--init", action="store_true",
+                        help="Convertir la tabla a particiones mensuales (una sola vez)")
+    parser.add_argument("--months-ahead", type=int, default=MONTHS_AHEAD,
+                        help=f"Meses futuros con partición propia (default: {MONTHS_AHEAD})")
+    parser.add_argument("--retention-months", type=int, default=RETENTION_MONTHS,
+                        help="Meses completos que se conservan además del actual "
+                             f"(default: {RETENTION_MONTHS}; 0 = conservar todo)")
+    parser.add_argument("--archive", action="store_true",
+                        help=f"Mover las particiones vencidas a {ARCHIVE_PREFIX}_pYYYY_MM "
+                             "en lugar de eliminarlas")
+    parser.add_argument("--check", action="store_true",
+                        help="Verificar con EXPLAIN que las cards solo lean su ventana")
+    parser.add_argument("--periods", type=parse_int_list, default=[int(PERIOD_FILTER["default"])],
+                        help=f"--check: períodos en días, separados por coma "
+                             f"(default: {PERIOD_FILTER['default']})")
+    parser.add_argument("--source", choices=("raw", "rollup"), default=CARD_SOURCE,
+                        help=f"--check: variante del SQL de las cards (default: {CARD_SOURCE})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Mostrar las sentencias DDL sin ejecutarlas")
+    args = parser.parse_args()
+
+    log.info("=" * 60)
+    log.info(f"ImagineCRM — Particiones de {LOG_TABLE}")
+    log.info("=" * 60)
+    start = time.time()
+
+    if args.check:
+        run_check(args)
+    if args.retention_months < 0 or args.months_ahead < 0:
+        log.error("--retention-months y --months-ahead no pueden ser negativos")
+        sys.exit(1)
+
+    try:
+        conn = connect(write=True)
+    except Exception as e:
+        log.error(f"No se pudo conectar a MySQL: {e}")
+        sys.exit(1)
+
+    try:
+        if not acquire_lock(conn):
+            log.warning("Otra ejecución del mantenimiento de particiones está en curso. Saliendo.")
+            sys.exit(0)
+        if args.init and init_partitioning(conn, args.months_ahead, args.dry_run) and args.dry_run:
+            sys.exit(0)  # La tabla sigue sin particionar: no hay mantenimiento que simular
+        with conn.cursor() as cur:
+            if not list_partitions(cur):
+                log.error(f"{LOG_TABLE} no está particionada; ejecutar antes con --init")
+                sys.exit(1)
+        created = ensure_future_partitions(conn, args.months_ahead, args.dry_run)
+        expired = []
+        if args.retention_months:
+            expired = expire_partitions(conn, args.retention_months, args.archive, args.dry_run)
+    except Exception as e:
+        log.error(f"Error durante el mantenimiento de particiones: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    action = "archivadas y eliminadas" if args.archive else "eliminadas"
+    log.info("=" * 60)
+    log.info(f"Particiones creadas: {len(created)}{' (' + ', '.join(created) + ')' if created else ''}")
+    log.info(f"Particiones {action}: {len(expired)}"
+             f"{' (sin ejecutar: --dry-run)' if args.dry_run and (created or expired) else ''}")
+    log.info(f"Tiempo total: {time.time() - start:.1f}s")
+    log.info("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+rollup_critical_emails.py
+───────────────────────────────────────────────────────────────────────────────
+Mantiene la tabla agregada critical_email_daily a partir de critical_email_log,
+para que las cards del dashboard (y el informe semanal) lean unos cientos de
+filas por día en lugar de recorrer todo el log del período.
+
+critical_email_daily tiene una fila por (day, tenantId, emailType, success)
+con la cantidad de emails. En cada ejecución el script:
+  1. Lee la marca de agua (último id procesado) de critical_email_rollup_state
+  2. Busca los días que recibieron filas nuevas desde esa marca (rango por PK)
+  3. Recalcula completos solo esos días (más hoy y los últimos --lookback-days)
+  4. Avanza la marca de agua
+
+Recalcular el día completo (DELETE + INSERT ... SELECT por rango de sentAt)
+hace que el proceso sea idempotente: si falla a mitad, la próxima ejecución
+vuelve a calcular los mismos días. Un lock con nombre (GET_LOCK) evita que
+dos ejecuciones se pisen.
+
+Uso:
+  pip install pymysql
+  python rollup_critical_emails.py                  # Incremental (cron cada 15 min)
+  python rollup_critical_emails.py --days 30        # Recalcular además los últimos 30 días
+  python rollup_critical_emails.py --full           # Reconstruir toda la tabla
+
+Variables de entorno: ver metabase_mysql.py (DB_* y DB_WRITE_*).
+
+Autor: ImagineCRM Automation
+"""
+
+import sys
+import time
+import logging
+import argparse
+from datetime import date, timedelta
+from typing import Set
+
+# ── Carga de variables de entorno ──────────────────────────────────────────
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # python-dotenv opcional; se pueden pasar las vars directamente
+
+from metabase_mysql import connect
+
+# ── Configuración ──────────────────────────────────────────────────────────
+ROLLUP_TABLE = "critical_email_daily"
+STATE_TABLE  = "critical_email_rollup_state"
+LOCK_NAME    = "imaginecrm_critical_email_rollup"
+# Filas con id menor a la marca que se confirman tarde (transacciones largas)
+# quedan cubiertas recalculando siempre los días más recientes
+LOOKBACK_DAYS = 1
+
+DDL = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        day        DATE         NOT NULL,
+        tenantId   INT          NOT NULL,
+        emailType  VARCHAR(64)  NOT NULL,
+        success    TINYINT(1)   NOT NULL,
+        cantidad   INT UNSIGNED NOT NULL,
+        updatedAt  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (day, tenantId, emailType, success),
+        KEY idx_critical_email_daily_tenant (tenantId, day)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+        name       VARCHAR(64) NOT NULL PRIMARY KEY,
+        lastId     BIGINT      NOT NULL DEFAULT 0,
+        updatedAt  TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+# ── Logging ────────────────────────────────────────────────────────────────
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+log = logging.getLogger("metabase_rollup")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ROLLUP
+# ══════════════════════════════════════════════════════════════════════════════
+
+def ensure_tables(cur) -> None:
+    for statement in DDL:
+        cur.execute(statement)
+
+
+def read_watermark(cur) -> int:
+    cur.execute(f"SELECT lastId FROM {STATE_TABLE} WHERE name = %s", (ROLLUP_TABLE,))
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def write_watermark(cur, last_id: int) -> None:
+    cur.execute(
+        f"INSERT INTO {STATE_TABLE} (name, lastId) VALUES (%s, %s) "
+        f"ON DUPLICATE KEY UPDATE lastId = VALUES(lastId)",
+        (ROLLUP_TABLE, last_id)
+    )
+
+
+def days_with_new_rows(cur, last_id: int, max_id: int) -> Set[date]:
+    """Días que recibieron filas con id en (last_id, max_id] (rango sobre la PK)."""
+    if max_id <= last_id:
+        return set()
+    cur.execute(
+        "SELECT DISTINCT DATE(sentAt) FROM critical_email_log WHERE id > %s AND id <= %s",
+        (last_id, max_id)
+    )
+    return {row[0] for row in cur.fetchall() if row[0] is not None}
+
+
+def all_days(cur) -> Set[date]:
+    cur.execute("SELECT MIN(DATE(sentAt)), MAX(DATE(sentAt)) FROM critical_email_log")
+    first, last = cur.fetchone()
+    if first is None:
+        return set()
+    return {first + timedelta(days=i) for i in range((last - first).days + 1)}
+
+
+def rebuild_day(conn, day: date) -> int:
+    """Recalcula las filas agregadas de un día en una transacción. Retorna las filas escritas."""
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE day = %s", (day,))
+        cur.execute(
+            f"""
+            INSERT INTO {ROLLUP_TABLE} (day, tenantId, emailType, success, cantidad)
+            SELECT DATE(sentAt), tenantId, emailType, success, COUNT(*)
+            FROM critical_email_log
+            WHERE sentAt >= %s AND sentAt < %s
+            GROUP BY DATE(sentAt), tenantId, emailType, success
+            """,
+            (day, day + timedelta(days=1))
+        )
+        written = cur.rowcount
+    conn.commit()
+    return written
+
+
+def run_rollup(conn, full: bool = False, extra_days: int = 0,
+               lookback_days: int = LOOKBACK_DAYS) -> dict:
+    """Actualiza critical_email_daily y retorna un resumen de la ejecución."""
+    results = {"days": 0, "rows": 0, "from_id": 0, "to_id": 0}
+    with conn.cursor() as cur:
+        ensure_tables(cur)
+        conn.commit()
+        last_id = read_watermark(cur)
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM critical_email_log")
+        max_id = int(cur.fetchone()[0])
+        results["from_id"], results["to_id"] = last_id, max_id
+
+        if full:
+            days = all_days(cur)
+        else:
+            days = days_with_new_rows(cur, last_id, max_id)
+            cur.execute("SELECT CURDATE()")
+            today = cur.fetchone()[0]
+            # Siempre se recalculan los días recientes (hoy + lookback + --days)
+            days.update(today - timedelta(days=i)
+                        for i in range(max(lookback_days, extra_days) + 1))
+
+    for day in sorted(days):
+        written = rebuild_day(conn, day)
+        results["days"] += 1
+        results["rows"] += written
+        log.info(f"  {day}: {written} filas agregadas")
+
+    with conn.cursor() as cur:
+        write_watermark(cur, max_id)
+    conn.commit()
+    return results
+
+
+def acquire_lock(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+        return cur.fetchone()[0] == 1
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FUNCIÓN PRINCIPAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Mantiene la tabla agregada {ROLLUP_TABLE} a partir de critical_email_log"
+    )
+    parser.add_argument("--full", action="store_true",
+                        help="Reconstruir todos los días presentes en critical_email_log")
+    parser.add_argument("--days", type=int, default=0,
+                        help="Recalcular además los últimos N días")
+    parser.add_argument("--lookback-days", type=int, default=LOOKBACK_DAYS,
+                        help=f"Días recientes que se recalculan siempre (default: {LOOKBACK_DAYS})")
+    args = parser.parse_args()
+
+    log.info("=" * 60)
+    log.info(f"ImagineCRM — Rollup diario de emails críticos ({ROLLUP_TABLE})")
+    log.info("=" * 60)
+    start = time.time()
+
+    try:
+        conn = connect(write=True, autocommit=False)
+    except Exception as e:
+        log.error(f"No se pudo conectar a MySQL: {e}")
+        sys.exit(1)
+
+    try:
+        if not acquire_lock(conn):
+            log.warning("Otra ejecución del rollup está en curso. Saliendo.")
+            sys.exit(0)
+        mode = "completo" if args.full else "incremental"
+        log.info(f"Modo {mode}...")
+        results = run_rollup(conn, full=args.full, extra_days=args.days,
+                             lookback_days=args.lookback_days)
+    except Exception as e:
+        conn.rollback()
+        log.error(f"Error durante el rollup: {e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+    log.info("=" * 60)
+    log.info(f"Días recalculados: {results['days']} ({results['rows']} filas agregadas)")
+    log.info(f"Marca de agua: id {results['from_id']} → {results['to_id']}")
+    log.info(f"Tiempo total: {time.time() - start:.1f}s")
+    log.info("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,10 +13,20 @@ Qué hace este script:
   5. Agrega el filtro de período interactivo
   6. Imprime la URL del dashboard creado
 
+Modo --reconcile:
+  Compara get_cards_definition() con las cards existentes en la colección
+  mediante un hash del SQL, el tipo de visualización y sus settings. Solo
+  crea las cards que faltan, actualiza las que cambiaron y reutiliza el
+  dashboard existente, de modo que re-ejecutar el script no duplica nada.
+
 Uso:
   pip install requests python-dotenv
   cp .env.example .env          # Editar con tus credenciales
   python setup_metabase_dashboard.py
+  python setup_metabase_dashboard.py --reconcile   # Re-ejecución idempotente
+  python setup_metabase_dashboard.py --reconcile --source rollup   # Cards sobre el rollup diario
+  python setup_metabase_dashboard.py --analyze     # Solo EXPLAIN de las cards e índices sugeridos
+  python setup_metabase_dashboard.py --tenants     # Un dashboard embebible por tenant enterprise
 
 Variables de entorno requeridas (ver .env.example):
   METABASE_URL          URL base de tu instancia (ej: https://metabase.tuempresa.com)
@@ -35,12 +45,24 @@ Autor: ImagineCRM Automation
 """
 
 import os
+import re
 import sys
 import json
 import time
+import hashlib
+import argparse
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from typing import Optional
 
+from metabase_api import BASE_MODEL_SLUG, SyncPoller, build_card_payload
+from metabase_cache import ResponseCache, cache_key
+from metabase_codec import ACCEPT_ENCODING, decode_json, encode_body
+from metabase_ratelimit import AdaptiveRateLimiter, THROTTLE_STATUSES, endpoint_key
+from metabase_state import StateStore
+
 # ── Carga de variables de entorno ──────────────────────────────────────────
 try:
     from dotenv import load_dotenv
@@ -60,10 +82,22 @@ DB_NAME     = os.getenv("DB_NAME", "imaginecrm")
 DB_USER     = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 
+SYNC_WAIT_TIMEOUT = int(os.getenv("METABASE_SYNC_TIMEOUT", "600"))
+MAX_RETRIES       = 3  # Reintentos ante 429/503 (respetando Retry-After)
+# Origen de las cards agregadas: "raw" (critical_email_log) o "rollup" (critical_email_daily)
+CARD_SOURCE = os.getenv("METABASE_CARD_SOURCE", "raw")
+# Cards 1-3 sobre un modelo base compartido (con caché de modelos)
+USE_BASE_MODEL = os.getenv("METABASE_USE_MODEL", "").lower() in ("1", "true", "yes")
+
 DASHBOARD_NAME    = "Emails Críticos — ImagineCRM"
 COLLECTION_NAME   = "ImagineCRM"
 DB_DISPLAY_NAME   = "ImagineCRM Producción"
 
+# Aprovisionamiento por tenant (--tenants)
+TENANT_COLLECTION_NAME = "ImagineCRM — Tenants"
+TENANT_BATCH_SIZE      = int(os.getenv("METABASE_TENANT_BATCH_SIZE", "100"))
+TENANT_CONCURRENCY     = int(os.getenv("METABASE_TENANT_CONCURRENCY", "8"))
+
 # ── Colores de consola ─────────────────────────────────────────────────────
 GREEN  = "\033[92m"
 YELLOW = "\033[93m"
@@ -86,10 +120,23 @@ def step(msg):  print(f"\n{BOLD}{msg}{RESET}")
 class MetabaseClient:
     """Cliente HTTP para la API REST de Metabase."""
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, pool_size: int = 1):
         self.base_url = base_url
         self.session  = requests.Session()
-        self.session.headers.update({"Content-Type": "application/json"})
+        # Pool keep-alive dimensionado para el aprovisionamiento concurrente (--tenants)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json",
+                                     "Accept-Encoding": ACCEPT_ENCODING})
+        # Limitador de tasa adaptativo compartido por todos los hilos del cliente
+        self.limiter     = AdaptiveRateLimiter()
+        # Respuestas GET de metadata (colecciones, BD, dashboards) durante la ejecución
+        self.cache       = ResponseCache(path="")
+        # Contadores para reportar throughput y respuestas 429/503
+        self._stats_lock = threading.Lock()
+        self.requests    = 0
+        self.throttled   = 0
 
     # ── Autenticación ──────────────────────────────────────────────────────
 
@@ -99,7 +146,7 @@ class MetabaseClient:
         # Verificar que la key funciona
         r = self.session.get(f"{self.base_url}/api/user/current")
         if r.status_code == 200:
-            user = r.json()
+            user = decode_json(r)
             ok(f"Autenticado como: {user.get('email')} (API Key)")
             return True
         err(f"API Key inválida o sin permisos. Status: {r.status_code}")
@@ -112,7 +159,7 @@ class MetabaseClient:
             json={"username": email, "password": password}
         )
         if r.status_code == 200:
-            token = r.json().get("id")
+            token = decode_json(r).get("id")
             self.session.headers["X-Metabase-Session"] = token
             ok(f"Autenticado como: {email} (session token)")
             return True
@@ -121,14 +168,53 @@ class MetabaseClient:
 
     # ── Helpers HTTP ───────────────────────────────────────────────────────
 
-    def get(self, path: str, **kwargs) -> requests.Response:
-        return self.session.get(f"{self.base_url}{path}", **kwargs)
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Envía el request al ritmo del limitador adaptativo; ante un 429/503 el
+        limitador reduce la tasa y pausa según Retry-After, y se reintenta.
+        """
+        key = endpoint_key(method, path)
+        for attempt in range(1, MAX_RETRIES + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            r = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            self.limiter.record(key, r.status_code, time.monotonic() - start,
+                                r.headers.get("Retry-After"))
+            with self._stats_lock:
+                self.requests += 1
+                if r.status_code in THROTTLE_STATUSES:
+                    self.throttled += 1
+            if r.status_code not in THROTTLE_STATUSES or attempt == MAX_RETRIES:
+                return r
+        return r
+
+    def get(self, path: str, cache: bool = True, **kwargs) -> requests.Response:
+        """GET a través del caché de respuestas (cache=False para lecturas que se sondean)."""
+        if not cache:
+            return self._send("GET", path, **kwargs)
+        r, _ = self.cache.fetch(
+            cache_key(path, kwargs.get("params")),
+            lambda headers: self._send("GET", path, headers=headers or None, **kwargs)
+        )
+        return r
 
     def post(self, path: str, data: dict = None, **kwargs) -> requests.Response:
-        return self.session.post(f"{self.base_url}{path}", json=data, **kwargs)
+        r = self._send("POST", path, **self._json_body(data), **kwargs)
+        self.cache.invalidate_for("POST", path)
+        return r
 
     def put(self, path: str, data: dict = None, **kwargs) -> requests.Response:
-        return self.session.put(f"{self.base_url}{path}", json=data, **kwargs)
+        r = self._send("PUT", path, **self._json_body(data), **kwargs)
+        self.cache.invalidate_for("PUT", path)
+        return r
+
+    @staticmethod
+    def _json_body(data: Optional[dict]) -> dict:
+        """Cuerpo JSON serializado con el codec (y gzip si está activado)."""
+        if data is None:
+            return {}
+        body, headers = encode_body(data)
+        return {"data": body, "headers": headers}
 
     # ── Base de datos ──────────────────────────────────────────────────────
 
@@ -137,7 +223,9 @@ class MetabaseClient:
         r = self.get("/api/database")
         if r.status_code != 200:
             return None
-        dbs = r.json().get("data", r.json()) if isinstance(r.json(), dict) else r.json()
+        dbs = decode_json(r)
+        if isinstance(dbs, dict):
+            dbs = dbs.get("data", dbs)
         for db in dbs:
             if db.get("name") == name:
                 return db
@@ -164,14 +252,35 @@ class MetabaseClient:
         }
         r = self.post("/api/database", payload)
         if r.status_code in (200, 201):
-            db_id = r.json()["id"]
+            db_id = decode_json(r)["id"]
             ok(f"Base de datos creada con ID: {db_id}")
             # Esperar a que Metabase sincronice el esquema
-            info("Esperando sincronización del esquema (15s)...")
-            time.sleep(15)
+            info("Esperando sincronización del esquema...")
+            self.wait_for_sync(db_id)
             return db_id
         raise RuntimeError(f"Error al crear la base de datos: {r.status_code} — {r.text[:300]}")
 
+    def wait_for_sync(self, db_id: int, timeout: float = SYNC_WAIT_TIMEOUT) -> bool:
+        """
+        Espera a que termine la sincronización inicial consultando
+        /api/database/{id}?include=tables con el criterio y el backoff de
+        SyncPoller (metabase_api.py).
+        """
+        poller = SyncPoller(timeout)
+        while True:
+            r = self.get(f"/api/database/{db_id}", cache=False, params={"include": "tables"})
+            db = decode_json(r) if r.status_code == 200 else None
+            result = poller.observe(db)
+            if result:
+                ok(f"Esquema sincronizado ({poller.total} tablas, {poller.elapsed}s)")
+                return True
+            if db:
+                info(f"Sincronización en curso: {poller.done}/{poller.total} tablas ({poller.elapsed}s)")
+            if result is False:
+                warn(f"La sincronización no terminó en {timeout}s; se continúa igualmente.")
+                return False
+            time.sleep(poller.next_delay())
+
     def get_or_create_database(self) -> int:
         """Obtiene la BD existente o la crea si no existe."""
         existing = self.find_database(DB_DISPLAY_NAME)
@@ -184,19 +293,24 @@ class MetabaseClient:
 
     # ── Colección ──────────────────────────────────────────────────────────
 
-    def get_or_create_collection(self, name: str) -> Optional[int]:
-        """Obtiene o crea una colección para organizar el dashboard."""
+    def get_or_create_collection(self, name: str, parent_id: Optional[int] = None) -> Optional[int]:
+        """Obtiene o crea una colección (opcionalmente dentro de otra) para organizar el dashboard."""
         r = self.get("/api/collection")
         if r.status_code == 200:
-            collections = r.json().get("data", [])
+            collections = decode_json(r)
+            if isinstance(collections, dict):  # Algunas versiones envuelven en "data"
+                collections = collections.get("data", [])
             for col in collections:
                 if col.get("name") == name:
                     ok(f"Colección existente encontrada: '{name}' (ID: {col['id']})")
                     return col["id"]
         # Crear nueva colección
-        r = self.post("/api/collection", {"name": name, "color": "#509EE3"})
+        payload = {"name": name, "color": "#509EE3"}
+        if parent_id:
+            payload["parent_id"] = parent_id
+        r = self.post("/api/collection", payload)
         if r.status_code in (200, 201):
-            col_id = r.json()["id"]
+            col_id = decode_json(r)["id"]
             ok(f"Colección '{name}' creada con ID: {col_id}")
             return col_id
         warn(f"No se pudo crear la colección. El dashboard se creará en la raíz.")
@@ -206,42 +320,106 @@ class MetabaseClient:
 
     def create_card(self, name: str, description: str, sql: str,
                     db_id: int, display: str, viz_settings: dict,
-                    collection_id: Optional[int] = None) -> int:
-        """Crea una pregunta (card) con SQL nativo en Metabase."""
-        payload = {
-            "name": name,
-            "description": description,
-            "display": display,
-            "visualization_settings": viz_settings,
-            "dataset_query": {
-                "database": db_id,
-                "type": "native",
-                "native": {
-                    "query": sql,
-                    "template-tags": {
-                        "periodo_dias": {
-                            "id": "periodo_dias",
-                            "name": "periodo_dias",
-                            "display-name": "Período (días)",
-                            "type": "number",
-                            "default": "7"
-                        }
-                    }
-                }
-            },
-            "collection_id": collection_id
-        }
+                    collection_id: Optional[int] = None,
+                    card_type: str = "question", model_id: Optional[int] = None) -> int:
+        """Crea una pregunta (card) o un modelo con SQL nativo en Metabase."""
+        payload = build_card_payload(name, description, sql, db_id, display,
+                                     viz_settings, collection_id, card_type, model_id)
         r = self.post("/api/card", payload)
         if r.status_code in (200, 201):
-            card_id = r.json()["id"]
+            card_id = decode_json(r)["id"]
             ok(f"Card '{name}' creada con ID: {card_id}")
             return card_id
         raise RuntimeError(f"Error al crear card '{name}': {r.status_code} — {r.text[:300]}")
 
+    def update_card(self, card_id: int, payload: dict) -> None:
+        """Actualiza una card existente (SQL, visualización y settings)."""
+        r = self.put(f"/api/card/{card_id}", payload)
+        if r.status_code == 200:
+            ok(f"Card '{payload.get('name')}' actualizada (ID: {card_id})")
+            return
+        raise RuntimeError(
+            f"Error al actualizar card {card_id}: {r.status_code} — {r.text[:300]}"
+        )
+
+    def persist_model(self, model_id: int, db_id: int, enable: bool = False) -> bool:
+        """
+        Activa el caché (persistencia) del modelo: Metabase guarda su resultado
+        en una tabla de la propia BD y las cards que lo usan leen de ahí.
+
+        Si la persistencia no está habilitada, por defecto solo avisa. Con
+        enable=True (--enable-persistence) la habilita antes de reintentar:
+        POST /api/persist/enable la activa para TODA la instancia de Metabase y
+        POST /api/persist/database/{db_id}/persist hace que Metabase cree un
+        esquema de caché y escriba tablas en esa BD (la de producción), lo que
+        requiere un usuario con permiso de escritura en ese esquema.
+        """
+        r = self.post(f"/api/persist/card/{model_id}/persist")
+        if r.status_code in (200, 204):
+            return True
+        if not enable:
+            warn(f"No se pudo activar el caché del modelo: {r.status_code} — {r.text[:200]}")
+            warn("La persistencia de modelos no está habilitada. Un administrador debe "
+                 "habilitarla (Admin → Performance → Model persistence, y en la BD) con un "
+                 "usuario que pueda escribir en el esquema de caché, o ejecutar el setup "
+                 "con --enable-persistence")
+            return False
+        warn("Habilitando la persistencia de modelos en la instancia y en la BD "
+             f"{db_id} (--enable-persistence)")
+        for path in ("/api/persist/enable", f"/api/persist/database/{db_id}/persist"):
+            self.post(path)
+        r = self.post(f"/api/persist/card/{model_id}/persist")
+        if r.status_code in (200, 204):
+            return True
+        warn(f"No se pudo activar el caché del modelo: {r.status_code} — {r.text[:200]}")
+        return False
+
+    def run_native_query(self, dataset_query: dict, parameters: list = None) -> list:
+        """Ejecuta una consulta nativa ad-hoc vía /api/dataset y retorna sus filas."""
+        r = self.post("/api/dataset", {**dataset_query, "parameters": parameters or []})
+        if r.status_code not in (200, 202):
+            raise RuntimeError(f"Error en /api/dataset: {r.status_code} — {r.text[:300]}")
+        result = decode_json(r)
+        if result.get("status") == "failed" or result.get("error"):
+            raise RuntimeError(f"La consulta falló: {str(result.get('error'))[:300]}")
+        return (result.get("data") or {}).get("rows") or []
+
+    def list_collection_cards(self, collection_id: Optional[int]) -> list:
+        """Lista las cards no archivadas que pertenecen a la colección."""
+        r = self.get("/api/card", params={"f": "all"})
+        if r.status_code != 200:
+            raise RuntimeError(f"Error al listar cards: {r.status_code} — {r.text[:300]}")
+        cards = decode_json(r)
+        if isinstance(cards, dict):
+            cards = cards.get("data", [])
+        return [c for c in cards
+                if c.get("collection_id") == collection_id and not c.get("archived")]
+
     # ── Dashboard ──────────────────────────────────────────────────────────
 
+    def find_dashboard(self, name: str, collection_id: Optional[int] = None) -> Optional[dict]:
+        """Busca un dashboard no archivado por nombre dentro de la colección."""
+        r = self.get("/api/dashboard", params={"f": "all"})
+        if r.status_code != 200:
+            return None
+        dashboards = decode_json(r)
+        if isinstance(dashboards, dict):
+            dashboards = dashboards.get("data", [])
+        for d in dashboards:
+            if (d.get("name") == name and d.get("collection_id") == collection_id
+                    and not d.get("archived")):
+                return d
+        return None
+
+    def get_dashboard(self, dashboard_id: int) -> Optional[dict]:
+        """Obtiene el dashboard completo (dashcards y parámetros)."""
+        r = self.get(f"/api/dashboard/{dashboard_id}")
+        if r.status_code == 200:
+            return decode_json(r)
+        return None
+
     def create_dashboard(self, name: str, description: str,
-                         collection_id: Optional[int] = None) -> int:
+                         collection_id: Optional[int] = None, quiet: bool = False) -> int:
         """Crea un dashboard vacío."""
         payload = {
             "name": name,
@@ -251,86 +429,51 @@ class MetabaseClient:
         }
         r = self.post("/api/dashboard", payload)
         if r.status_code in (200, 201):
-            dash_id = r.json()["id"]
-            ok(f"Dashboard '{name}' creado con ID: {dash_id}")
+            dash_id = decode_json(r)["id"]
+            if not quiet:
+                ok(f"Dashboard '{name}' creado con ID: {dash_id}")
             return dash_id
         raise RuntimeError(f"Error al crear dashboard: {r.status_code} — {r.text[:300]}")
 
-    def add_card_to_dashboard(self, dashboard_id: int, card_id: int,
-                               row: int, col: int, size_x: int, size_y: int) -> int:
-        """Agrega una card al dashboard en la posición especificada."""
-        payload = {
-            "cardId": card_id,
-            "row": row,
-            "col": col,
-            "size_x": size_x,
-            "size_y": size_y,
-            "parameter_mappings": [],
-            "visualization_settings": {}
-        }
-        r = self.post(f"/api/dashboard/{dashboard_id}/cards", payload)
-        if r.status_code in (200, 201):
-            dash_card_id = r.json()["id"]
-            return dash_card_id
-        raise RuntimeError(
-            f"Error al agregar card {card_id} al dashboard: {r.status_code} — {r.text[:300]}"
-        )
-
-    def add_filter_to_dashboard(self, dashboard_id: int, card_ids: list) -> None:
-        """Agrega el filtro de período al dashboard y lo conecta a todas las cards."""
-        # Obtener el estado actual del dashboard para leer los dashcards
-        r = self.get(f"/api/dashboard/{dashboard_id}")
-        if r.status_code != 200:
-            warn("No se pudo obtener el estado del dashboard para agregar filtros.")
-            return
-
-        dash_data = r.json()
-        ordered_cards = dash_data.get("ordered_cards", [])
-
-        # Definir el parámetro de filtro
-        filter_param = {
-            "id": "periodo_dias_filter",
-            "name": "Período (días)",
-            "slug": "periodo_dias",
-            "type": "category",
-            "default": "7"
-        }
-
-        # Mapear el filtro a cada card que tenga el template-tag
-        parameter_mappings = []
-        for dc in ordered_cards:
-            if dc.get("card_id") in card_ids:
-                parameter_mappings.append({
-                    "parameter_id": "periodo_dias_filter",
-                    "card_id": dc["card_id"],
-                    "target": ["variable", ["template-tag", "periodo_dias"]]
-                })
-
-        # Actualizar el dashboard con el parámetro y los mappings
-        update_payload = {
-            "parameters": [filter_param],
-            "ordered_cards": [
-                {**dc, "parameter_mappings": [
-                    m for m in parameter_mappings if m["card_id"] == dc.get("card_id")
-                ]}
-                for dc in ordered_cards
-            ]
-        }
-        r = self.put(f"/api/dashboard/{dashboard_id}", update_payload)
+    def update_dashboard_layout(self, dashboard_id: int, dashcards: list,
+                                parameters: list, extra: dict = None) -> None:
+        """
+        Envía el layout completo (dashcards + filtros) en una sola actualización.
+        Los dashcards nuevos llevan ID negativo; Metabase los crea al guardar.
+        `extra` agrega otros campos del dashboard al mismo PUT (p. ej. embedding).
+        """
+        r = self.put(f"/api/dashboard/{dashboard_id}",
+                     {"dashcards": dashcards, "parameters": parameters, **(extra or {})})
         if r.status_code == 200:
-            ok("Filtro de período conectado a todas las cards del dashboard")
-        else:
-            warn(f"No se pudo conectar el filtro automáticamente: {r.status_code}")
-            warn("Conecta el filtro manualmente desde la UI de Metabase.")
+            saved = decode_json(r)
+            saved_cards = saved.get("dashcards", saved.get("ordered_cards"))
+            if saved_cards is not None and len(saved_cards) >= len(dashcards):
+                return
+        # Metabase < 0.47 ignora "dashcards" en PUT /api/dashboard/{id}:
+        # usar el endpoint bulk anterior para las cards y luego los filtros
+        r = self.put(f"/api/dashboard/{dashboard_id}/cards", {"cards": dashcards})
+        if r.status_code == 200:
+            r = self.put(f"/api/dashboard/{dashboard_id}",
+                         {"parameters": parameters, **(extra or {})})
+        if r.status_code != 200:
+            raise RuntimeError(
+                f"Error al guardar el layout del dashboard: {r.status_code} — {r.text[:300]}"
+            )
 
 
 # ══════════════════════════════════════════════════════════════════════════════
 # DEFINICIÓN DE LAS 5 PREGUNTAS (QUERIES SQL)
 # ══════════════════════════════════════════════════════════════════════════════
 
-def get_cards_definition():
-    """Retorna la definición completa de las 5 cards del dashboard."""
-    return [
+def get_cards_definition(source: str = "raw", model_id: Optional[int] = None):
+    """
+    Retorna la definición completa de las 5 cards del dashboard.
+    Con source="rollup", las cards 1 a 4 leen la tabla agregada critical_email_daily
+    (ver rollup_critical_emails.py) en lugar de recorrer critical_email_log.
+    Con model_id, las cards 1 a 3 se construyen sobre el modelo base (ver
+    get_base_model_definition) en lugar de agregar cada una la tabla fuente.
+    """
+    cards = [
         # ── Card 1: Resumen Ejecutivo ────────────────────────────────────
         {
             "name": "📊 Resumen Ejecutivo — Emails Críticos",
@@ -473,12 +616,808 @@ LIMIT 500
         }
     ]
 
+    if source == "rollup":
+        for card, sql in zip(cards, ROLLUP_CARDS_SQL):
+            card["sql"] = sql
+    if model_id:
+        model_ref = f"{{{{#{model_id}-{BASE_MODEL_SLUG}}}}}"
+        for card, sql in zip(cards, MODEL_CARDS_SQL):
+            card["sql"] = sql.replace("{{modelo}}", model_ref)
+            card["model_id"] = model_id
+    return cards
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# VARIANTE SOBRE EL ROLLUP DIARIO (critical_email_daily)
+# ══════════════════════════════════════════════════════════════════════════════
+# Mismas columnas y nombres que las cards 1 a 4, pero sumando `cantidad` sobre
+# una fila por (día, tenant, tipo, éxito). El período se cuenta en días
+# completos: el primer día de la ventana se incluye entero. La card 5 (log
+# detallado) necesita las filas individuales y sigue leyendo critical_email_log.
+
+ROLLUP_PERIOD = "day >= DATE(DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY))"
+
+ROLLUP_CARDS_SQL = [
+    # ── Card 1: Resumen Ejecutivo ────────────────────────────────────────
+    f"""
+SELECT
+    SUM(cantidad) AS total_enviados,
+    SUM(CASE WHEN success = 1 THEN cantidad ELSE 0 END) AS emails_exitosos,
+    SUM(CASE WHEN success = 0 THEN cantidad ELSE 0 END) AS emails_fallidos,
+    CONCAT(ROUND(
+        (SUM(CASE WHEN success = 1 THEN cantidad ELSE 0 END) / NULLIF(SUM(cantidad), 0)) * 100, 1
+    ), '%') AS tasa_de_exito,
+    SUM(CASE WHEN emailType = 'PAYMENT_FAILED'   THEN cantidad ELSE 0 END) AS pago_fallido,
+    SUM(CASE WHEN emailType = 'TRIAL_EXPIRED'    THEN cantidad ELSE 0 END) AS trial_expirado,
+    SUM(CASE WHEN emailType = 'SUBSCRIPTION_EXP' THEN cantidad ELSE 0 END) AS suscripcion_expirada
+FROM critical_email_daily
+WHERE {ROLLUP_PERIOD}
+""".strip(),
+
+    # ── Card 2: Emails por Día ───────────────────────────────────────────
+    f"""
+SELECT
+    day AS dia,
+    CASE emailType
+        WHEN 'PAYMENT_FAILED'   THEN 'Pago Fallido'
+        WHEN 'TRIAL_EXPIRED'    THEN 'Trial Expirado'
+        WHEN 'SUBSCRIPTION_EXP' THEN 'Suscripción Expirada'
+        ELSE emailType
+    END AS tipo,
+    SUM(cantidad) AS cantidad
+FROM critical_email_daily
+WHERE {ROLLUP_PERIOD}
+GROUP BY day, emailType
+ORDER BY dia ASC
+""".strip(),
+
+    # ── Card 3: Distribución por Tipo ────────────────────────────────────
+    f"""
+SELECT
+    CASE emailType
+        WHEN 'PAYMENT_FAILED'   THEN 'Pago Fallido'
+        WHEN 'TRIAL_EXPIRED'    THEN 'Trial Expirado'
+        WHEN 'SUBSCRIPTION_EXP' THEN 'Suscripción Expirada'
+        ELSE emailType
+    END AS tipo,
+    SUM(cantidad) AS cantidad
+FROM critical_email_daily
+WHERE {ROLLUP_PERIOD}
+GROUP BY emailType
+ORDER BY cantidad DESC
+""".strip(),
+
+    # ── Card 4: Top Tenants en Riesgo ────────────────────────────────────
+    f"""
+SELECT
+    t.name AS tenant,
+    SUM(d.cantidad) AS emails_recibidos,
+    SUM(CASE WHEN d.success = 0 THEN d.cantidad ELSE 0 END) AS emails_fallidos
+FROM critical_email_daily d
+JOIN tenants t ON d.tenantId = t.id
+WHERE d.{ROLLUP_PERIOD}
+GROUP BY t.id, t.name
+ORDER BY emails_recibidos DESC
+LIMIT 10
+""".strip(),
+]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MODELO BASE COMPARTIDO (cards 1 a 3)
+# ══════════════════════════════════════════════════════════════════════════════
+# Las cards 1, 2 y 3 agregan el mismo recorte de datos con el mismo mapeo de
+# emailType. El modelo guarda ese agregado base (una fila por día, tipo y
+# éxito de los últimos MODEL_WINDOW_DAYS días) y, con el caché de modelos
+# activado, Metabase lo calcula una vez por refresco y las tres cards leen el
+# resultado persistido. Los modelos no admiten variables, así que el filtro
+# {{periodo_dias}} se aplica en cada card, en días completos.
+
+BASE_MODEL_NAME   = "🧱 Base — Emails Críticos por Día y Tipo"
+MODEL_WINDOW_DAYS = 365
+
+EMAIL_TYPE_LABEL = """
+    CASE emailType
+        WHEN 'PAYMENT_FAILED'   THEN 'Pago Fallido'
+        WHEN 'TRIAL_EXPIRED'    THEN 'Trial Expirado'
+        WHEN 'SUBSCRIPTION_EXP' THEN 'Suscripción Expirada'
+        ELSE emailType
+    END""".strip("\n")
+
+
+def get_base_model_definition(source: str = "raw") -> dict:
+    """Definición del modelo base; con source="rollup" lo agrega desde critical_email_daily."""
+    if source == "rollup":
+        day, count, table, window = "day", "SUM(cantidad)", "critical_email_daily", "day"
+    else:
+        day, count, table, window = "DATE(sentAt)", "COUNT(*)", "critical_email_log", "sentAt"
+    return {
+        "name": BASE_MODEL_NAME,
+        "description": f"Emails críticos por día, tipo y resultado de los últimos "
+                       f"{MODEL_WINDOW_DAYS} días. Base de las cards de resumen, "
+                       f"evolución diaria y distribución.",
+        "sql": f"""
+SELECT
+    {day} AS dia,
+    emailType,
+{EMAIL_TYPE_LABEL} AS tipo,
+    success,
+    {count} AS cantidad
+FROM {table}
+WHERE {window} >= DATE_SUB(CURDATE(), INTERVAL {MODEL_WINDOW_DAYS} DAY)
+GROUP BY {day}, emailType, success
+""".strip(),
+        "display": "table",
+        "viz_settings": {},
+        "type": "model"
+    }
+
+
+MODEL_PERIOD = "base.dia >= DATE(DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY))"
+
+MODEL_CARDS_SQL = [
+    # ── Card 1: Resumen Ejecutivo ────────────────────────────────────────
+    f"""
+SELECT
+    SUM(base.cantidad) AS total_enviados,
+    SUM(CASE WHEN base.success = 1 THEN base.cantidad ELSE 0 END) AS emails_exitosos,
+    SUM(CASE WHEN base.success = 0 THEN base.cantidad ELSE 0 END) AS emails_fallidos,
+    CONCAT(ROUND(
+        (SUM(CASE WHEN base.success = 1 THEN base.cantidad ELSE 0 END)
+            / NULLIF(SUM(base.cantidad), 0)) * 100, 1
+    ), '%') AS tasa_de_exito,
+    SUM(CASE WHEN base.emailType = 'PAYMENT_FAILED'   THEN base.cantidad ELSE 0 END) AS pago_fallido,
+    SUM(CASE WHEN base.emailType = 'TRIAL_EXPIRED'    THEN base.cantidad ELSE 0 END) AS trial_expirado,
+    SUM(CASE WHEN base.emailType = 'SUBSCRIPTION_EXP' THEN base.cantidad ELSE 0 END) AS suscripcion_expirada
+FROM {{{{modelo}}}} AS base
+WHERE {MODEL_PERIOD}
+""".strip(),
+
+    # ── Card 2: Emails por Día ───────────────────────────────────────────
+    f"""
+SELECT
+    base.dia,
+    base.tipo,
+    SUM(base.cantidad) AS cantidad
+FROM {{{{modelo}}}} AS base
+WHERE {MODEL_PERIOD}
+GROUP BY base.dia, base.tipo
+ORDER BY base.dia ASC
+""".strip(),
+
+    # ── Card 3: Distribución por Tipo ────────────────────────────────────
+    f"""
+SELECT
+    base.tipo,
+    SUM(base.cantidad) AS cantidad
+FROM {{{{modelo}}}} AS base
+WHERE {MODEL_PERIOD}
+GROUP BY base.tipo
+ORDER BY cantidad DESC
+""".strip(),
+]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# LAYOUT DEL DASHBOARD
+# ══════════════════════════════════════════════════════════════════════════════
+
+PERIOD_FILTER = {
+    "id": "periodo_dias_filter",
+    "name": "Período (días)",
+    "slug": "periodo_dias",
+    "type": "category",
+    "default": "7"
+}
+
+LAYOUT_KEYS = ("row", "col", "size_x", "size_y")
+
+
+def build_dashboard_layout(card_ids: list, current_dashcards: list,
+                           filters: tuple = (PERIOD_FILTER,)) -> tuple:
+    """
+    Arma localmente los dashcards del dashboard a partir de los `layout` de
+    get_cards_definition(), con los filtros (por defecto, el de período) ya
+    mapeados en cada card a la variable del mismo slug.
+    Los dashcards existentes de esas cards conservan su ID y los que no son
+    nuestros (p. ej. textos agregados a mano) se mantienen intactos.
+    Retorna (dashcards, cambió) donde `cambió` indica si hace falta guardarlo.
+    """
+    current_by_card = {dc.get("card_id"): dc for dc in current_dashcards if dc.get("card_id")}
+    ours = {card_id for card_id, _ in card_ids}
+    dashcards = [dc for dc in current_dashcards if dc.get("card_id") not in ours]
+    changed = False
+
+    for new_id, (card_id, layout) in enumerate(card_ids, start=1):
+        mappings = [{
+            "parameter_id": f["id"],
+            "card_id": card_id,
+            "target": ["variable", ["template-tag", f["slug"]]]
+        } for f in filters]
+        current = current_by_card.get(card_id)
+        if current is None:
+            changed = True
+        elif (any(current.get(k) != layout[k] for k in LAYOUT_KEYS)
+              or current.get("parameter_mappings") != mappings):
+            changed = True
+        dashcards.append({
+            "id": current["id"] if current else -new_id,
+            "card_id": card_id,
+            **{k: layout[k] for k in LAYOUT_KEYS},
+            "parameter_mappings": mappings,
+            "visualization_settings": (current or {}).get("visualization_settings", {})
+        })
+
+    return dashcards, changed
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ANÁLISIS DE ÍNDICES (EXPLAIN)
+# ══════════════════════════════════════════════════════════════════════════════
+# Antes de desplegar una card nueva o modificada se ejecuta su SQL con
+# EXPLAIN FORMAT=JSON vía /api/dataset (con el valor por defecto de
+# {{periodo_dias}}) y se reportan el tipo de acceso, las filas examinadas y el
+# uso de filesort/tablas temporales. Si una tabla conocida se recorre completa
+# o sin índice cubriente, se sugiere un índice compuesto: primero la columna
+# del rango de fechas y luego las columnas de filtro/agrupación que usa la card.
+
+INDEX_CANDIDATES = {
+    "critical_email_log":   ["sentAt", "emailType", "success", "tenantId"],
+    "critical_email_daily": ["day", "tenantId", "emailType", "success"],
+}
+FULL_SCAN_ACCESS = ("ALL", "index")
+# EXPLAIN reporta el alias de la tabla ("log"), no su nombre real
+TABLE_ALIAS_RE = re.compile(r"\b(?:FROM|JOIN)\s+`?(\w+)`?(?:\s+(?:AS\s+)?`?(\w+)`?)?",
+                            re.IGNORECASE)
+SQL_KEYWORDS = {"where", "join", "on", "group", "order", "limit", "left", "inner", "right"}
+
+
+def table_aliases(sql: str) -> dict:
+    """Mapa alias → tabla de las cláusulas FROM/JOIN del SQL."""
+    aliases = {}
+    for table, alias in TABLE_ALIAS_RE.findall(sql):
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def explain_tables(node, found: list = None) -> list:
+    """Recorre el plan JSON de MySQL y retorna los nodos 'table' con sus flags."""
+    found = [] if found is None else found
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "table" and isinstance(value, dict) and "table_name" in value:
+                found.append(value)
+            explain_tables(value, found)
+    elif isinstance(node, list):
+        for item in node:
+            explain_tables(item, found)
+    return found
+
+
+def explain_flags(node) -> set:
+    """Flags using_filesort / using_temporary_table presentes en cualquier nivel del plan."""
+    flags = set()
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ("using_filesort", "using_temporary_table") and value is True:
+                flags.add(key)
+            flags |= explain_flags(value)
+    elif isinstance(node, list):
+        for item in node:
+            flags |= explain_flags(item)
+    return flags
+
+
+def suggest_index(table: dict, sql: str) -> Optional[tuple]:
+    """
+    Sugiere un índice compuesto (tabla, columnas) si la tabla se recorre
+    completa o sin índice cubriente. None si no hay nada que sugerir.
+    """
+    name = table_aliases(sql).get(table.get("table_name"), table.get("table_name"))
+    if name not in INDEX_CANDIDATES:
+        return None
+    if table.get("access_type") not in FULL_SCAN_ACCESS and table.get("using_index"):
+        return None
+    columns = tuple(c for c in INDEX_CANDIDATES[name] if re.search(rf"\b{c}\b", sql))
+    # Sin la columna del rango de fechas la card no filtra esa tabla directamente
+    if not columns or columns[0] != INDEX_CANDIDATES[name][0]:
+        return None
+    if list(columns) == (table.get("used_key_parts") or [])[:len(columns)]:
+        return None
+    return name, columns
+
+
+def index_ddl(suggestion: tuple) -> str:
+    name, columns = suggestion
+    return f"CREATE INDEX idx_{name}_{'_'.join(columns)} ON {name} ({', '.join(columns)});"
+
+
+def merge_suggestions(suggestions: list) -> list:
+    """Descarta los índices que son prefijo de otro sugerido para la misma tabla."""
+    return [s for s in dict.fromkeys(suggestions)
+            if not any(o != s and o[0] == s[0] and o[1][:len(s[1])] == s[1]
+                       for o in suggestions)]
+
+
+def analyze_card(client: MetabaseClient, card_def: dict, db_id: int) -> list:
+    """
+    Ejecuta EXPLAIN FORMAT=JSON del SQL de la card e imprime el diagnóstico.
+    Retorna los índices sugeridos como (tabla, columnas); nunca bloquea el despliegue.
+    """
+    query = build_card_payload(card_def["name"], "", card_def["sql"], db_id, "table", {},
+                               card_type=card_def.get("type", "question"),
+                               model_id=card_def.get("model_id"))["dataset_query"]
+    query["native"]["query"] = "EXPLAIN FORMAT=JSON " + card_def["sql"]
+    parameters = []
+    if "periodo_dias" in query["native"]["template-tags"]:
+        parameters.append({"type": "number/=", "value": PERIOD_FILTER["default"],
+                           "target": ["variable", ["template-tag", "periodo_dias"]]})
+
+    info(f"EXPLAIN '{card_def['name']}'")
+    try:
+        rows = client.run_native_query(query, parameters)
+        plan = json.loads(rows[0][0]) if rows and rows[0] else None
+    except (RuntimeError, ValueError, TypeError) as e:
+        warn(f"    No se pudo analizar: {e}")
+        return []
+    if not plan:
+        warn("    EXPLAIN no retornó un plan")
+        return []
+
+    suggestions = []
+    for table in explain_tables(plan):
+        access = table.get("access_type", "?")
+        key = table.get("key") or "sin índice"
+        rows_examined = table.get("rows_examined_per_scan", "?")
+        line = f"    {table['table_name']}: acceso {access} ({key}), ~{rows_examined} filas/scan"
+        (warn if access in FULL_SCAN_ACCESS else info)(line)
+        suggestion = suggest_index(table, card_def["sql"])
+        if suggestion and suggestion not in suggestions:
+            suggestions.append(suggestion)
+    flags = explain_flags(plan)
+    if flags:
+        labels = {"using_filesort": "filesort", "using_temporary_table": "tabla temporal"}
+        warn(f"    Usa {' y '.join(labels[f] for f in sorted(flags))}")
+    for suggestion in suggestions:
+        warn(f"    Índice sugerido: {index_ddl(suggestion)}")
+    return suggestions
+
+
+def analyze_cards(client: MetabaseClient, cards_def: list, db_id: int) -> list:
+    """Analiza todas las cards y retorna los índices sugeridos, combinados por prefijo."""
+    suggestions = []
+    for card_def in cards_def:
+        suggestions += analyze_card(client, card_def, db_id)
+    return merge_suggestions(suggestions)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# RECONCILIACIÓN DE CARDS (MODO --reconcile)
+# ══════════════════════════════════════════════════════════════════════════════
+
+def card_content_hash(sql: str, display: str, viz_settings: dict) -> str:
+    """Hash estable del contenido relevante de una card (SQL, display y settings)."""
+    content = json.dumps(
+        {"sql": sql.strip(), "display": display, "viz_settings": viz_settings or {}},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def existing_card_hash(card: dict) -> str:
+    """Calcula card_content_hash para una card tal como la devuelve /api/card."""
+    native = (card.get("dataset_query") or {}).get("native") or {}
+    return card_content_hash(native.get("query", ""), card.get("display"),
+                             card.get("visualization_settings"))
+
+
+def reconcile_cards(client: MetabaseClient, cards_def: list, db_id: int,
+                    collection_id: Optional[int], analyze: bool = False) -> tuple:
+    """
+    Sincroniza las cards de la colección con get_cards_definition().
+    Las cards se emparejan por nombre: crea las que faltan, actualiza las que
+    cambiaron según su hash de contenido y no toca las que ya coinciden.
+    Con analyze=True, ejecuta EXPLAIN de cada card antes de crearla o actualizarla.
+    Retorna ([(card_id, layout), ...], {"created", "updated", "unchanged"}).
+    """
+    existing = {c["name"]: c for c in client.list_collection_cards(collection_id)}
+    card_ids = []
+    stats = {"created": 0, "updated": 0, "unchanged": 0}
+
+    for card_def in cards_def:
+        name = card_def["name"]
+        try:
+            current = existing.get(name)
+            if current is None:
+                if analyze:
+                    analyze_card(client, card_def, db_id)
+                card_id = client.create_card(
+                    name=name,
+                    description=card_def["description"],
+                    sql=card_def["sql"],
+                    db_id=db_id,
+                    display=card_def["display"],
+                    viz_settings=card_def["viz_settings"],
+                    collection_id=collection_id,
+                    card_type=card_def.get("type", "question"),
+                    model_id=card_def.get("model_id")
+                )
+                stats["created"] += 1
+            else:
+                card_id = current["id"]
+                wanted = card_content_hash(card_def["sql"], card_def["display"],
+                                           card_def["viz_settings"])
+                if existing_card_hash(current) == wanted:
+                    info(f"Card '{name}' sin cambios (ID: {card_id})")
+                    stats["unchanged"] += 1
+                else:
+                    if analyze:
+                        analyze_card(client, card_def, db_id)
+                    client.update_card(card_id, build_card_payload(
+                        name, card_def["description"], card_def["sql"], db_id,
+                        card_def["display"], card_def["viz_settings"], collection_id,
+                        card_def.get("type", "question"), card_def.get("model_id")
+                    ))
+                    stats["updated"] += 1
+            card_ids.append((card_id, card_def["layout"]))
+        except RuntimeError as e:
+            err(str(e))
+            warn(f"Continuando con las demás cards...")
+
+    return card_ids, stats
+
+
+def ensure_base_model(client: MetabaseClient, source: str, db_id: int,
+                      collection_id: Optional[int], reconcile: bool,
+                      analyze: bool = False,
+                      enable_persistence: bool = False) -> Optional[int]:
+    """
+    Crea (o reconcilia) el modelo base y activa su caché. Retorna su ID o None.
+    enable_persistence habilita la persistencia de modelos en Metabase si hace
+    falta (ver MetabaseClient.persist_model).
+    """
+    model_def = get_base_model_definition(source)
+    model_def["layout"] = None  # El modelo no se agrega al dashboard
+    try:
+        if reconcile:
+            card_ids, _ = reconcile_cards(client, [model_def], db_id, collection_id, analyze)
+            model_id = card_ids[0][0] if card_ids else None
+        else:
+            if analyze:
+                analyze_card(client, model_def, db_id)
+            model_id = client.create_card(
+                name=model_def["name"],
+                description=model_def["description"],
+                sql=model_def["sql"],
+                db_id=db_id,
+                display=model_def["display"],
+                viz_settings=model_def["viz_settings"],
+                collection_id=collection_id,
+                card_type="model"
+            )
+    except RuntimeError as e:
+        err(str(e))
+        return None
+    if model_id and client.persist_model(model_id, db_id, enable_persistence):
+        ok(f"Modelo base con caché activado (ID: {model_id})")
+    return model_id
+
+
+def run_analysis(client: MetabaseClient, source: str, use_model: bool) -> None:
+    """Modo --analyze: EXPLAIN de todas las cards contra la BD existente, sin cambios."""
+    step("Analizando el SQL de las cards (EXPLAIN)...")
+    database = client.find_database(DB_DISPLAY_NAME)
+    if not database:
+        err(f"No se encontró la base de datos '{DB_DISPLAY_NAME}' en Metabase")
+        sys.exit(1)
+    db_id = database["id"]
+
+    cards_def, model_id = [], None
+    if use_model:
+        # El modelo ya desplegado (registrado por un setup anterior) es el que leerán las cards
+        model_id = StateStore().get("model_id")
+        cards_def.append(get_base_model_definition(source))
+    cards_def += get_cards_definition(source, model_id)
+
+    suggestions = analyze_cards(client, cards_def, db_id)
+    print()
+    if suggestions:
+        warn(f"{len(suggestions)} índice(s) sugerido(s):")
+        for suggestion in suggestions:
+            print(f"      {index_ddl(suggestion)}")
+    else:
+        ok("Sin índices sugeridos")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DASHBOARDS POR TENANT
+# ══════════════════════════════════════════════════════════════════════════════
+# Un dashboard filtrado por cada tenant (p. ej. todos los enterprise) para
+# embeberlo en su panel. Todos comparten las mismas cards, con una variable
+# tenant_id adicional; cada dashboard fija su tenant en el filtro y lo bloquea
+# (locked) en el embedding firmado. Crear un dashboard cuesta 2 requests (POST +
+# PUT del layout), así que miles de tenants se aprovisionan en paralelo por
+# lotes, con un checkpoint en el estado local para poder retomar.
+
+TENANT_CARD_INDEXES   = (0, 1, 2, 4)  # Top Tenants en Riesgo no aplica a un solo tenant
+TENANT_CARD_SUFFIX    = " · por tenant"
+TENANT_DASHBOARD_RE   = re.compile(r"\(tenant (\d+)\)$")
+TENANT_PAGE_SIZE      = 1000  # /api/dataset limita las consultas ad-hoc a 2000 filas
+TENANT_EMBEDDING      = {"tenant_id": "locked", "periodo_dias": "enabled"}
+TENANT_THROTTLE_RATIO = 0.05  # Fracción de 429/503 en un lote a partir de la cual se reduce la concurrencia
+PERIOD_WHERE_RE       = re.compile(r"^WHERE\s+(?:(\w+)\.)?.*\{\{periodo_dias\}\}.*$", re.MULTILINE)
+
+
+def tenant_dashboard_name(tenant: dict) -> str:
+    return f"Emails Críticos — {tenant['name']} (tenant {tenant['id']})"
+
+
+def tenant_filter(tenant_id: int) -> dict:
+    return {
+        "id": "tenant_id_filter",
+        "name": "Tenant",
+        "slug": "tenant_id",
+        "type": "category",
+        "default": str(tenant_id)
+    }
+
+
+def add_tenant_filter(sql: str) -> str:
+    """
+    Agrega AND tenantId = {{tenant_id}} tras el WHERE del período (con su alias).
+    La condición es obligatoria (fuera de [[...]]): sin tenant_id la card falla
+    en lugar de mostrar las filas de todos los tenants.
+    """
+    def _append(match):
+        alias = f"{match.group(1)}." if match.group(1) else ""
+        return f"{match.group(0)}\nAND {alias}tenantId = {{{{tenant_id}}}}"
+    filtered, count = PERIOD_WHERE_RE.subn(_append, sql, count=1)
+    if not count:
+        raise ValueError("La card no tiene un WHERE con {{periodo_dias}} donde "
+                         "agregar el filtro de tenant")
+    return filtered
+
+
+def get_tenant_cards_definition(source: str = "raw") -> list:
+    """Cards compartidas por los dashboards de tenant: las del dashboard general con filtro de tenant."""
+    cards = get_cards_definition(source)
+    tenant_cards = []
+    for index in TENANT_CARD_INDEXES:
+        card = dict(cards[index])
+        card["name"] += TENANT_CARD_SUFFIX
+        card["sql"] = add_tenant_filter(card["sql"])
+        tenant_cards.append(card)
+    tenant_cards[-1]["layout"] = {"row": 12, "col": 0, "size_x": 24, "size_y": 8}
+    return tenant_cards
+
+
+def fetch_tenants(client: MetabaseClient, db_id: int, plan: str,
+                  only_ids: Optional[set] = None) -> list:
+    """Tenants activos del plan, paginados por id (keyset) a través de /api/dataset."""
+    tenants, after = [], 0
+    while True:
+        sql = (f"SELECT id, name FROM tenants WHERE plan = '{plan}' AND status = 'active' "
+               f"AND id > {after} ORDER BY id LIMIT {TENANT_PAGE_SIZE}")
+        rows = client.run_native_query({"database": db_id, "type": "native",
+                                        "native": {"query": sql}})
+        tenants += [{"id": int(row[0]), "name": row[1]} for row in rows
+                    if only_ids is None or int(row[0]) in only_ids]
+        if len(rows) < TENANT_PAGE_SIZE:
+            return tenants
+        after = int(rows[-1][0])
+
+
+def list_tenant_dashboards(client: MetabaseClient, collection_id: Optional[int]) -> dict:
+    """Dashboards de tenant ya existentes en la colección: {tenant_id: dashboard_id}."""
+    r = client.get("/api/dashboard", params={"f": "all"})
+    if r.status_code != 200:
+        raise RuntimeError(f"Error al listar dashboards: {r.status_code} — {r.text[:300]}")
+    dashboards = decode_json(r)
+    if isinstance(dashboards, dict):
+        dashboards = dashboards.get("data", [])
+    found = {}
+    for d in dashboards:
+        match = TENANT_DASHBOARD_RE.search(d.get("name", ""))
+        if match and d.get("collection_id") == collection_id and not d.get("archived"):
+            found[int(match.group(1))] = d["id"]
+    return found
+
+
+def tenant_dashboard_hash(card_ids: list, tenant: dict) -> str:
+    """Hash de todo lo que define el dashboard de un tenant (cards, layout, nombre, filtros)."""
+    content = json.dumps({"cards": card_ids, "name": tenant_dashboard_name(tenant),
+                          "filters": [PERIOD_FILTER, tenant_filter(tenant["id"])],
+                          "embedding": TENANT_EMBEDDING},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def provision_tenant(client: MetabaseClient, tenant: dict, card_ids: list,
+                     collection_id: Optional[int], dashboard_id: Optional[int]) -> tuple:
+    """Crea o actualiza el dashboard de un tenant. Retorna (dashboard_id, "created"|"updated")."""
+    filters = (PERIOD_FILTER, tenant_filter(tenant["id"]))
+    current_dashcards, parameters = [], []
+    if dashboard_id:
+        current = client.get_dashboard(dashboard_id) or {}
+        current_dashcards = current.get("dashcards", current.get("ordered_cards", []))
+        ids = {f["id"] for f in filters}
+        parameters = [p for p in current.get("parameters") or [] if p.get("id") not in ids]
+        outcome = "updated"
+    else:
+        dashboard_id = client.create_dashboard(
+            name=tenant_dashboard_name(tenant),
+            description=f"Emails críticos enviados al tenant {tenant['name']}.",
+            collection_id=collection_id,
+            quiet=True
+        )
+        outcome = "created"
+    dashcards, _ = build_dashboard_layout(card_ids, current_dashcards, filters)
+    client.update_dashboard_layout(dashboard_id, dashcards, parameters + list(filters),
+                                   extra={"name": tenant_dashboard_name(tenant),
+                                          "enable_embedding": True,
+                                          "embedding_params": TENANT_EMBEDDING})
+    return dashboard_id, outcome
+
+
+def provision_tenant_dashboards(client: MetabaseClient, db_id: int, collection_id: Optional[int],
+                                source: str, plan: str, only_ids: Optional[set] = None,
+                                batch_size: int = TENANT_BATCH_SIZE,
+                                concurrency: int = TENANT_CONCURRENCY,
+                                restart: bool = False, analyze: bool = False) -> dict:
+    """
+    Aprovisiona un dashboard por tenant en lotes concurrentes.
+    El checkpoint ("tenant_dashboards" en el estado local) guarda el dashboard y
+    el hash de cada tenant tras cada lote: una re-ejecución (o la continuación de
+    una interrumpida) salta los tenants que ya están al día. Si un lote recibe
+    respuestas 429/503, el siguiente usa la mitad de workers; si no, suma uno.
+    El ritmo de requests lo regula además el limitador adaptativo del cliente.
+    """
+    tenants_collection = client.get_or_create_collection(TENANT_COLLECTION_NAME, collection_id)
+    card_ids, card_stats = reconcile_cards(client, get_tenant_cards_definition(source), db_id,
+                                           tenants_collection, analyze)
+    if len(card_ids) < len(TENANT_CARD_INDEXES):
+        raise RuntimeError("No se pudieron preparar todas las cards compartidas por tenant")
+    ok(f"Cards por tenant: {card_stats['created']} creadas, {card_stats['updated']} "
+       f"actualizadas, {card_stats['unchanged']} sin cambios")
+
+    tenants = fetch_tenants(client, db_id, plan, only_ids)
+    existing = list_tenant_dashboards(client, tenants_collection)
+    state = StateStore()
+    checkpoint = {} if restart else dict(state.get("tenant_dashboards") or {})
+
+    pending = []
+    for tenant in tenants:
+        wanted = tenant_dashboard_hash(card_ids, tenant)
+        saved = checkpoint.get(str(tenant["id"])) or {}
+        dashboard_id = existing.get(tenant["id"])
+        if dashboard_id and saved.get("dashboard_id") == dashboard_id and saved.get("hash") == wanted:
+            continue
+        pending.append((tenant, dashboard_id, wanted))
+    results = {"tenants": len(tenants), "created": 0, "updated": 0,
+               "unchanged": len(tenants) - len(pending), "errors": 0}
+    info(f"{len(tenants)} tenants '{plan}' activos: {len(pending)} por aprovisionar, "
+         f"{results['unchanged']} al día")
+
+    start = time.time()
+    requests_before, throttled_before = client.requests, client.throttled
+    workers = max(1, concurrency)
+    for offset in range(0, len(pending), batch_size):
+        batch = pending[offset:offset + batch_size]
+        batch_requests, batch_throttled = client.requests, client.throttled
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(tenant, wanted, executor.submit(
+                            provision_tenant, client, tenant, card_ids,
+                            tenants_collection, dashboard_id))
+                       for tenant, dashboard_id, wanted in batch]
+            for tenant, wanted, future in futures:
+                try:
+                    dashboard_id, outcome = future.result()
+                except (RuntimeError, requests.RequestException) as e:
+                    results["errors"] += 1
+                    err(f"Tenant {tenant['id']}: {e}")
+                    continue
+                results[outcome] += 1
+                checkpoint[str(tenant["id"])] = {"dashboard_id": dashboard_id, "hash": wanted}
+
+        state.set("tenant_dashboards", checkpoint)
+        try:
+            state.save()
+        except OSError as e:
+            warn(f"No se pudo guardar el checkpoint en {state.path}: {e}")
+
+        done = offset + len(batch)
+        rate = done / max(time.time() - start, 0.001)
+        throttled = client.throttled - batch_throttled
+        ratio = throttled / max(client.requests - batch_requests, 1)
+        info(f"Lote {offset // batch_size + 1}: {done}/{len(pending)} tenants — "
+             f"{results['created']} creados, {results['updated']} actualizados, "
+             f"{results['errors']} errores | {rate:.1f} tenants/s, {workers} workers, "
+             f"límite {client.limiter.rate:.1f} req/s, {throttled} respuestas 429/503, ETA {(len(pending) - done) / rate:.0f}s")
+        # Un 429 aislado ya lo absorbió el limitador; solo se quitan workers si son frecuentes
+        if ratio > TENANT_THROTTLE_RATIO:
+            workers = max(1, workers // 2)
+        else:
+            workers = min(concurrency, workers + 1)
+
+    results["elapsed"] = round(time.time() - start, 1)
+    results["requests"] = client.requests - requests_before
+    results["throttled"] = client.throttled - throttled_before
+    return results
+
+
+def run_tenant_provisioning(client: MetabaseClient, db_id: int, collection_id: Optional[int],
+                            args, analyze: bool) -> None:
+    """Modo --tenants: aprovisiona los dashboards por tenant e imprime el resumen."""
+    step(f"5/6  Aprovisionando dashboards por tenant (plan '{args.tenant_plan}')...")
+    if args.model:
+        warn("--model no aplica a los dashboards por tenant (el modelo no tiene tenantId)")
+    try:
+        results = provision_tenant_dashboards(
+            client, db_id, collection_id, args.source, args.tenant_plan, args.tenant_ids,
+            batch_size=args.batch_size, concurrency=args.concurrency,
+            restart=args.restart, analyze=analyze
+        )
+    except RuntimeError as e:
+        err(str(e))
+        sys.exit(1)
+
+    step("6/6  Resumen")
+    elapsed = max(results["elapsed"], 0.001)
+    print(f"  {BOLD}Tenants:{RESET} {results['tenants']} — {results['created']} creados, "
+          f"{results['updated']} actualizados, {results['unchanged']} al día, "
+          f"{results['errors']} errores")
+    print(f"  {BOLD}Tiempo:{RESET} {results['elapsed']}s "
+          f"({(results['created'] + results['updated']) / elapsed:.1f} tenants/s, "
+          f"{results['requests'] / elapsed:.1f} requests/s, {results['throttled']} respuestas 429/503)")
+    print(f"\n  {YELLOW}Embedding:{RESET} habilita el embedding estático en Admin → Embedding; "
+          f"el filtro tenant_id queda bloqueado (locked) en el token firmado.\n")
+    if results["errors"]:
+        sys.exit(1)
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # FUNCIÓN PRINCIPAL
 # ══════════════════════════════════════════════════════════════════════════════
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Configura el Dashboard de Emails Críticos en Metabase"
+    )
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Reutilizar cards y dashboard existentes: crear solo lo que "
+                             "falta y actualizar solo lo que cambió")
+    parser.add_argument("--analyze", action="store_true",
+                        help="Solo analizar el SQL de las cards con EXPLAIN y sugerir índices "
+                             "(no crea ni modifica nada)")
+    parser.add_argument("--no-analyze", action="store_true",
+                        help="No ejecutar EXPLAIN antes de desplegar cards nuevas o modificadas")
+    parser.add_argument("--model", action="store_true", default=USE_BASE_MODEL,
+                        help="Construir las cards 1-3 sobre un modelo base compartido "
+                             "con caché de modelos activado")
+    parser.add_argument("--enable-persistence", action="store_true",
+                        help="Con --model: si la persistencia de modelos está deshabilitada, "
+                             "habilitarla en toda la instancia y en la BD (crea un esquema de "
+                             "caché con tablas en la BD; requiere permiso de escritura)")
+    parser.add_argument("--source", choices=("raw", "rollup"), default=CARD_SOURCE,
+                        help="Origen de las cards 1-4: 'raw' (critical_email_log) o 'rollup' "
+                             "(critical_email_daily, mantenida por rollup_critical_emails.py)")
+    parser.add_argument("--tenants", action="store_true",
+                        help="Aprovisionar un dashboard embebible por tenant (en lugar del general)")
+    parser.add_argument("--tenant-plan", choices=("free", "starter", "pro", "enterprise"),
+                        default="enterprise",
+                        help="Plan de los tenants activos a aprovisionar (default: enterprise)")
+    parser.add_argument("--tenant-ids", type=lambda v: {int(x) for x in v.split(",") if x},
+                        help="Solo estos tenants (IDs separados por coma)")
+    parser.add_argument("--batch-size", type=int, default=TENANT_BATCH_SIZE,
+                        help=f"Tenants por lote entre checkpoints (default: {TENANT_BATCH_SIZE})")
+    parser.add_argument("--concurrency", type=int, default=TENANT_CONCURRENCY,
+                        help=f"Requests en paralelo como máximo (default: {TENANT_CONCURRENCY})")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignorar el checkpoint y revisar todos los dashboards de tenant")
+    args = parser.parse_args()
+
     print(f"\n{BOLD}{'═' * 60}{RESET}")
     print(f"{BOLD}  ImagineCRM — Setup Dashboard Metabase{RESET}")
     print(f"{BOLD}{'═' * 60}{RESET}")
@@ -501,7 +1440,7 @@ def main():
 
     # ── 2. Autenticar ──────────────────────────────────────────────────────
     step("2/6  Autenticando en Metabase...")
-    client = MetabaseClient(METABASE_URL)
+    client = MetabaseClient(METABASE_URL, pool_size=args.concurrency)
 
     if METABASE_API_KEY:
         if not client.auth_with_api_key(METABASE_API_KEY):
@@ -510,6 +1449,11 @@ def main():
         if not client.auth_with_credentials(METABASE_EMAIL, METABASE_PASSWORD):
             sys.exit(1)
 
+    if args.analyze:
+        run_analysis(client, args.source, args.model)
+        sys.exit(0)
+    analyze = not args.no_analyze
+
     # ── 3. Conectar base de datos ──────────────────────────────────────────
     step("3/6  Configurando conexión a la base de datos...")
     try:
@@ -522,27 +1466,53 @@ def main():
     step("4/6  Configurando colección...")
     collection_id = client.get_or_create_collection(COLLECTION_NAME)
 
+    if args.tenants:
+        run_tenant_provisioning(client, db_id, collection_id, args, analyze)
+        sys.exit(0)
+
     # ── 5. Crear las 5 cards ───────────────────────────────────────────────
     step("5/6  Creando preguntas (cards)...")
-    cards_def = get_cards_definition()
+    model_id = None
+    if args.model:
+        model_id = ensure_base_model(client, args.source, db_id, collection_id,
+                                     args.reconcile, analyze, args.enable_persistence)
+        if not model_id:
+            warn("Sin modelo base: las cards 1-3 consultarán la tabla fuente directamente")
+    cards_def = get_cards_definition(args.source, model_id)
+    if args.source == "rollup":
+        info("Cards 1-4 sobre critical_email_daily: ejecuta rollup_critical_emails.py "
+             "antes de abrir el dashboard")
     card_ids  = []
+    stats     = None
 
-    for card_def in cards_def:
+    if args.reconcile:
         try:
-            card_id = client.create_card(
-                name=card_def["name"],
-                description=card_def["description"],
-                sql=card_def["sql"],
-                db_id=db_id,
-                display=card_def["display"],
-                viz_settings=card_def["viz_settings"],
-                collection_id=collection_id
-            )
-            card_ids.append((card_id, card_def["layout"]))
-            time.sleep(0.5)  # Pequeña pausa para no saturar la API
+            card_ids, stats = reconcile_cards(client, cards_def, db_id, collection_id,
+                                              analyze)
         except RuntimeError as e:
             err(str(e))
-            warn(f"Continuando con las demás cards...")
+            sys.exit(1)
+        ok(f"Cards reconciliadas: {stats['created']} creadas, {stats['updated']} "
+           f"actualizadas, {stats['unchanged']} sin cambios")
+    else:
+        for card_def in cards_def:
+            try:
+                if analyze:
+                    analyze_card(client, card_def, db_id)
+                card_id = client.create_card(
+                    name=card_def["name"],
+                    description=card_def["description"],
+                    sql=card_def["sql"],
+                    db_id=db_id,
+                    display=card_def["display"],
+                    viz_settings=card_def["viz_settings"],
+                    collection_id=collection_id,
+                    model_id=card_def.get("model_id")
+                )
+                card_ids.append((card_id, card_def["layout"]))
+            except RuntimeError as e:
+                err(str(e))
+                warn(f"Continuando con las demás cards...")
 
     if not card_ids:
         err("No se pudo crear ninguna card. Abortando.")
@@ -550,48 +1520,67 @@ def main():
 
     # ── 6. Crear dashboard y agregar cards ─────────────────────────────────
     step("6/6  Creando dashboard y configurando layout...")
-    try:
-        dashboard_id = client.create_dashboard(
-            name=DASHBOARD_NAME,
-            description="Monitoreo en tiempo real de emails críticos enviados a tenants en riesgo.",
-            collection_id=collection_id
-        )
-    except RuntimeError as e:
-        err(str(e))
-        sys.exit(1)
-
-    # Agregar cada card al dashboard en su posición
-    all_card_ids = []
-    for card_id, layout in card_ids:
+    existing_dash = client.find_dashboard(DASHBOARD_NAME, collection_id) if args.reconcile else None
+    current_dashcards, parameters = [], []
+    if existing_dash:
+        dashboard_id = existing_dash["id"]
+        current = client.get_dashboard(dashboard_id) or {}
+        current_dashcards = current.get("dashcards", current.get("ordered_cards", []))
+        parameters = current.get("parameters") or []
+        ok(f"Dashboard existente reutilizado (ID: {dashboard_id})")
+    else:
         try:
-            client.add_card_to_dashboard(
-                dashboard_id=dashboard_id,
-                card_id=card_id,
-                row=layout["row"],
-                col=layout["col"],
-                size_x=layout["size_x"],
-                size_y=layout["size_y"]
+            dashboard_id = client.create_dashboard(
+                name=DASHBOARD_NAME,
+                description="Monitoreo en tiempo real de emails críticos enviados a tenants en riesgo.",
+                collection_id=collection_id
             )
-            all_card_ids.append(card_id)
-            ok(f"Card {card_id} agregada al dashboard en posición ({layout['row']}, {layout['col']})")
-            time.sleep(0.3)
         except RuntimeError as e:
             err(str(e))
+            sys.exit(1)
 
-    # Agregar filtro de período
-    if all_card_ids:
-        info("Conectando filtro de período a las cards...")
-        client.add_filter_to_dashboard(dashboard_id, all_card_ids)
+    # Layout completo + filtro de período en una sola actualización del dashboard
+    dashcards, changed = build_dashboard_layout(card_ids, current_dashcards)
+    has_filter = PERIOD_FILTER in parameters
+    if changed or not has_filter:
+        parameters = [p for p in parameters if p.get("id") != PERIOD_FILTER["id"]]
+        try:
+            client.update_dashboard_layout(dashboard_id, dashcards,
+                                           parameters + [PERIOD_FILTER])
+            ok(f"Layout guardado: {len(card_ids)} cards con el filtro de período conectado")
+        except RuntimeError as e:
+            err(str(e))
+            warn("Agrega las cards y conecta el filtro manualmente desde la UI de Metabase.")
+            sys.exit(1)
+    else:
+        info("Layout y filtro del dashboard sin cambios")
+    all_card_ids = [card_id for card_id, _ in card_ids]
+
+    # Registrar los IDs para que update_metabase_dashboard.py no tenga que buscarlos
+    state = StateStore()
+    state.set("dashboard_id", dashboard_id)
+    state.set("database_id", db_id)
+    state.set("collection_id", collection_id)
+    state.set("model_id", model_id)
+    try:
+        state.save()
+        ok(f"IDs registrados en el estado local: {state.path}")
+    except OSError as e:
+        warn(f"No se pudo guardar el estado local en {state.path}: {e}")
 
     # ── Resultado final ────────────────────────────────────────────────────
     dashboard_url = f"{METABASE_URL}/dashboard/{dashboard_id}"
 
     print(f"\n{BOLD}{'═' * 60}{RESET}")
-    print(f"{GREEN}{BOLD}  ✓ Dashboard creado exitosamente{RESET}")
+    status = "reconciliado" if existing_dash else "creado"
+    print(f"{GREEN}{BOLD}  ✓ Dashboard {status} exitosamente{RESET}")
     print(f"{BOLD}{'═' * 60}{RESET}")
     print(f"\n  {BOLD}URL del dashboard:{RESET}")
     print(f"  {BLUE}{dashboard_url}{RESET}")
-    print(f"\n  {BOLD}Cards creadas:{RESET} {len(all_card_ids)}/{len(cards_def)}")
+    print(f"\n  {BOLD}Cards en el dashboard:{RESET} {len(all_card_ids)}/{len(cards_def)}")
+    if stats:
+        print(f"  {BOLD}Reconciliación:{RESET} {stats['created']} creadas, "
+              f"{stats['updated']} actualizadas, {stats['unchanged']} sin cambios")
     print(f"  {BOLD}Dashboard ID:{RESET} {dashboard_id}")
     print(f"  {BOLD}Base de datos ID:{RESET} {db_id}")
     print(f"\n  {YELLOW}Próximos pasos:{RESET}")
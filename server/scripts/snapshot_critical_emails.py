@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+snapshot_critical_emails.py
+───────────────────────────────────────────────────────────────────────────────
+Ejecuta el SQL de las cards del dashboard (get_cards_definition() de
+setup_metabase_dashboard.py) directamente en una read replica de MySQL y
+guarda cada resultado en la tabla critical_email_card_snapshot del primario.
+
+Sirve para los trabajos que solo validan o precalculan resultados y no
+necesitan el procesador de queries de Metabase: las queries pesadas no pasan
+por Metabase ni cargan el primario, y Metabase queda solo para mostrar.
+
+En cada ejecución:
+  1. Renderiza el SQL de cada card para cada período pedido: {{periodo_dias}}
+     y las demás variables van como parámetros de pymysql (nunca como texto)
+     y las cláusulas [[ ... ]] sin valor se omiten, igual que en Metabase.
+  2. Ejecuta las queries en paralelo sobre un pool de conexiones a la réplica
+     (DB_REPLICA_*), con un plazo por query.
+  3. Reemplaza el snapshot de cada (card, período) en una transacción en el
+     primario (DB_WRITE_*). Cada fila del resultado se guarda como un objeto
+     JSON columna → valor; Metabase puede desplegar las columnas JSON al
+     mostrar la tabla. critical_email_card_snapshot_state guarda filas,
+     duración y hash del SQL de cada snapshot.
+
+Un lock con nombre (GET_LOCK) evita que dos ejecuciones se pisen. Las cards
+sobre el modelo base (--model en setup) hacen referencia a otra card
+({{#id-modelo}}) y solo se pueden ejecutar en Metabase.
+
+Uso:
+  pip install pymysql
+  python snapshot_critical_emails.py                       # Período por defecto (7 días)
+  python snapshot_critical_emails.py --periods 7,30,90     # Varios períodos
+  python snapshot_critical_emails.py --source rollup --cards 1,2,3
+  python snapshot_critical_emails.py --dry-run             # Solo validar en la réplica
+  python update_metabase_dashboard.py --direct             # Mismo proceso dentro del update
+
+Variables de entorno: ver metabase_mysql.py (DB_*, DB_WRITE_*, DB_REPLICA_*, DB_POOL_SIZE).
+  SNAPSHOT_QUERY_TIMEOUT  Plazo por query en la réplica, en segundos (default: 300)
+
+Autor: ImagineCRM Automation
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Dict, Optional
+
+# ── Carga de variables de entorno ──────────────────────────────────────────
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass  # python-dotenv opcional; se pueden pasar las vars directamente
+
+from metabase_mysql import ConnectionPool, POOL_SIZE, connect, render_native_query
+from setup_metabase_dashboard import CARD_SOURCE, PERIOD_FILTER, get_cards_definition
+
+# ── Configuración ──────────────────────────────────────────────────────────
+SNAPSHOT_TABLE = "critical_email_card_snapshot"
+STATE_TABLE    = "critical_email_card_snapshot_state"
+LOCK_NAME      = "imaginecrm_critical_email_snapshot"
+QUERY_TIMEOUT  = int(os.getenv("SNAPSHOT_QUERY_TIMEOUT", "300"))
+INSERT_BATCH   = 500   # Filas por INSERT multi-valor
+
+DDL = [
+    f"""
+    CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE} (
+        cardKey     VARCHAR(100) NOT NULL,
+        periodoDias INT          NOT NULL,
+        rowNum      INT UNSIGNED NOT NULL,
+        data        JSON         NOT NULL,
+        capturedAt  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (cardKey, periodoDias, rowNum)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+        cardKey     VARCHAR(100) NOT NULL,
+        periodoDias INT          NOT NULL,
+        cardName    VARCHAR(255) NOT NULL,
+        rowCount    INT UNSIGNED NOT NULL,
+        durationMs  INT UNSIGNED NOT NULL,
+        sqlHash     CHAR(64)     NOT NULL,
+        capturedAt  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (cardKey, periodoDias)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """,
+]
+
+# ── Logging ────────────────────────────────────────────────────────────────
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+log = logging.getLogger("metabase_snapshot")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# EJECUCIÓN EN LA RÉPLICA
+# ══════════════════════════════════════════════════════════════════════════════
+
+def card_key(name: str) -> str:
+    """Clave estable de una card a partir de su nombre: '📊 Resumen Ejecutivo' → 'resumen-ejecutivo'."""
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "-", ascii_name.lower()).strip("-")[:100]
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def run_card(pool: ConnectionPool, card: Dict, periodo_dias: int) -> Dict:
+    """Ejecuta una card en la réplica y retorna su resultado (o el error) con la duración."""
+    entry = {"card_id": card_key(card["name"]), "name": card["name"],
+             "periodo_dias": periodo_dias, "status": "error"}
+    start = time.monotonic()
+    try:
+        sql, args = render_native_query(card["sql"], {"periodo_dias": periodo_dias})
+        with pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, args)
+            columns = [c[0] for c in cur.description or ()]
+            rows = cur.fetchall()
+    except Exception as e:
+        entry["elapsed"] = round(time.monotonic() - start, 2)
+        entry["error"] = str(e)[:200]
+        log.warning(f"  {card['name'][:50]} ({periodo_dias}d): error en la réplica: {entry['error']}")
+        return entry
+    entry.update({
+        "status": "ok", "rows": len(rows), "columns": columns, "result": rows,
+        "elapsed": round(time.monotonic() - start, 2),
+        "sql_hash": hashlib.sha256(card["sql"].encode("utf-8")).hexdigest(),
+    })
+    log.info(f"  {card['name'][:50]} ({periodo_dias}d): {len(rows)} filas ({entry['elapsed']}s)")
+    return entry
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ESCRITURA EN EL PRIMARIO
+# ══════════════════════════════════════════════════════════════════════════════
+
+def ensure_tables(conn) -> None:
+    with conn.cursor() as cur:
+        for statement in DDL:
+            cur.execute(statement)
+    conn.commit()
+
+
+def write_snapshot(conn, entry: Dict) -> None:
+    """Reemplaza el snapshot de (card, período) en una sola transacción."""
+    key, periodo = entry["card_id"], entry["periodo_dias"]
+    records = [
+        (key, periodo, num, json.dumps(dict(zip(entry["columns"], map(_json_value, row))),
+                                       ensure_ascii=False))
+        for num, row in enumerate(entry["result"], start=1)
+    ]
+    with conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {SNAPSHOT_TABLE} WHERE cardKey = %s AND periodoDias = %s",
+                    (key, periodo))
+        for i in range(0, len(records), INSERT_BATCH):
+            cur.executemany(
+                f"INSERT INTO {SNAPSHOT_TABLE} (cardKey, periodoDias, rowNum, data) "
+                f"VALUES (%s, %s, %s, %s)",
+                records[i:i + INSERT_BATCH]
+            )
+        cur.execute(
+            f"INSERT INTO {STATE_TABLE} (cardKey, periodoDias, cardName, rowCount, durationMs, sqlHash) "
+            f"VALUES (%s, %s, %s, %s, %s, %s) "
+            f"ON DUPLICATE KEY UPDATE cardName = VALUES(cardName), rowCount = VALUES(rowCount), "
+            f"durationMs = VALUES(durationMs), sqlHash = VALUES(sqlHash), capturedAt = NOW()",
+            (key, periodo, entry["name"][:255], entry["rows"], int(entry["elapsed"] * 1000),
+             entry["sql_hash"])
+        )
+    conn.commit()
+
+
+def write_snapshots(entries: List[Dict]) -> None:
+    """Guarda los resultados en el primario, bajo el lock con nombre."""
+    writer = connect(write=True, autocommit=False)
+    try:
+        if not acquire_lock(writer):
+            raise RuntimeError("otra ejecución del snapshot está escribiendo")
+        ensure_tables(writer)
+        for entry in entries:
+            try:
+                write_snapshot(writer, entry)
+            except Exception as e:
+                writer.rollback()
+                entry["status"], entry["error"] = "error", str(e)[:200]
+                log.warning(f"  {entry['name'][:50]} ({entry['periodo_dias']}d): "
+                            f"no se pudo guardar el snapshot: {entry['error']}")
+    finally:
+        writer.close()
+
+
+def acquire_lock(conn) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+        return cur.fetchone()[0] == 1
+
+
+def select_cards(source: str = CARD_SOURCE, indexes: Optional[List[int]] = None) -> List[Dict]:
+    """Cards de get_cards_definition() a ejecutar (índices desde 1, como en el dashboard)."""
+    cards = get_cards_definition(source)
+    if indexes:
+        cards = [cards[i - 1] for i in indexes if 1 <= i <= len(cards)]
+    return cards
+
+
+def run_snapshots(cards: List[Dict], periods: List[int], concurrency: int = POOL_SIZE,
+                  dry_run: bool = False) -> List[Dict]:
+    """
+    Ejecuta cada (card, período) en la réplica con hasta `concurrency` queries
+    simultáneas y escribe los resultados en el primario (salvo dry_run).
+    Retorna una entrada por ejecución, sin las filas del resultado.
+    """
+    jobs = [(card, periodo) for card in cards for periodo in periods]
+    with ConnectionPool(concurrency, replica=True, read_timeout=QUERY_TIMEOUT) as pool:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            entries = list(executor.map(lambda job: run_card(pool, *job), jobs))
+        log.info(f"Réplica: {len(jobs)} queries con {pool.created} conexiones")
+
+    pending = [entry for entry in entries if entry["status"] == "ok"]
+    if pending and not dry_run:
+        try:
+            write_snapshots(pending)
+        except Exception as e:
+            # Sin escritura los resultados no llegan al dashboard: cuentan como error
+            log.error(f"No se pudieron guardar los snapshots en el primario: {e}")
+            for entry in pending:
+                entry["status"], entry["error"] = "error", str(e)[:200]
+
+    for entry in entries:
+        entry.pop("result", None)
+        entry.pop("columns", None)
+    return entries
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FUNCIÓN PRINCIPAL
+# ══════════════════════════════════════════════════════════════════════════════
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Ejecuta las cards del dashboard en la réplica y guarda {SNAPSHOT_TABLE}"
+    )
+    parser.add_argument("--periods", type=parse_int_list, default=[int(PERIOD_FILTER["default"])],
+                        help=f"Períodos en días, separados por coma (default: {PERIOD_FILTER['default']})")
+    parser.add_argument("--source", choices=("raw", "rollup"), default=CARD_SOURCE,
+                        help=f"Variante del SQL de las cards (default: {CARD_SOURCE})")
+    parser.add_argument("--cards", type=parse_int_list, default=None,
+                        help="Solo estas cards, por posición en el dashboard (p. ej. 1,2,3)")
+    parser.add_argument("--concurrency", type=int, default=POOL_SIZE,
+                        help=f"Queries simultáneas y tamaño del pool (default: {POOL_SIZE})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Ejecutar en la réplica sin escribir los snapshots")
+    args = parser.parse_args()
+
+    log.info("=" * 60)
+    log.info(f"ImagineCRM — Snapshot de cards en la réplica ({SNAPSHOT_TABLE})")
+    log.info("=" * 60)
+    start = time.time()
+
+    cards = select_cards(args.source, args.cards)
+    try:
+        entries = run_snapshots(cards, args.periods, args.concurrency, args.dry_run)
+    except Exception as e:
+        log.error(f"Error durante el snapshot: {e}")
+        sys.exit(1)
+
+    errors = sum(1 for e in entries if e["status"] != "ok")
+    log.info("=" * 60)
+    log.info(f"Snapshots: {len(entries) - errors} correctos, {errors} con errores"
+             f"{' (sin escribir: --dry-run)' if args.dry_run else ''}")
+    log.info(f"Tiempo total: {time.time() - start:.1f}s")
+    log.info("=" * 60)
+    sys.exit(2 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
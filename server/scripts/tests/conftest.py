@@ -0,0 +1,13 @@
+"""
+Configuración de pytest para los scripts de Metabase.
+
+Los scripts no son un paquete: se importan como módulos sueltos desde
+server/scripts, igual que cuando se ejecutan con `python script.py`.
+
+  cd server/scripts && python -m pytest -q tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
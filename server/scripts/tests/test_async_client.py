@@ -0,0 +1,91 @@
+"""Tests del cliente asíncrono contra un servidor aiohttp local."""
+
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+import metabase_async_client  # noqa: E402
+from metabase_async_client import AsyncMetabaseClient  # noqa: E402
+from metabase_metrics import HTTP_REQUESTS, HTTP_RETRIES  # noqa: E402
+
+
+def counter(metric, **labels):
+    return metric._values.get(metric._key(labels), 0.0)
+
+
+def run_with_server(routes, scenario):
+    """Levanta un servidor con `routes`, ejecuta scenario(client) y retorna su resultado."""
+    async def main():
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with AsyncMetabaseClient(f"http://127.0.0.1:{port}") as client:
+                return await scenario(client)
+        finally:
+            await runner.cleanup()
+    return asyncio.run(main())
+
+
+def test_requests_and_rate_limit_retries_are_counted(monkeypatch):
+    monkeypatch.setattr(metabase_async_client, "RETRY_DELAY_SEC", 0)
+    calls = []
+
+    async def dashboard(request):
+        calls.append(1)
+        if len(calls) == 1:
+            return web.json_response({}, status=429, headers={"Retry-After": "0"})
+        return web.json_response({"id": 1})
+
+    before_ok = counter(HTTP_REQUESTS, method="GET", status=200)
+    before_429 = counter(HTTP_REQUESTS, method="GET", status=429)
+    before_retry = counter(HTTP_RETRIES, reason="rate_limit")
+    r = run_with_server([web.get("/api/dashboard/1", dashboard)],
+                        lambda client: client._get("/api/dashboard/1"))
+    assert r.status_code == 200
+    assert counter(HTTP_REQUESTS, method="GET", status=200) == before_ok + 1
+    assert counter(HTTP_REQUESTS, method="GET", status=429) == before_429 + 1
+    assert counter(HTTP_RETRIES, reason="rate_limit") == before_retry + 1
+
+
+def test_timed_out_card_query_is_not_resent(monkeypatch):
+    monkeypatch.setattr(metabase_async_client, "RETRY_DELAY_SEC", 0)
+    monkeypatch.setattr(metabase_async_client, "REQUEST_TIMEOUT", 0.2)
+    calls = []
+
+    async def query(request):
+        calls.append(1)
+        await asyncio.sleep(1)
+        return web.json_response({"data": {"rows": []}})
+
+    before_retry = counter(HTTP_RETRIES, reason="timeout")
+    result = run_with_server([web.post("/api/card/7/query", query)],
+                             lambda client: client.execute_card(7))
+    assert result["status"] == "timeout"
+    assert calls == [1]
+    assert counter(HTTP_RETRIES, reason="timeout") == before_retry
+
+
+def test_timed_out_get_is_retried(monkeypatch):
+    monkeypatch.setattr(metabase_async_client, "RETRY_DELAY_SEC", 0)
+    calls = []
+
+    async def dashboard(request):
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return web.json_response({"id": 1})
+
+    r = run_with_server(
+        [web.get("/api/dashboard/1", dashboard)],
+        lambda client: client._get("/api/dashboard/1",
+                                   timeout=aiohttp.ClientTimeout(sock_read=0.2)))
+    assert r.status_code == 200
+    assert len(calls) == 2
@@ -0,0 +1,72 @@
+"""Tests de setup_metabase_dashboard.build_dashboard_layout (PUT único del layout)."""
+
+from setup_metabase_dashboard import LAYOUT_KEYS, PERIOD_FILTER, build_dashboard_layout
+
+LAYOUT_A = {"row": 0, "col": 0, "size_x": 12, "size_y": 4}
+LAYOUT_B = {"row": 4, "col": 0, "size_x": 24, "size_y": 6}
+
+
+def mapping(card_id, f=PERIOD_FILTER):
+    return {"parameter_id": f["id"], "card_id": card_id,
+            "target": ["variable", ["template-tag", f["slug"]]]}
+
+
+def existing(dc_id, card_id, layout, mappings=None, viz=None):
+    return {"id": dc_id, "card_id": card_id, **layout,
+            "parameter_mappings": mappings if mappings is not None else [mapping(card_id)],
+            "visualization_settings": viz or {}}
+
+
+def test_new_dashcards_get_distinct_negative_ids():
+    dashcards, changed = build_dashboard_layout([(10, LAYOUT_A), (11, LAYOUT_B)], [])
+    assert changed
+    assert [dc["id"] for dc in dashcards] == [-1, -2]
+    assert [dc["card_id"] for dc in dashcards] == [10, 11]
+    assert {k: dashcards[1][k] for k in LAYOUT_KEYS} == LAYOUT_B
+
+
+def test_period_filter_is_mapped_on_every_card():
+    dashcards, _ = build_dashboard_layout([(10, LAYOUT_A), (11, LAYOUT_B)], [])
+    assert dashcards[0]["parameter_mappings"] == [mapping(10)]
+    assert dashcards[1]["parameter_mappings"] == [mapping(11)]
+
+
+def test_existing_dashcard_keeps_id_and_settings():
+    current = [existing(7, 10, LAYOUT_A, viz={"graph.dimensions": ["dia"]})]
+    dashcards, changed = build_dashboard_layout([(10, LAYOUT_A), (11, LAYOUT_B)], current)
+    assert changed  # La card 11 es nueva
+    assert dashcards[0]["id"] == 7
+    assert dashcards[0]["visualization_settings"] == {"graph.dimensions": ["dia"]}
+    # El ID negativo sale de la posición de la card, no del número de cards nuevas
+    assert dashcards[1]["id"] == -2
+
+
+def test_unchanged_layout_reports_no_change():
+    current = [existing(7, 10, LAYOUT_A), existing(8, 11, LAYOUT_B)]
+    dashcards, changed = build_dashboard_layout([(10, LAYOUT_A), (11, LAYOUT_B)], current)
+    assert not changed
+    assert [dc["id"] for dc in dashcards] == [7, 8]
+
+
+def test_moved_card_or_missing_mapping_is_a_change():
+    moved = [existing(7, 10, {**LAYOUT_A, "row": 2})]
+    assert build_dashboard_layout([(10, LAYOUT_A)], moved)[1]
+    unmapped = [existing(7, 10, LAYOUT_A, mappings=[])]
+    assert build_dashboard_layout([(10, LAYOUT_A)], unmapped)[1]
+
+
+def test_foreign_dashcards_are_kept_untouched():
+    text_card = {"id": 3, "card_id": None, "row": 20, "col": 0, "size_x": 24, "size_y": 2,
+                 "visualization_settings": {"text": "Notas"}}
+    other = existing(4, 99, LAYOUT_B)
+    dashcards, _ = build_dashboard_layout([(10, LAYOUT_A)], [text_card, other])
+    assert dashcards[0] is text_card
+    assert dashcards[1] is other
+    assert dashcards[2]["card_id"] == 10
+
+
+def test_extra_filters_are_mapped_to_their_slug():
+    tenant = {"id": "tenant_filter", "slug": "tenant_id"}
+    dashcards, _ = build_dashboard_layout([(10, LAYOUT_A)], [],
+                                          filters=(PERIOD_FILTER, tenant))
+    assert dashcards[0]["parameter_mappings"] == [mapping(10), mapping(10, tenant)]
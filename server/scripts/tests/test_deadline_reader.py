@@ -0,0 +1,75 @@
+"""Tests del corte por plazo al leer el resultado de una card (update_metabase_dashboard)."""
+
+import io
+
+import pytest
+
+import update_metabase_dashboard
+from update_metabase_dashboard import QueryDeadlineExceeded, _DeadlineReader
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class KeepaliveStream:
+    """Stream sin read1(): cada keepalive tarda un segundo y read(n) no retorna antes de n bytes."""
+
+    def __init__(self, clock, keepalives, body=b'{"status": "completed"}'):
+        self.clock = clock
+        self.data = io.BytesIO(b"\n" * keepalives + body)
+        self.keepalives = keepalives
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        chunk = self.data.read(size)
+        # Tiempo que pasa esperando keepalives dentro de esta lectura
+        self.clock.now += min(chunk.count(b"\n"), self.keepalives)
+        return chunk
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(update_metabase_dashboard.time, "monotonic", c)
+    return c
+
+
+def test_deadline_enforced_without_read1(clock):
+    reader = _DeadlineReader(KeepaliveStream(clock, keepalives=100), deadline=5.0)
+    with pytest.raises(QueryDeadlineExceeded):
+        while reader.read(64 * 1024):
+            pass
+    assert clock.now <= 6.0  # Como mucho un keepalive después del plazo
+
+
+def test_body_is_read_in_blocks_after_keepalives(clock):
+    stream = KeepaliveStream(clock, keepalives=3)
+    reader = _DeadlineReader(stream, deadline=60.0)
+    data = b""
+    while True:
+        chunk = reader.read(64 * 1024)
+        if not chunk:
+            break
+        data += chunk
+    assert data == b'{"status": "completed"}'
+    assert stream.reads[:4] == [1, 1, 1, 1]
+    assert stream.reads[4:] == [64 * 1024, 64 * 1024]
+
+
+def test_read1_is_preferred(clock):
+    class Raw:
+        def read1(self, size=-1):
+            return b"x"
+
+        def read(self, size=-1):
+            raise AssertionError("read() bloqueante con read1() disponible")
+    assert _DeadlineReader(Raw(), deadline=1.0).read(10) == b"x"
+    clock.now = 2.0
+    with pytest.raises(QueryDeadlineExceeded):
+        _DeadlineReader(Raw(), deadline=1.0).read(10)
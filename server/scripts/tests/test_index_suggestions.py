@@ -0,0 +1,87 @@
+"""Tests del análisis de índices de setup_metabase_dashboard (EXPLAIN → CREATE INDEX)."""
+
+from setup_metabase_dashboard import (explain_flags, explain_tables, index_ddl,
+                                      merge_suggestions, suggest_index, table_aliases)
+
+SQL_LOG = """
+SELECT DATE(log.sentAt) AS dia, log.emailType, SUM(log.success = 1) AS ok
+FROM critical_email_log log
+WHERE log.sentAt >= DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY)
+GROUP BY dia, log.emailType
+"""
+
+
+def test_table_aliases_skip_keywords():
+    aliases = table_aliases("SELECT 1 FROM critical_email_log WHERE 1 = 1")
+    assert aliases == {"critical_email_log": "critical_email_log"}
+    assert table_aliases(SQL_LOG) == {"critical_email_log": "critical_email_log",
+                                      "log": "critical_email_log"}
+
+
+def test_full_scan_suggests_date_first_index():
+    table = {"table_name": "log", "access_type": "ALL"}
+    assert suggest_index(table, SQL_LOG) == (
+        "critical_email_log", ("sentAt", "emailType", "success"))
+
+
+def test_covering_index_needs_no_suggestion():
+    table = {"table_name": "log", "access_type": "range", "using_index": True,
+             "used_key_parts": ["sentAt"]}
+    assert suggest_index(table, SQL_LOG) is None
+
+
+def test_range_without_covering_index_suggests():
+    table = {"table_name": "log", "access_type": "range", "used_key_parts": ["sentAt"]}
+    assert suggest_index(table, SQL_LOG) == (
+        "critical_email_log", ("sentAt", "emailType", "success"))
+
+
+def test_index_already_matching_is_not_suggested():
+    table = {"table_name": "log", "access_type": "ALL",
+             "used_key_parts": ["sentAt", "emailType", "success", "tenantId"]}
+    assert suggest_index(table, SQL_LOG) is None
+
+
+def test_without_date_column_nothing_is_suggested():
+    sql = "SELECT emailType, COUNT(*) FROM critical_email_log GROUP BY emailType"
+    assert suggest_index({"table_name": "critical_email_log", "access_type": "ALL"}, sql) is None
+
+
+def test_unknown_table_is_ignored():
+    assert suggest_index({"table_name": "tenants", "access_type": "ALL"},
+                         "SELECT * FROM tenants") is None
+
+
+def test_merge_drops_prefixes_and_duplicates():
+    short = ("critical_email_log", ("sentAt",))
+    mid = ("critical_email_log", ("sentAt", "emailType"))
+    full = ("critical_email_log", ("sentAt", "emailType", "success"))
+    daily = ("critical_email_daily", ("day",))
+    assert merge_suggestions([short, full, mid, full, daily]) == [full, daily]
+
+
+def test_merge_keeps_non_prefix_indexes():
+    a = ("critical_email_log", ("sentAt", "success"))
+    b = ("critical_email_log", ("sentAt", "emailType"))
+    assert merge_suggestions([a, b]) == [a, b]
+
+
+def test_merge_is_per_table():
+    a = ("critical_email_daily", ("day",))
+    b = ("critical_email_log", ("day", "tenantId"))
+    assert merge_suggestions([a, b]) == [a, b]
+
+
+def test_index_ddl():
+    assert index_ddl(("critical_email_daily", ("day", "tenantId"))) == (
+        "CREATE INDEX idx_critical_email_daily_day_tenantId "
+        "ON critical_email_daily (day, tenantId);")
+
+
+def test_explain_plan_walk():
+    plan = {"query_block": {"grouping_operation": {
+        "using_temporary_table": True,
+        "nested_loop": [{"table": {"table_name": "log", "access_type": "ALL"}},
+                        {"table": {"table_name": "t", "access_type": "eq_ref"}}]}}}
+    assert [t["table_name"] for t in explain_tables(plan)] == ["log", "t"]
+    assert explain_flags(plan) == {"using_temporary_table"}
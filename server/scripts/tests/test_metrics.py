@@ -0,0 +1,79 @@
+"""Tests de metabase_metrics (formato de texto de Prometheus y escritura del .prom)."""
+
+import os
+import stat
+import threading
+import urllib.request
+
+from metabase_metrics import MetricsRegistry
+
+
+def make_registry():
+    registry = MetricsRegistry()
+    requests = registry.counter("metabase_http_requests_total", "Requests", ("method", "status"))
+    seconds = registry.histogram("metabase_card_seconds", "Duración", ("card_id",),
+                                 buckets=(1.0, 5.0))
+    requests.inc(method="GET", status=200)
+    requests.inc(method="GET", status=200)
+    seconds.observe(0.5, card_id=3)
+    seconds.observe(4.0, card_id=3)
+    return registry
+
+
+def test_render_counter_and_histogram():
+    text = make_registry().render()
+    assert '# TYPE metabase_http_requests_total counter' in text
+    assert 'metabase_http_requests_total{method="GET",status="200"} 2.0' in text
+    assert 'metabase_card_seconds_bucket{card_id="3",le="1.0"} 1' in text
+    assert 'metabase_card_seconds_bucket{card_id="3",le="5.0"} 2' in text
+    assert 'metabase_card_seconds_bucket{card_id="3",le="+Inf"} 2' in text
+    assert 'metabase_card_seconds_sum{card_id="3"} 4.5' in text
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.gauge("g", "G", ("name",)).set(1, name='a "b"\\n')
+    assert 'g{name="a \\"b\\"\\\\n"} 1' in registry.render()
+
+
+def test_textfile_is_readable_by_node_exporter(tmp_path):
+    path = tmp_path / "metabase.prom"
+    make_registry().write_textfile(str(path))
+    assert "metabase_http_requests_total" in path.read_text()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(tmp_path) == ["metabase.prom"]
+
+
+def test_concurrent_writes_from_threads(tmp_path):
+    path = str(tmp_path / "metabase.prom")
+    registry = make_registry()
+    errors = []
+
+    def write():
+        try:
+            for _ in range(50):
+                registry.write_textfile(path)
+        except Exception as e:  # pragma: no cover - el test falla con el detalle
+            errors.append(e)
+    threads = [threading.Thread(target=write) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == registry.render()
+    assert os.listdir(tmp_path) == ["metabase.prom"]
+
+
+def test_serve_binds_loopback_by_default():
+    registry = make_registry()
+    server = registry.serve(0)
+    try:
+        host, port = server.server_address
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+            assert b"metabase_http_requests_total" in r.read()
+    finally:
+        server.shutdown()
+        server.server_close()
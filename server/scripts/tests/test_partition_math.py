@@ -0,0 +1,140 @@
+"""Tests de los límites de partición de partition_critical_emails (meses, poda, retención)."""
+
+from datetime import date, datetime
+
+import pytest
+
+from partition_critical_emails import (FIRST_PARTITION, LAST_PARTITION, add_months,
+                                       ensure_future_partitions, expected_partitions,
+                                       expire_partitions, month_definitions, month_range,
+                                       partition_month, partition_name)
+
+TODAY = date(2026, 10, 17)
+
+
+class StubCursor:
+    """Cursor que responde las consultas de information_schema y CURDATE() con datos fijos."""
+
+    def __init__(self, partitions, data_type="datetime"):
+        self.partitions = list(partitions)
+        self.data_type  = data_type
+        self.executed   = []
+        self._result    = []
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+        if "information_schema.PARTITIONS" in sql:
+            self._result = [(p,) for p in self.partitions]
+        elif "CURDATE()" in sql:
+            self._result = [(TODAY,)]
+        elif "information_schema.COLUMNS" in sql:
+            self._result = [(self.data_type,)]
+        else:
+            self._result = []
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class StubConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def months(*names):
+    return [FIRST_PARTITION, *names, LAST_PARTITION]
+
+
+@pytest.mark.parametrize("month, n, expected", [
+    (date(2026, 10, 1), 3, date(2027, 1, 1)),
+    (date(2026, 1, 1), -1, date(2025, 12, 1)),
+    (date(2026, 12, 1), 1, date(2027, 1, 1)),
+    (date(2026, 10, 1), -22, date(2024, 12, 1)),
+    (date(2026, 10, 1), 0, date(2026, 10, 1)),
+])
+def test_add_months(month, n, expected):
+    assert add_months(month, n) == expected
+
+
+def test_partition_names_roundtrip():
+    assert partition_name(date(2026, 1, 1)) == "p2026_01"
+    assert partition_month("p2026_01") == date(2026, 1, 1)
+    assert partition_month(FIRST_PARTITION) is None
+    assert partition_month(LAST_PARTITION) is None
+
+
+def test_month_range_is_inclusive_and_crosses_years():
+    assert month_range(date(2026, 11, 1), date(2027, 2, 1)) == [
+        date(2026, 11, 1), date(2026, 12, 1), date(2027, 1, 1), date(2027, 2, 1)]
+    assert month_range(date(2026, 10, 1), date(2026, 10, 1)) == [date(2026, 10, 1)]
+    assert month_range(date(2026, 11, 1), date(2026, 10, 1)) == []
+
+
+def test_month_definitions_use_next_month_as_upper_bound():
+    assert month_definitions([date(2026, 12, 1)], "datetime") == [
+        "PARTITION p2026_12 VALUES LESS THAN ('2027-01-01')"]
+    assert month_definitions([date(2026, 12, 1)], "timestamp") == [
+        "PARTITION p2026_12 VALUES LESS THAN (UNIX_TIMESTAMP('2027-01-01 00:00:00'))"]
+
+
+def test_expected_partitions_window_inside_month():
+    partitions = months("p2026_08", "p2026_09", "p2026_10", "p2026_11")
+    # 7 días desde el 17 de octubre: solo el mes actual (y los extremos tolerados)
+    assert expected_partitions(partitions, datetime(2026, 10, 10, 8, 30)) == {
+        FIRST_PARTITION, "p2026_10", "p2026_11", LAST_PARTITION}
+
+
+def test_expected_partitions_window_starting_on_boundary():
+    partitions = months("p2026_08", "p2026_09", "p2026_10")
+    # Un inicio exactamente en el límite no incluye el mes anterior
+    assert expected_partitions(partitions, datetime(2026, 10, 1)) == {
+        FIRST_PARTITION, "p2026_10", LAST_PARTITION}
+    # Un segundo antes del límite sí
+    assert expected_partitions(partitions, datetime(2026, 9, 30, 23, 59, 59)) == {
+        FIRST_PARTITION, "p2026_09", "p2026_10", LAST_PARTITION}
+
+
+def test_expected_partitions_only_reports_existing():
+    assert expected_partitions(["p2026_10"], datetime(2026, 1, 1)) == {"p2026_10"}
+
+
+def test_expire_cutoff_keeps_full_retention_months():
+    cur = StubCursor(months("p2025_12", "p2026_06", "p2026_07", "p2026_08", "p2026_10"))
+    expired = expire_partitions(StubConnection(cur), retention_months=3, dry_run=True)
+    # Se conservan julio, agosto y septiembre completos más octubre (el actual)
+    assert expired == ["p2025_12", "p2026_06"]
+    assert not any(sql.startswith("ALTER") for sql in cur.executed)  # dry_run
+
+
+def test_expire_with_zero_retention_keeps_current_month():
+    cur = StubCursor(months("p2026_09", "p2026_10"))
+    assert expire_partitions(StubConnection(cur), retention_months=0, dry_run=True) == [
+        "p2026_09"]
+
+
+def test_expire_nothing_to_do():
+    cur = StubCursor(months("p2026_10"))
+    assert expire_partitions(StubConnection(cur), retention_months=12, dry_run=True) == []
+
+
+def test_future_partitions_fill_the_gap_up_to_months_ahead():
+    cur = StubCursor(months("p2026_09", "p2026_10"))
+    created = ensure_future_partitions(StubConnection(cur), months_ahead=3, dry_run=True)
+    assert created == ["p2026_11", "p2026_12", "p2027_01"]
+
+
+def test_future_partitions_already_present():
+    cur = StubCursor(months("p2026_10", "p2026_11", "p2026_12", "p2027_01"))
+    assert ensure_future_partitions(StubConnection(cur), months_ahead=3, dry_run=True) == []
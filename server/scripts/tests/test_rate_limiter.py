@@ -0,0 +1,97 @@
+"""Tests de metabase_ratelimit.AdaptiveRateLimiter (token bucket con tasa AIMD)."""
+
+import pytest
+
+import metabase_ratelimit
+from metabase_ratelimit import (AdaptiveRateLimiter, RATE_DECREASE, endpoint_key,
+                                parse_retry_after)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(metabase_ratelimit.time, "monotonic", c)
+    return c
+
+
+def test_endpoint_key_normalizes_ids():
+    assert endpoint_key("POST", "/api/card/12/query?x=1") == "POST /api/card/{id}/query"
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Sat, 17 Oct 2026 10:00:00 GMT") is None
+
+
+def test_bucket_allows_burst_then_spaces_requests(clock):
+    limiter = AdaptiveRateLimiter(rate=10, burst=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1)
+    clock.now += 1.0
+    assert limiter.reserve() == 0
+
+
+def test_slow_start_adds_one_per_response(clock):
+    limiter = AdaptiveRateLimiter(rate=10, max_rate=12)
+    for _ in range(5):
+        limiter.record("GET /api/card", 200, 0.01)
+    assert limiter.rate == 12
+
+
+def test_throttle_halves_rate_and_pauses(clock):
+    limiter = AdaptiveRateLimiter(rate=10, burst=5)
+    limiter.record("GET /api/card", 429, 0.01, retry_after="3")
+    assert limiter.rate == 10 * RATE_DECREASE
+    assert limiter.throttled == 1
+    assert limiter.reserve() == pytest.approx(3.0)
+
+
+def test_decrease_has_cooldown_and_floor(clock):
+    limiter = AdaptiveRateLimiter(rate=4, min_rate=1.5)
+    limiter.record("k", 503, 0.01)
+    limiter.record("k", 503, 0.01)  # Misma ráfaga: no vuelve a bajar
+    assert limiter.rate == 2
+    clock.now += 2
+    limiter.record("k", 503, 0.01)
+    assert limiter.rate == 1.5
+
+
+def test_additive_increase_after_congestion(clock):
+    limiter = AdaptiveRateLimiter(rate=8)
+    limiter.record("k", 429, 0.01)
+    assert limiter.rate == 4
+    limiter.record("k", 200, 0.01)
+    assert limiter.rate == pytest.approx(4.25)  # +1/rate, ya sin arranque lento
+
+
+def test_latency_spike_is_a_congestion_signal(clock):
+    limiter = AdaptiveRateLimiter(rate=10)
+    limiter.record("POST /api/card/{id}/query", 200, 0.4)
+    rate = limiter.rate
+    limiter.record("POST /api/card/{id}/query", 200, 2.0)
+    assert limiter.rate == pytest.approx(rate * metabase_ratelimit.LATENCY_DECREASE)
+
+
+def test_latency_is_compared_per_endpoint(clock):
+    limiter = AdaptiveRateLimiter(rate=10)
+    limiter.record("GET /api/card", 200, 0.01)
+    rate = limiter.rate
+    limiter.record("POST /api/card/{id}/query", 200, 3.0)  # Primera muestra del endpoint
+    assert limiter.rate > rate
+
+
+def test_network_error_does_not_change_rate(clock):
+    limiter = AdaptiveRateLimiter(rate=10)
+    limiter.record("k", None, 0.0)
+    assert limiter.rate == 10
@@ -0,0 +1,83 @@
+"""Tests de metabase_mysql.render_native_query (SQL de cards → SQL de pymysql)."""
+
+import pytest
+
+from metabase_mysql import render_native_query
+
+
+def test_variable_becomes_placeholder():
+    sql, args = render_native_query(
+        "SELECT * FROM critical_email_log "
+        "WHERE sentAt >= DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY)",
+        {"periodo_dias": 30})
+    assert "%(periodo_dias)s" in sql
+    assert "{{" not in sql
+    assert args == {"periodo_dias": 30}
+
+
+def test_value_is_never_interpolated():
+    sql, args = render_native_query("SELECT {{x}}", {"x": "1; DROP TABLE tenants"})
+    assert "DROP" not in sql
+    assert args == {"x": "1; DROP TABLE tenants"}
+
+
+def test_spaces_inside_braces():
+    sql, _ = render_native_query("SELECT {{ periodo_dias }}", {"periodo_dias": 7})
+    assert sql == "SELECT %(periodo_dias)s"
+
+
+def test_optional_clause_kept_with_value():
+    sql, args = render_native_query(
+        "SELECT 1 FROM t WHERE 1 = 1 [[AND tenantId = {{tenant_id}}]]", {"tenant_id": 42})
+    assert sql == "SELECT 1 FROM t WHERE 1 = 1 AND tenantId = %(tenant_id)s"
+    assert args == {"tenant_id": 42}
+
+
+def test_optional_clause_dropped_without_value():
+    sql, args = render_native_query(
+        "SELECT 1 FROM t WHERE 1 = 1 [[AND tenantId = {{tenant_id}}]] LIMIT 5", {})
+    assert sql == "SELECT 1 FROM t WHERE 1 = 1  LIMIT 5"
+    assert args == {}
+
+
+def test_optional_clause_needs_every_variable():
+    sql, args = render_native_query(
+        "SELECT 1 [[AND a = {{a}} AND b = {{b}}]]", {"a": 1, "b": None})
+    assert sql == "SELECT 1 "
+    assert args == {}
+
+
+def test_multiline_optional_clause():
+    sql, _ = render_native_query("SELECT 1\n[[AND a = {{a}}\n AND c = 2]]\n", {})
+    assert sql == "SELECT 1\n\n"
+
+
+def test_literal_percent_is_escaped():
+    sql, args = render_native_query(
+        "SELECT CONCAT(ROUND(100 * {{x}}), '%') AS pct WHERE name LIKE 'a%'", {"x": 1})
+    assert sql == "SELECT CONCAT(ROUND(100 * %(x)s), '%%') AS pct WHERE name LIKE 'a%%'"
+    # El resultado tiene que ser válido para el formateo de pymysql
+    assert sql % {"x": 1} == "SELECT CONCAT(ROUND(100 * 1), '%') AS pct WHERE name LIKE 'a%'"
+
+
+def test_percent_escaped_without_variables():
+    sql, args = render_native_query("SELECT '100%'", {})
+    assert sql == "SELECT '100%%'"
+    assert args == {}
+
+
+def test_missing_required_variable_raises():
+    with pytest.raises(ValueError, match="periodo_dias"):
+        render_native_query("SELECT {{periodo_dias}}", {})
+
+
+def test_card_reference_raises():
+    with pytest.raises(ValueError, match="Metabase"):
+        render_native_query("SELECT * FROM {{#12-base-emails-criticos}} AS base",
+                            {"periodo_dias": 7})
+
+
+def test_repeated_variable():
+    sql, args = render_native_query("SELECT {{a}}, {{a}}", {"a": 3})
+    assert sql == "SELECT %(a)s, %(a)s"
+    assert args == {"a": 3}
@@ -0,0 +1,189 @@
+"""Tests de metabase_cache.ResponseCache (TTL, revalidación con 304, LRU, invalidación)."""
+
+import json
+import os
+
+import pytest
+
+import metabase_cache
+
+from metabase_cache import ResponseCache, cache_key
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, text="{}", headers=None):
+        self.status_code = status_code
+        self.text        = text
+        self.headers     = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeServer:
+    """send(headers) de ResponseCache.fetch: registra los headers y retorna la respuesta dada."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def __call__(self, headers):
+        self.sent.append(headers)
+        return self.responses.pop(0)
+
+
+def test_cache_key_sorts_params():
+    assert cache_key("/api/card") == "/api/card"
+    assert cache_key("/api/database/2", {"include": "tables", "a": 1}) == (
+        "/api/database/2?a=1&include=tables")
+
+
+def test_fresh_entry_is_served_without_request():
+    cache = ResponseCache(ttl=60)
+    server = FakeServer(FakeResponse(text='{"id": 1}'))
+    r, result = cache.fetch("/api/dashboard/1", server)
+    assert result == "miss"
+    r, result = cache.fetch("/api/dashboard/1", server)
+    assert result == "hit"
+    assert r.json() == {"id": 1}
+    assert r.from_cache
+    assert len(server.sent) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entry_revalidates_with_validators():
+    cache = ResponseCache(ttl=0)
+    server = FakeServer(
+        FakeResponse(text='{"v": 1}', headers={"ETag": '"abc"',
+                                               "Last-Modified": "Sat, 17 Oct 2026 10:00:00 GMT"}),
+        FakeResponse(status_code=304, text=""))
+    cache.fetch("/api/card", server)
+    r, result = cache.fetch("/api/card", server)
+    assert result == "revalidated"
+    assert server.sent[1] == {"If-None-Match": '"abc"',
+                              "If-Modified-Since": "Sat, 17 Oct 2026 10:00:00 GMT"}
+    assert r.json() == {"v": 1}
+    assert cache.revalidated == 1
+
+
+def test_expired_entry_without_validators_is_fetched_again():
+    cache = ResponseCache(ttl=0)
+    server = FakeServer(FakeResponse(text='{"v": 1}'), FakeResponse(text='{"v": 2}'))
+    cache.fetch("/api/card", server)
+    r, result = cache.fetch("/api/card", server)
+    assert result == "miss"
+    assert server.sent[1] == {}
+    assert r.json() == {"v": 2}
+
+
+def test_304_after_entry_was_dropped_asks_full_response():
+    cache = ResponseCache(ttl=0)
+    cache.store("/api/card", FakeResponse(headers={"ETag": '"abc"'}))
+    original_revalidate = cache.revalidate
+
+    def dropped(key):
+        cache.clear()
+        return original_revalidate(key)
+    cache.revalidate = dropped
+    server = FakeServer(FakeResponse(status_code=304, text=""), FakeResponse(text='{"v": 3}'))
+    r, result = cache.fetch("/api/card", server)
+    assert result == "miss"
+    assert server.sent == [{"If-None-Match": '"abc"'}, {}]
+    assert r.json() == {"v": 3}
+
+
+def test_only_200_is_stored():
+    cache = ResponseCache(ttl=60)
+    cache.store("/api/card/9", FakeResponse(status_code=404))
+    assert cache.lookup("/api/card/9") == (None, {})
+
+
+def test_lru_drops_least_recently_used():
+    cache = ResponseCache(ttl=60, max_entries=2)
+    cache.store("a", FakeResponse())
+    cache.store("b", FakeResponse())
+    cache.lookup("a")  # "a" pasa a ser la más reciente
+    cache.store("c", FakeResponse())
+    assert cache.lookup("b")[0] is None
+    assert cache.lookup("a")[0] is not None
+    assert cache.lookup("c")[0] is not None
+
+
+def test_mutation_invalidates_the_whole_resource():
+    cache = ResponseCache(ttl=60)
+    for key in ("/api/dashboard", "/api/dashboard/5", "/api/dashboard?f=all",
+                "/api/dashboards", "/api/card/1"):
+        cache.store(key, FakeResponse())
+    cache.invalidate_for("PUT", "/api/dashboard/5/cards")
+    assert cache.lookup("/api/dashboard")[0] is None
+    assert cache.lookup("/api/dashboard/5")[0] is None
+    assert cache.lookup("/api/dashboard?f=all")[0] is None
+    assert cache.lookup("/api/dashboards")[0] is not None
+    assert cache.lookup("/api/card/1")[0] is not None
+
+
+def test_reads_do_not_invalidate():
+    cache = ResponseCache(ttl=60)
+    cache.store("/api/card/1", FakeResponse())
+    cache.invalidate_for("GET", "/api/card/1")
+    cache.invalidate_for("POST", "/api/card/1/query")
+    cache.store("/api/dataset", FakeResponse())
+    cache.invalidate_for("POST", "/api/dataset")
+    assert cache.lookup("/api/card/1")[0] is not None
+    assert cache.lookup("/api/dataset")[0] is not None
+    cache.invalidate_for("POST", "/api/card")
+    assert cache.lookup("/api/card/1")[0] is None
+
+
+def test_persistence_roundtrip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ResponseCache(ttl=60, path=path)
+    cache.store("/api/card", FakeResponse(text='[1]', headers={"ETag": '"x"', "Server": "j"}))
+    cache.save()
+    restored = ResponseCache(ttl=60, path=path)
+    r, _ = restored.lookup("/api/card")
+    assert r.json() == [1]
+    assert r.headers == {"ETag": '"x"'}
+
+
+def test_corrupt_cache_file_starts_empty(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_text("{no es json")
+    assert ResponseCache(ttl=60, path=str(path)).lookup("/api/card") == (None, {})
+    path.write_text(json.dumps([1, 2]))
+    assert ResponseCache(ttl=60, path=str(path)).lookup("/api/card") == (None, {})
+
+
+def test_failed_save_keeps_previous_file_and_no_temp(tmp_path, monkeypatch):
+    path = tmp_path / "cache.json"
+    cache = ResponseCache(ttl=60, path=str(path))
+    cache.store("/api/card", FakeResponse(text="[1]"))
+    cache.save()
+
+    def broken_dump(*args, **kwargs):
+        raise OSError("disco lleno")
+    cache.store("/api/card", FakeResponse(text="[2]"))
+    monkeypatch.setattr(metabase_cache.json, "dump", broken_dump)
+    with pytest.raises(OSError):
+        cache.save()
+    assert json.loads(path.read_text())["/api/card"]["text"] == "[1]"
+    assert os.listdir(tmp_path) == ["cache.json"]
+
+
+def test_concurrent_saves_use_distinct_temp_files(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    first, second = ResponseCache(ttl=60, path=path), ResponseCache(ttl=60, path=path)
+    first.store("/api/a", FakeResponse())
+    second.store("/api/b", FakeResponse())
+    temps = []
+    original = metabase_cache.os.replace
+
+    def record(src, dst):
+        temps.append(src)
+        if len(temps) == 1:
+            second.save()  # Otro proceso guarda mientras el primero está a punto de renombrar
+        original(src, dst)
+    monkeypatch.setattr(metabase_cache.os, "replace", record)
+    first.save()
+    assert len(set(temps)) == 2
+    assert os.listdir(tmp_path) == ["cache.json"]
@@ -0,0 +1,129 @@
+"""Tests de rollup_critical_emails con una conexión falsa (sin MySQL)."""
+
+from datetime import date
+
+from rollup_critical_emails import (ROLLUP_TABLE, days_with_new_rows, rebuild_day,
+                                    run_rollup)
+
+
+class FakeCursor:
+    """Registra las sentencias y responde según el primer patrón de `answers` que coincide."""
+
+    def __init__(self, conn):
+        self.conn     = conn
+        self.rowcount = 0
+        self._result  = []
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        self.conn.log.append((sql, params))
+        self._result, self.rowcount = [], 0
+        for pattern, answer in self.conn.answers:
+            if pattern in sql:
+                result = answer(params) if callable(answer) else answer
+                if isinstance(result, int):
+                    self.rowcount = result
+                else:
+                    self._result = result
+                break
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, answers):
+        self.answers = answers
+        self.log     = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append(("COMMIT", None))
+        self.commits += 1
+
+    def statements(self, prefix):
+        return [(sql, params) for sql, params in self.log if sql.startswith(prefix)]
+
+
+def test_no_new_ids_skips_the_query():
+    conn = FakeConnection([])
+    with conn.cursor() as cur:
+        assert days_with_new_rows(cur, last_id=10, max_id=10) == set()
+    assert conn.log == []
+
+
+def test_new_rows_are_searched_by_pk_range():
+    conn = FakeConnection([("SELECT DISTINCT DATE(sentAt)",
+                            [(date(2026, 10, 16),), (None,), (date(2026, 10, 17),)])])
+    with conn.cursor() as cur:
+        days = days_with_new_rows(cur, last_id=10, max_id=25)
+    assert days == {date(2026, 10, 16), date(2026, 10, 17)}
+    assert conn.log[0][1] == (10, 25)
+    assert "WHERE id > %s AND id <= %s" in conn.log[0][0]
+
+
+def test_rebuild_day_replaces_the_day_in_one_transaction():
+    conn = FakeConnection([(f"INSERT INTO {ROLLUP_TABLE}", 7)])
+    assert rebuild_day(conn, date(2026, 12, 31)) == 7
+    (delete, delete_params), (insert, insert_params), commit = conn.log
+    assert delete.startswith(f"DELETE FROM {ROLLUP_TABLE} WHERE day = %s")
+    assert delete_params == (date(2026, 12, 31),)
+    # Rango semiabierto sobre sentAt: del día hasta el día siguiente (cruza de año)
+    assert "WHERE sentAt >= %s AND sentAt < %s" in insert
+    assert insert_params == (date(2026, 12, 31), date(2027, 1, 1))
+    assert commit == ("COMMIT", None)
+
+
+def test_incremental_run_rebuilds_new_and_recent_days_then_advances_watermark():
+    conn = FakeConnection([
+        ("SELECT lastId", [(100,)]),
+        ("SELECT COALESCE(MAX(id), 0)", [(150,)]),
+        ("SELECT DISTINCT DATE(sentAt)", [(date(2026, 10, 1),), (date(2026, 10, 17),)]),
+        ("SELECT CURDATE()", [(date(2026, 10, 17),)]),
+        (f"INSERT INTO {ROLLUP_TABLE}", 3),
+    ])
+    results = run_rollup(conn, lookback_days=1)
+    assert results == {"days": 3, "rows": 9, "from_id": 100, "to_id": 150}
+    rebuilt = [params[0] for _, params in conn.statements(f"DELETE FROM {ROLLUP_TABLE}")]
+    assert rebuilt == [date(2026, 10, 1), date(2026, 10, 16), date(2026, 10, 17)]
+    (watermark, params), = conn.statements("INSERT INTO critical_email_rollup_state")
+    assert params == (ROLLUP_TABLE, 150)
+    # La marca de agua avanza después de recalcular todos los días
+    assert conn.log.index((watermark, params)) > conn.log.index(
+        conn.statements(f"DELETE FROM {ROLLUP_TABLE}")[-1])
+
+
+def test_extra_days_extend_the_recent_window():
+    conn = FakeConnection([
+        ("SELECT lastId", []),
+        ("SELECT COALESCE(MAX(id), 0)", [(0,)]),
+        ("SELECT CURDATE()", [(date(2026, 10, 17),)]),
+    ])
+    results = run_rollup(conn, extra_days=3, lookback_days=1)
+    assert results["days"] == 4
+    assert results["from_id"] == 0
+    assert not conn.statements("SELECT DISTINCT")
+
+
+def test_full_run_covers_every_day_of_the_log():
+    conn = FakeConnection([
+        ("SELECT lastId", [(5,)]),
+        ("SELECT COALESCE(MAX(id), 0)", [(9,)]),
+        ("SELECT MIN(DATE(sentAt))", [(date(2026, 2, 27), date(2026, 3, 2))]),
+    ])
+    results = run_rollup(conn, full=True)
+    rebuilt = [params[0] for _, params in conn.statements(f"DELETE FROM {ROLLUP_TABLE}")]
+    assert rebuilt == [date(2026, 2, 27), date(2026, 2, 28), date(2026, 3, 1), date(2026, 3, 2)]
+    assert results["days"] == 4
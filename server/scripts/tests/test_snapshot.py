@@ -0,0 +1,202 @@
+"""Tests de snapshot_critical_emails con conexiones y pool falsos (sin MySQL)."""
+
+import json
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+import snapshot_critical_emails as snapshot
+from snapshot_critical_emails import (SNAPSHOT_TABLE, STATE_TABLE, card_key, run_card,
+                                      run_snapshots, write_snapshot)
+
+CARD = {"name": "📊 Resumen Ejecutivo — Emails Críticos",
+        "sql": "SELECT COUNT(*) AS total, '100%' AS pct FROM critical_email_log "
+               "WHERE sentAt >= DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY)"}
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn        = conn
+        self.description = None
+        self._rows       = []
+
+    def execute(self, sql, params=None):
+        sql = " ".join(sql.split())
+        if self.conn.fail_on and self.conn.fail_on in sql:
+            raise RuntimeError("fallo simulado")
+        self.conn.log.append(("execute", sql, params))
+        if sql.startswith("SELECT GET_LOCK"):
+            self._rows = [(self.conn.lock,)]
+        elif sql.startswith("SELECT"):
+            self.description = [(c,) for c in self.conn.columns]
+            self._rows = list(self.conn.rows)
+
+    def executemany(self, sql, records):
+        self.conn.log.append(("executemany", " ".join(sql.split()), list(records)))
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, columns=(), rows=(), lock=1, fail_on=None):
+        self.columns   = columns
+        self.rows      = rows
+        self.lock      = lock
+        self.fail_on   = fail_on
+        self.log       = []
+        self.commits   = 0
+        self.rollbacks = 0
+        self.closed    = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    def __init__(self, conn, size=2):
+        self.conn    = conn
+        self.size    = size
+        self.created = 1
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def ok_entry(rows, columns=("dia", "total")):
+    return {"card_id": "resumen", "name": "Resumen", "periodo_dias": 30, "status": "ok",
+            "rows": len(rows), "columns": list(columns), "result": rows,
+            "elapsed": 1.234, "sql_hash": "h" * 64}
+
+
+def test_card_key_is_ascii_slug():
+    assert card_key(CARD["name"]) == "resumen-ejecutivo-emails-criticos"
+
+
+def test_run_card_renders_parameters():
+    conn = FakeConnection(columns=("total", "pct"), rows=[(12, "100%")])
+    entry = run_card(FakePool(conn), CARD, 30)
+    assert entry["status"] == "ok"
+    assert entry["rows"] == 1 and entry["columns"] == ["total", "pct"]
+    _, sql, params = conn.log[0]
+    assert "INTERVAL %(periodo_dias)s DAY" in sql and "'100%%'" in sql
+    assert params == {"periodo_dias": 30}
+
+
+def test_run_card_reports_replica_errors():
+    conn = FakeConnection(fail_on="SELECT COUNT")
+    entry = run_card(FakePool(conn), CARD, 7)
+    assert entry["status"] == "error"
+    assert "fallo simulado" in entry["error"]
+
+
+def test_write_snapshot_replaces_rows_in_one_transaction(monkeypatch):
+    monkeypatch.setattr(snapshot, "INSERT_BATCH", 2)
+    rows = [(date(2026, 10, 15), Decimal("1.5")), (datetime(2026, 10, 16, 8, 30), 2),
+            (b"x", None)]
+    conn = FakeConnection()
+    write_snapshot(conn, ok_entry(rows))
+
+    kinds = [(kind, sql.split(" (")[0]) for kind, sql, _ in conn.log]
+    assert kinds == [
+        ("execute", f"DELETE FROM {SNAPSHOT_TABLE} WHERE cardKey = %s AND periodoDias = %s"),
+        ("executemany", f"INSERT INTO {SNAPSHOT_TABLE}"),
+        ("executemany", f"INSERT INTO {SNAPSHOT_TABLE}"),
+        ("execute", f"INSERT INTO {STATE_TABLE}"),
+    ]
+    assert conn.log[0][2] == ("resumen", 30)
+    records = conn.log[1][2] + conn.log[2][2]
+    assert [len(conn.log[1][2]), len(conn.log[2][2])] == [2, 1]
+    assert [r[2] for r in records] == [1, 2, 3]
+    assert [json.loads(r[3]) for r in records] == [
+        {"dia": "2026-10-15", "total": 1.5},
+        {"dia": "2026-10-16 08:30:00", "total": 2},
+        {"dia": "x", "total": None},
+    ]
+    assert conn.log[3][2] == ("resumen", 30, "Resumen", 3, 1234, "h" * 64)
+    assert conn.commits == 1
+
+
+def test_write_snapshot_with_empty_result_still_clears_and_records_state():
+    conn = FakeConnection()
+    write_snapshot(conn, ok_entry([]))
+    assert [kind for kind, _, _ in conn.log] == ["execute", "execute"]
+    assert conn.log[1][2][3] == 0
+
+
+def test_run_snapshots_writes_only_successful_entries(monkeypatch):
+    replica = FakeConnection(columns=("total",), rows=[(5,)])
+    writer = FakeConnection()
+    monkeypatch.setattr(snapshot, "ConnectionPool", lambda *a, **k: FakePool(replica))
+    monkeypatch.setattr(snapshot, "connect", lambda **k: writer)
+    bad = {"name": "Modelo", "sql": "SELECT * FROM {{#12-base-emails-criticos}}"}
+
+    entries = run_snapshots([CARD, bad], [7, 30], concurrency=2)
+
+    assert [(e["periodo_dias"], e["status"]) for e in entries] == [
+        (7, "ok"), (30, "ok"), (7, "error"), (30, "error")]
+    assert all("result" not in e and "columns" not in e for e in entries)
+    deletes = [params for kind, sql, params in writer.log if sql.startswith("DELETE")]
+    assert deletes == [("resumen-ejecutivo-emails-criticos", 7),
+                       ("resumen-ejecutivo-emails-criticos", 30)]
+    assert writer.closed
+
+
+def test_run_snapshots_dry_run_does_not_connect_to_primary(monkeypatch):
+    replica = FakeConnection(columns=("total",), rows=[(5,)])
+    monkeypatch.setattr(snapshot, "ConnectionPool", lambda *a, **k: FakePool(replica))
+
+    def no_primary(**kwargs):
+        raise AssertionError("dry_run no escribe en el primario")
+    monkeypatch.setattr(snapshot, "connect", no_primary)
+    entries = run_snapshots([CARD], [7], dry_run=True)
+    assert entries[0]["status"] == "ok"
+
+
+def test_failed_write_marks_entries_as_errors(monkeypatch):
+    replica = FakeConnection(columns=("total",), rows=[(5,)])
+    writer = FakeConnection(fail_on=f"INSERT INTO {STATE_TABLE}")
+    monkeypatch.setattr(snapshot, "ConnectionPool", lambda *a, **k: FakePool(replica))
+    monkeypatch.setattr(snapshot, "connect", lambda **k: writer)
+    entries = run_snapshots([CARD], [7, 30])
+    assert [e["status"] for e in entries] == ["error", "error"]
+    assert writer.rollbacks == 2 and writer.commits == 1  # Solo el commit del DDL
+
+
+@pytest.mark.parametrize("lock", [0, None])
+def test_lock_held_elsewhere_fails_every_entry(monkeypatch, lock):
+    replica = FakeConnection(columns=("total",), rows=[(5,)])
+    writer = FakeConnection(lock=lock)
+    monkeypatch.setattr(snapshot, "ConnectionPool", lambda *a, **k: FakePool(replica))
+    monkeypatch.setattr(snapshot, "connect", lambda **k: writer)
+    entries = run_snapshots([CARD], [7])
+    assert entries[0]["status"] == "error"
+    assert "otra ejecución" in entries[0]["error"]
+    assert writer.closed
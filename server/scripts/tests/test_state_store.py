@@ -0,0 +1,72 @@
+"""Tests de metabase_state.StateStore (escritura atómica y combinación entre procesos)."""
+
+import json
+import os
+
+import pytest
+
+import metabase_state
+from metabase_state import StateStore
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / "state.json")
+    store = StateStore(path)
+    store.set("dashboard_id", 5)
+    store.save()
+    assert StateStore(path).get("dashboard_id") == 5
+    assert sorted(os.listdir(tmp_path)) == ["state.json", "state.json.lock"]
+
+
+def test_long_lived_store_keeps_newer_ids_from_another_process(tmp_path):
+    path = str(tmp_path / "state.json")
+    seed = StateStore(path)
+    seed.set("dashboard_id", 1)
+    seed.set("database_id", 2)
+    seed.save()
+
+    daemon = StateStore(path)           # Carga el estado una vez
+    setup = StateStore(path)
+    setup.set("dashboard_id", 10)       # Setup recrea el dashboard
+    setup.set("model_id", 77)
+    setup.save()
+
+    daemon.touch("dashboard_id")        # El daemon re-valida su ID viejo
+    daemon.set("card_costs", {"3": {"avg": 1.0, "runs": 1}})
+    daemon.save()
+
+    on_disk = StateStore(path)
+    assert on_disk.get("dashboard_id") == 10
+    assert on_disk.get("model_id") == 77
+    assert on_disk.get("database_id") == 2
+    assert on_disk.get("card_costs") == {"3": {"avg": 1.0, "runs": 1}}
+    # El daemon ve los valores combinados tras guardar
+    assert daemon.get("dashboard_id") == 10
+
+
+def test_both_changed_newest_wins(tmp_path, monkeypatch):
+    path = str(tmp_path / "state.json")
+    clock = iter([100.0, 200.0])
+    monkeypatch.setattr(metabase_state.time, "time", lambda: next(clock))
+    first, second = StateStore(path), StateStore(path)
+    first.set("dashboard_id", 1)        # stored_at 100
+    second.set("dashboard_id", 2)       # stored_at 200
+    second.save()
+    first.save()
+    assert StateStore(path).get("dashboard_id") == 2
+
+
+def test_failed_save_leaves_previous_file_and_no_temp(tmp_path, monkeypatch):
+    path = tmp_path / "state.json"
+    store = StateStore(str(path))
+    store.set("dashboard_id", 1)
+    store.save()
+
+    def broken_dump(*args, **kwargs):
+        raise OSError("disco lleno")
+    store.set("dashboard_id", 2)
+    monkeypatch.setattr(metabase_state.json, "dump", broken_dump)
+    with pytest.raises(OSError):
+        store.save()
+    assert json.loads(path.read_text())["dashboard_id"]["value"] == 1
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
@@ -0,0 +1,33 @@
+"""Tests del filtro de tenant de las cards compartidas por los dashboards de tenant."""
+
+import pytest
+
+from metabase_api import build_card_payload
+from metabase_mysql import render_native_query
+from setup_metabase_dashboard import add_tenant_filter, get_tenant_cards_definition
+
+
+def test_tenant_condition_is_required_and_uses_alias():
+    sql = ("SELECT * FROM critical_email_log log\n"
+           "WHERE log.sentAt >= DATE_SUB(NOW(), INTERVAL {{periodo_dias}} DAY)\n"
+           "ORDER BY log.sentAt DESC")
+    filtered = add_tenant_filter(sql)
+    assert "AND log.tenantId = {{tenant_id}}" in filtered
+    assert "[[" not in filtered
+
+
+def test_sql_without_period_where_is_rejected():
+    with pytest.raises(ValueError):
+        add_tenant_filter("SELECT * FROM critical_email_log")
+
+
+@pytest.mark.parametrize("source", ["raw", "rollup"])
+def test_every_tenant_card_requires_tenant_id(source):
+    for card in get_tenant_cards_definition(source):
+        tags = build_card_payload(card["name"], "", card["sql"], 2, card["display"],
+                                  {})["dataset_query"]["native"]["template-tags"]
+        assert tags["tenant_id"]["required"] is True
+        assert "default" not in tags["tenant_id"]
+        # Sin tenant la consulta no se puede renderizar (no cae a "todos los tenants")
+        with pytest.raises(ValueError, match="tenant_id"):
+            render_native_query(card["sql"], {"periodo_dias": 7})
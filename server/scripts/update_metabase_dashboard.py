@@ -6,7 +6,8 @@ Script de actualización automática del Dashboard de Emails Críticos en Metaba
 
 Qué hace este script:
   1. Autentica con Metabase (API Key o usuario/contraseña)
-  2. Re-sincroniza el esquema de la base de datos (detecta nuevas columnas/tablas)
+  2. Re-sincroniza el esquema de la base de datos si cambió la huella de las
+     tablas que leen las cards, y re-escanea los valores de las columnas de filtro
   3. Invalida el caché de todas las cards del dashboard
   4. Re-ejecuta (refresca) todas las cards del dashboard
   5. Configura el auto-refresh del dashboard si aún no está activo
@@ -16,7 +17,15 @@ Modos de ejecución:
   python update_metabase_dashboard.py              # Actualización completa
   python update_metabase_dashboard.py --cards-only # Solo re-ejecutar cards
   python update_metabase_dashboard.py --sync-only  # Solo re-sincronizar BD
+  python update_metabase_dashboard.py --sync-only --full-sync  # Sync y rescan de toda la BD
   python update_metabase_dashboard.py --status     # Ver estado actual del dashboard
+  python update_metabase_dashboard.py --concurrency 8  # Refrescar hasta 8 cards en paralelo
+  python update_metabase_dashboard.py --async      # Refresco/estado con cliente asyncio
+  python update_metabase_dashboard.py --export-card 5 --output log.csv  # Exportar resultado
+  python update_metabase_dashboard.py --daemon --refresh-every 300      # Proceso residente
+  python update_metabase_dashboard.py --force      # Re-ejecutar cards aunque no haya datos nuevos
+  python update_metabase_dashboard.py --direct     # SQL de las cards en la réplica MySQL (snapshots)
+  python update_metabase_dashboard.py --metrics-file /var/lib/node_exporter/metabase.prom
 
 Uso típico (cron cada hora):
   0 * * * * /usr/bin/python3 /opt/imaginecrm/update_metabase_dashboard.py >> /var/log/metabase_update.log 2>&1
@@ -25,6 +34,12 @@ Variables de entorno (mismo .env del script de setup):
   METABASE_URL, METABASE_API_KEY (o METABASE_EMAIL + METABASE_PASSWORD)
   METABASE_DASHBOARD_ID   ID del dashboard a actualizar (obtenido del setup)
   METABASE_DATABASE_ID    ID de la base de datos en Metabase (obtenido del setup)
+  METABASE_STATE_FILE     Estado local con IDs resueltos y metadata de cards
+                          (si faltan los IDs, se leen de aquí antes de buscar por nombre)
+  METABASE_QUERY_TIMEOUT  Plazo por card hasta su resultado final, incluidas las 202 (default: 900)
+  METABASE_ADAPTIVE_TTL   1 para ajustar el cache_ttl de cada card, como --adaptive-ttl (default: 0)
+  METABASE_TTL_MIN_SAMPLES Mediciones de una card antes de aplicarle un TTL propio (default: 5)
+  METABASE_DIRECT_PERIOD  --direct: período (días) de los snapshots en la réplica (default: 7)
 
 Autor: ImagineCRM Automation
 """
@@ -32,13 +47,35 @@ Autor: ImagineCRM Automation
 import os
 import sys
 import time
+import re
 import json
 import argparse
+import asyncio
 import logging
+import random
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+try:
+    import ijson  # Parser JSON incremental (opcional): conteo de filas en memoria constante
+except ImportError:
+    ijson = None
+
+from metabase_api import SyncPoller
+from metabase_async_client import AsyncMetabaseClient
+from metabase_cache import ResponseCache, cache_key
+from metabase_codec import ACCEPT_ENCODING, decode_json, encode_body, loads
+from metabase_metrics import (HTTP_REQUESTS, HTTP_RETRIES, METRICS_HOST, RATE_LIMIT_RATE,
+                              RATE_LIMIT_WAIT, REGISTRY)
+from metabase_ratelimit import AdaptiveRateLimiter, THROTTLE_STATUSES, endpoint_key
+from metabase_state import StateStore
 
 # ── Carga de variables de entorno ──────────────────────────────────────────
 try:
@@ -58,7 +95,61 @@ METABASE_DATABASE_ID  = int(os.getenv("METABASE_DATABASE_ID", "0"))
 # Configuración de reintentos
 MAX_RETRIES     = 3
 RETRY_DELAY_SEC = 5
-CARD_EXEC_DELAY = 1.0   # Segundos entre ejecución de cada card (evitar sobrecarga)
+CARD_CONCURRENCY = int(os.getenv("METABASE_CARD_CONCURRENCY", "4"))  # Cards en paralelo
+
+# Espera de sincronización (backoff exponencial entre consultas de estado)
+SYNC_WAIT_TIMEOUT   = int(os.getenv("METABASE_SYNC_TIMEOUT", "600"))
+
+EXPORT_CHUNK_BYTES = 64 * 1024  # Tamaño de bloque al volcar exportaciones a disco
+
+# Plazo de extremo a extremo de cada ejecución de card: una 202 sigue corriendo
+# en Metabase y el resultado llega en el mismo cuerpo cuando termina
+QUERY_TIMEOUT     = float(os.getenv("METABASE_QUERY_TIMEOUT", "900"))
+QUERY_READ_CHUNK  = 64 * 1024
+
+# Modo daemon: intervalos por tarea (segundos) y jitter relativo
+DAEMON_REFRESH_EVERY = int(os.getenv("METABASE_DAEMON_REFRESH_EVERY", "3600"))
+DAEMON_SYNC_EVERY    = int(os.getenv("METABASE_DAEMON_SYNC_EVERY", "86400"))
+DAEMON_RESCAN_EVERY  = int(os.getenv("METABASE_DAEMON_RESCAN_EVERY", "86400"))
+DAEMON_JITTER        = float(os.getenv("METABASE_DAEMON_JITTER", "0.1"))
+
+# Espera máxima al recalcular el caché del modelo base (ver setup --model)
+MODEL_REFRESH_TIMEOUT = int(os.getenv("METABASE_MODEL_REFRESH_TIMEOUT", "300"))
+
+# Marca de agua por tabla fuente: expresión barata que cambia cuando cambian los datos.
+# Las cards que leen tablas fuera de este mapa se re-ejecutan siempre.
+WATERMARK_EXPRESSIONS = {
+    "critical_email_log": "CONCAT(COALESCE(MAX(id), 0), '@', COALESCE(MAX(sentAt), ''))",
+    "tenants":            "CONCAT(COALESCE(MAX(id), 0), '@', COALESCE(MAX(updatedAt), ''))",
+}
+# Las cards filtran por ventana de tiempo (NOW() - periodo): aunque no haya filas
+# nuevas, se re-ejecutan como mínimo cada WATERMARK_MAX_AGE segundos
+WATERMARK_MAX_AGE = int(os.getenv("METABASE_WATERMARK_MAX_AGE", "21600"))
+
+# Sync incremental: sync_schema solo cuando cambia la huella del esquema de las
+# tablas que leen las cards, y rescan_values solo sobre las columnas de filtro
+# (de las tablas que el dashboard realmente usa)
+FILTER_FIELDS = {
+    "critical_email_log":   ("emailType",),
+    "critical_email_daily": ("emailType",),
+}
+
+# TTL de caché por card: costo medido × multiplicador, acotado por la frecuencia
+# de cambio de sus tablas fuente. Metabase expresa el cache_ttl de las cards en horas.
+ADAPTIVE_TTL      = os.getenv("METABASE_ADAPTIVE_TTL", "0").lower() in ("1", "true", "yes")
+TTL_MULTIPLIER    = float(os.getenv("METABASE_TTL_MULTIPLIER", "600"))
+TTL_MIN_COST      = float(os.getenv("METABASE_TTL_MIN_COST", "1.0"))
+TTL_MAX_HOURS     = int(os.getenv("METABASE_TTL_MAX_HOURS", "24"))
+TTL_MIN_SAMPLES   = int(os.getenv("METABASE_TTL_MIN_SAMPLES", "5"))
+TTL_UNKNOWN_CHANGE = 3600   # Tope (s) si no hay marca de agua para las tablas de la card
+TTL_EWMA_ALPHA    = 0.3     # Peso de cada medición nueva en los promedios móviles
+
+# Modo --direct: período con el que se precalculan los snapshots en la réplica
+DIRECT_PERIOD = os.getenv("METABASE_DIRECT_PERIOD", "7")
+
+# Métricas Prometheus (archivo .prom para node-exporter y/o /metrics en modo daemon)
+METRICS_FILE = os.getenv("METABASE_METRICS_FILE", "")
+METRICS_PORT = int(os.getenv("METABASE_METRICS_PORT", "0"))
 
 # ── Logging ────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -68,6 +159,35 @@ logging.basicConfig(
 )
 log = logging.getLogger("metabase_update")
 
+# ── Métricas ───────────────────────────────────────────────────────────────
+# HTTP_REQUESTS, HTTP_RETRIES, RATE_LIMIT_WAIT y RATE_LIMIT_RATE viven en
+# metabase_metrics: los comparte el cliente asíncrono (--async)
+CACHE_REQUESTS = REGISTRY.counter(
+    "metabase_cache_requests_total", "Lecturas GET por resultado del caché de respuestas",
+    ("result",))
+CARD_SECONDS = REGISTRY.histogram(
+    "metabase_card_execution_seconds", "Latencia de ejecución de cada card",
+    ("card_id", "card_name", "status"))
+CARD_CACHE_TTL = REGISTRY.gauge(
+    "metabase_card_cache_ttl_hours", "cache_ttl calculado para cada card (0 = sin TTL propio)",
+    ("card_id",))
+CARDS_SKIPPED = REGISTRY.counter(
+    "metabase_cards_skipped_total", "Cards omitidas por no tener datos fuente nuevos")
+SCHEMA_CHECKS = REGISTRY.counter(
+    "metabase_schema_checks_total",
+    "Comprobaciones de la huella del esquema por resultado (changed, unchanged, full)",
+    ("result",))
+SYNC_SECONDS = REGISTRY.histogram(
+    "metabase_sync_duration_seconds", "Duración de la espera de sincronización de la BD",
+    ("outcome",), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+JOB_SECONDS = REGISTRY.histogram(
+    "metabase_daemon_job_seconds", "Duración de cada tarea del modo daemon", ("job",))
+RUN_SECONDS = REGISTRY.gauge(
+    "metabase_update_run_seconds", "Duración total de la última ejecución")
+RUN_TIMESTAMP = REGISTRY.gauge(
+    "metabase_update_last_run_timestamp_seconds", "Fin de la última ejecución por resultado",
+    ("result",))
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # CLIENTE METABASE
@@ -76,21 +196,34 @@ log = logging.getLogger("metabase_update")
 class MetabaseClient:
     """Cliente HTTP para la API REST de Metabase con reintentos automáticos."""
 
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, pool_size: int = CARD_CONCURRENCY):
         self.base_url = base_url
         self.session  = requests.Session()
+        # Pool keep-alive dimensionado para los workers de refresco concurrente
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.session.headers.update({
             "Content-Type": "application/json",
-            "Accept": "application/json"
+            "Accept": "application/json",
+            "Accept-Encoding": ACCEPT_ENCODING
         })
+        # Metadata de cards por ID, válida durante la ejecución actual
+        self._card_cache: Dict[int, Dict] = {}
+        # Callback de re-autenticación ante un 401 (sesión vencida en modo daemon)
+        self.reauth = None
+        # Un único limitador para todos los requests del cliente (todos los hilos)
+        self.limiter = AdaptiveRateLimiter()
+        # Respuestas GET de metadata; en modo daemon se reutilizan entre ciclos
+        self.cache = ResponseCache()
 
     # ── Autenticación ──────────────────────────────────────────────────────
 
     def auth_with_api_key(self, api_key: str) -> bool:
         self.session.headers["x-api-key"] = api_key
-        r = self._get("/api/user/current")
+        r = self._get("/api/user/current", cache=False)
         if r and r.status_code == 200:
-            user = r.json()
+            user = decode_json(r)
             log.info(f"Autenticado como: {user.get('email')} (API Key)")
             return True
         log.error(f"API Key inválida. Status: {r.status_code if r else 'N/A'}")
@@ -102,7 +235,7 @@ class MetabaseClient:
             json={"username": email, "password": password}
         )
         if r.status_code == 200:
-            token = r.json().get("id")
+            token = decode_json(r).get("id")
             self.session.headers["X-Metabase-Session"] = token
             log.info(f"Autenticado como: {email} (session token)")
             return True
@@ -113,37 +246,83 @@ class MetabaseClient:
 
     def _request(self, method: str, path: str, **kwargs) -> Optional[requests.Response]:
         url = f"{self.base_url}{path}"
+        key = endpoint_key(method, path)
         for attempt in range(1, MAX_RETRIES + 1):
+            RATE_LIMIT_WAIT.inc(self.limiter.acquire())
+            start = time.monotonic()
             try:
                 r = self.session.request(method, url, timeout=30, **kwargs)
-                if r.status_code == 429:  # Rate limit
-                    wait = int(r.headers.get("Retry-After", RETRY_DELAY_SEC * attempt))
-                    log.warning(f"Rate limit alcanzado. Esperando {wait}s...")
-                    time.sleep(wait)
+                self.limiter.record(key, r.status_code, time.monotonic() - start,
+                                    r.headers.get("Retry-After"))
+                RATE_LIMIT_RATE.set(round(self.limiter.rate, 2))
+                HTTP_REQUESTS.inc(method=method, status=r.status_code)
+                if r.status_code == 401 and self.reauth and attempt < MAX_RETRIES:
+                    log.warning("Sesión rechazada (401). Re-autenticando...")
+                    r.close()
+                    HTTP_RETRIES.inc(reason="reauth")
+                    if self.reauth():
+                        continue
+                    return r
+                if r.status_code in THROTTLE_STATUSES:  # Rate limit / sobrecarga
+                    # El limitador ya redujo la tasa y aplica el Retry-After al próximo acquire()
+                    log.warning(f"Metabase respondió {r.status_code}. Tasa reducida a "
+                                f"{self.limiter.rate:.1f} req/s")
+                    HTTP_RETRIES.inc(reason="rate_limit")
+                    r.close()
                     continue
                 return r
             except requests.exceptions.ConnectionError as e:
                 log.warning(f"Error de conexión (intento {attempt}/{MAX_RETRIES}): {e}")
+                HTTP_REQUESTS.inc(method=method, status="connection_error")
                 if attempt < MAX_RETRIES:
+                    HTTP_RETRIES.inc(reason="connection_error")
                     time.sleep(RETRY_DELAY_SEC * attempt)
             except requests.exceptions.Timeout:
                 log.warning(f"Timeout (intento {attempt}/{MAX_RETRIES})")
+                HTTP_REQUESTS.inc(method=method, status="timeout")
                 if attempt < MAX_RETRIES:
+                    HTTP_RETRIES.inc(reason="timeout")
                     time.sleep(RETRY_DELAY_SEC)
         log.error(f"Falló después de {MAX_RETRIES} intentos: {method} {path}")
         return None
 
-    def _get(self, path: str, **kwargs):
-        return self._request("GET", path, **kwargs)
+    def _get(self, path: str, cache: bool = True, **kwargs):
+        """
+        GET a través del caché de respuestas: vigente se sirve sin request,
+        vencida se revalida con ETag/Last-Modified si el servidor los envió.
+        cache=False para lecturas de estado que se sondean (sync, persistencia).
+        """
+        if not cache or kwargs.get("stream"):
+            return self._request("GET", path, **kwargs)
+        r, result = self.cache.fetch(
+            cache_key(path, kwargs.get("params")),
+            lambda headers: self._request("GET", path, headers=headers or None, **kwargs)
+        )
+        CACHE_REQUESTS.inc(result=result)
+        return r
 
     def _post(self, path: str, data: dict = None, **kwargs):
-        return self._request("POST", path, json=data, **kwargs)
+        r = self._request("POST", path, **self._json_body(data), **kwargs)
+        self.cache.invalidate_for("POST", path)
+        return r
 
     def _put(self, path: str, data: dict = None, **kwargs):
-        return self._request("PUT", path, json=data, **kwargs)
+        r = self._request("PUT", path, **self._json_body(data), **kwargs)
+        self.cache.invalidate_for("PUT", path)
+        return r
+
+    @staticmethod
+    def _json_body(data: Optional[dict]) -> Dict:
+        """Cuerpo JSON serializado con el codec (y gzip si está activado)."""
+        if data is None:
+            return {}
+        body, headers = encode_body(data)
+        return {"data": body, "headers": headers}
 
     def _delete(self, path: str, **kwargs):
-        return self._request("DELETE", path, **kwargs)
+        r = self._request("DELETE", path, **kwargs)
+        self.cache.invalidate_for("DELETE", path)
+        return r
 
     # ── Base de datos ──────────────────────────────────────────────────────
 
@@ -173,20 +352,64 @@ class MetabaseClient:
         log.warning(f"Error al re-escanear valores: {r.status_code if r else 'N/A'}")
         return False
 
-    def get_database_status(self, db_id: int) -> Optional[Dict]:
-        """Obtiene el estado actual de la base de datos."""
-        r = self._get(f"/api/database/{db_id}")
+    def rescan_field_values(self, field_id: int) -> bool:
+        """Re-escanea los valores de un único campo (mucho más barato que toda la BD)."""
+        r = self._post(f"/api/field/{field_id}/rescan_values")
+        if r and r.status_code in (200, 204):
+            return True
+        log.warning(f"Error al re-escanear el campo {field_id}: {r.status_code if r else 'N/A'}")
+        return False
+
+    def get_table_fields(self, table_id: int) -> List[Dict]:
+        """Campos de una tabla según la metadata de Metabase."""
+        r = self._get(f"/api/table/{table_id}/query_metadata")
         if r and r.status_code == 200:
-            return r.json()
+            return decode_json(r).get("fields", [])
+        log.warning(f"No se pudo leer la metadata de la tabla {table_id}: "
+                    f"{r.status_code if r else 'N/A'}")
+        return []
+
+    def get_database_status(self, db_id: int, include_tables: bool = False,
+                            cached: bool = True) -> Optional[Dict]:
+        """Obtiene el estado actual de la base de datos (opcionalmente con sus tablas)."""
+        params = {"include": "tables"} if include_tables else None
+        r = self._get(f"/api/database/{db_id}", cache=cached, params=params)
+        if r and r.status_code == 200:
+            return decode_json(r)
         return None
 
+    def wait_for_sync(self, db_id: int, timeout: float = SYNC_WAIT_TIMEOUT) -> bool:
+        """
+        Espera a que Metabase termine de sincronizar la base de datos.
+        Consulta /api/database/{id}?include=tables con backoff exponencial y
+        considera la BD lista cuando ella y todas sus tablas tienen
+        initial_sync_status = 'complete' y la metadata de las tablas no cambió
+        entre dos consultas consecutivas. Retorna False si vence el plazo.
+        """
+        poller = SyncPoller(timeout)
+        while True:
+            db = self.get_database_status(db_id, include_tables=True, cached=False)
+            result = poller.observe(db)
+            if result:
+                log.info(f"Sincronización completa ({poller.total} tablas, {poller.elapsed}s)")
+                SYNC_SECONDS.observe(poller.elapsed, outcome="complete")
+                return True
+            if db:
+                log.info(f"Sincronización en curso: {poller.done}/{poller.total} tablas completas "
+                         f"({poller.elapsed}s)")
+            if result is False:
+                log.warning(f"La sincronización no terminó en {timeout}s; se continúa igualmente")
+                SYNC_SECONDS.observe(poller.elapsed, outcome="timeout")
+                return False
+            time.sleep(poller.next_delay())
+
     # ── Dashboard ──────────────────────────────────────────────────────────
 
     def get_dashboard(self, dashboard_id: int) -> Optional[Dict]:
         """Obtiene los datos completos del dashboard incluyendo sus cards."""
         r = self._get(f"/api/dashboard/{dashboard_id}")
         if r and r.status_code == 200:
-            return r.json()
+            return decode_json(r)
         log.error(f"No se pudo obtener el dashboard {dashboard_id}: {r.status_code if r else 'N/A'}")
         return None
 
@@ -197,7 +420,19 @@ class MetabaseClient:
             return []
         # Las cards pueden estar en 'ordered_cards' o 'dashcards'
         cards = dashboard.get("ordered_cards", dashboard.get("dashcards", []))
-        return [c for c in cards if c.get("card_id")]  # Excluir text cards
+        cards = [c for c in cards if c.get("card_id")]  # Excluir text cards
+        self.remember_cards(cards)
+        return cards
+
+    def remember_cards(self, dashcards: List[Dict]) -> None:
+        """
+        Guarda en el caché la card embebida en cada dashcard de /api/dashboard/{id},
+        evitando un GET /api/card/{id} por card solo para leer nombre y updated_at.
+        """
+        for dc in dashcards:
+            card = dc.get("card")
+            if dc.get("card_id") and card:
+                self._card_cache[dc["card_id"]] = card
 
     def set_dashboard_auto_refresh(self, dashboard_id: int,
                                     interval_seconds: int = 3600) -> bool:
@@ -221,6 +456,50 @@ class MetabaseClient:
         log.warning(f"No se pudo configurar auto-refresh: {r.status_code if r else 'N/A'}")
         return False
 
+    def set_card_cache_ttl(self, card_id: int, hours: Optional[int]) -> bool:
+        """
+        Fija el cache_ttl de una card, en horas como lo expresa Metabase
+        (None = heredar la política de la base de datos o la global).
+        """
+        r = self._put(f"/api/card/{card_id}", {"cache_ttl": hours})
+        # El dashboard embebe sus cards: la copia cacheada ya no refleja el TTL
+        self.cache.invalidate_for("PUT", "/api/dashboard")
+        return bool(r and r.status_code == 200)
+
+    # ── Modelo base (caché de modelos) ─────────────────────────────────────
+
+    def refresh_persisted_model(self, model_id: int,
+                                timeout: float = MODEL_REFRESH_TIMEOUT) -> bool:
+        """
+        Recalcula el resultado persistido del modelo base y espera a que
+        Metabase termine (estado 'persisted'), para que las cards construidas
+        sobre él lean el agregado nuevo calculado una sola vez.
+        """
+        r = self._post(f"/api/persist/card/{model_id}/refresh")
+        if not r or r.status_code not in (200, 204):
+            log.warning(f"No se pudo refrescar el caché del modelo {model_id}: "
+                        f"{r.status_code if r else 'N/A'}")
+            return False
+        start, delay = time.time(), 1.0
+        while time.time() - start < timeout:
+            time.sleep(delay)
+            r = self._get(f"/api/persist/card/{model_id}", cache=False)
+            if not r or r.status_code != 200:
+                log.warning(f"No se pudo consultar el caché del modelo {model_id}: "
+                            f"{r.status_code if r else 'N/A'}")
+                return False
+            persisted = decode_json(r)
+            if persisted.get("state") == "persisted":
+                log.info(f"Caché del modelo {model_id} actualizado "
+                         f"({time.time() - start:.1f}s)")
+                return True
+            if persisted.get("state") == "error":
+                log.warning(f"Error al refrescar el modelo {model_id}: {persisted.get('error')}")
+                return False
+            delay = min(delay * 2, 10.0)
+        log.warning(f"El caché del modelo {model_id} no terminó en {timeout}s; se continúa")
+        return False
+
     # ── Cards (Preguntas) ──────────────────────────────────────────────────
 
     def invalidate_card_cache(self, card_id: int) -> bool:
@@ -230,41 +509,123 @@ class MetabaseClient:
         # pero re-ejecutar la card con force=true tiene el mismo efecto.
         return True  # La invalidación real ocurre al re-ejecutar
 
-    def execute_card(self, card_id: int, parameters: list = None) -> Optional[Dict]:
+    def execute_card(self, card_id: int, parameters: list = None,
+                     timeout: float = QUERY_TIMEOUT) -> Optional[Dict]:
         """
-        Fuerza la re-ejecución de una card, ignorando el caché.
-        Retorna el resultado de la ejecución con métricas de tiempo.
+        Fuerza la re-ejecución de una card, ignorando el caché, y espera su
+        resultado final. Retorna el estado final y la latencia de extremo a extremo.
+
+        Metabase responde 202 apenas acepta la query y envía el resultado en
+        el mismo cuerpo cuando termina (con saltos de línea de keepalive
+        mientras tanto), así que una 202 se sigue leyendo hasta el final: el
+        "status" del cuerpo dice si la query terminó ("completed") o falló.
+        Si no termina en `timeout` segundos se cierra la conexión, lo que
+        además cancela la query en Metabase.
         """
         payload = {
             "parameters": parameters or [],
             "ignore_cache": True
         }
-        start_time = time.time()
-        r = self._post(f"/api/card/{card_id}/query", payload)
-        elapsed = round(time.time() - start_time, 2)
-
-        if r and r.status_code == 202:
-            # 202 Accepted: la query fue aceptada para ejecución asíncrona
-            log.info(f"  Card {card_id}: ejecución asíncrona iniciada ({elapsed}s)")
-            return {"card_id": card_id, "status": "async", "elapsed": elapsed}
-
-        if r and r.status_code == 200:
-            data = r.json()
-            row_count = 0
-            if "data" in data:
-                row_count = len(data["data"].get("rows", []))
-            log.info(f"  Card {card_id}: {row_count} filas ({elapsed}s)")
-            return {"card_id": card_id, "status": "ok", "rows": row_count, "elapsed": elapsed}
+        start_time = time.monotonic()
+        r = self._post(f"/api/card/{card_id}/query", payload, stream=True)
+
+        if not r or r.status_code not in (200, 202):
+            if r:
+                r.close()
+            elapsed = round(time.monotonic() - start_time, 2)
+            status = r.status_code if r else "N/A"
+            log.warning(f"  Card {card_id}: error al ejecutar (status {status}, {elapsed}s)")
+            return {"card_id": card_id, "status": "error", "http_status": status, "elapsed": elapsed}
+
+        accepted = round(time.monotonic() - start_time, 2)
+        is_async = r.status_code == 202
+        try:
+            with r:
+                stats = summarize_query_result(r, deadline=start_time + timeout)
+        except QueryDeadlineExceeded:
+            elapsed = round(time.monotonic() - start_time, 2)
+            log.warning(f"  Card {card_id}: sin resultado tras {elapsed}s (aceptada en "
+                        f"{accepted}s); se cancela la query")
+            return {"card_id": card_id, "status": "timeout", "http_status": r.status_code,
+                    "async": is_async, "elapsed": elapsed}
+        except QUERY_STREAM_ERRORS as e:
+            elapsed = round(time.monotonic() - start_time, 2)
+            log.warning(f"  Card {card_id}: se cortó la lectura del resultado ({elapsed}s): {e}")
+            return {"card_id": card_id, "status": "error", "http_status": r.status_code,
+                    "async": is_async, "elapsed": elapsed}
+
+        elapsed = round(time.monotonic() - start_time, 2)
+        if stats.get("status") not in (None, "completed"):
+            error = str(stats.get("error") or "")[:200]
+            log.warning(f"  Card {card_id}: la query terminó en estado {stats['status']} "
+                        f"({elapsed}s): {error}")
+            return {"card_id": card_id, "status": "error", "query_status": stats["status"],
+                    "error": error, "async": is_async, "elapsed": elapsed}
+
+        row_count = stats["rows"]
+        suffix = f", aceptada en {accepted}s" if is_async else ""
+        log.info(f"  Card {card_id}: {row_count} filas ({elapsed}s{suffix})")
+        return {"card_id": card_id, "status": "ok", "rows": row_count, "elapsed": elapsed,
+                "async": is_async, "running_time_ms": stats.get("running_time")}
+
+    def run_native_query(self, db_id: int, sql: str) -> Optional[List[list]]:
+        """Ejecuta una query SQL nativa vía /api/dataset y retorna sus filas."""
+        r = self._post("/api/dataset", {
+            "database": db_id,
+            "type": "native",
+            "native": {"query": sql}
+        })
+        # /api/dataset responde 202 y el resultado llega completo en el cuerpo
+        if r and r.status_code in (200, 202):
+            data = decode_json(r)
+            if data.get("status") in (None, "completed"):
+                return (data.get("data") or {}).get("rows", [])
+            log.warning(f"Query nativa fallida: {str(data.get('error', ''))[:200]}")
+            return None
+        log.warning(f"Error en query nativa: {r.status_code if r else 'N/A'}")
+        return None
 
-        status = r.status_code if r else "N/A"
-        log.warning(f"  Card {card_id}: error al ejecutar (status {status}, {elapsed}s)")
-        return {"card_id": card_id, "status": "error", "http_status": status, "elapsed": elapsed}
+    def export_card(self, card_id: int, sink, export_format: str = "csv",
+                    parameters: list = None) -> Optional[Dict]:
+        """
+        Exporta el resultado completo de una card vía /api/card/{id}/query/{formato}
+        volcándolo por bloques en `sink` (objeto binario con .write) sin cargarlo
+        en memoria. Retorna bytes escritos y, para CSV, el número de filas.
+        """
+        start_time = time.time()
+        r = self._request(
+            "POST", f"/api/card/{card_id}/query/{export_format}",
+            data={"parameters": json.dumps(parameters or [])},
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            stream=True
+        )
+        if not r or r.status_code not in (200, 202):
+            log.error(f"No se pudo exportar la card {card_id}: {r.status_code if r else 'N/A'}")
+            if r:
+                r.close()
+            return None
+
+        written, newlines = 0, 0
+        with r:
+            for chunk in r.iter_content(chunk_size=EXPORT_CHUNK_BYTES):
+                sink.write(chunk)
+                written += len(chunk)
+                newlines += chunk.count(b"\n")
+        result = {"card_id": card_id, "format": export_format, "bytes": written,
+                  "elapsed": round(time.time() - start_time, 2)}
+        if export_format == "csv":
+            # Sin la fila de encabezados; aproximado si algún valor contiene saltos de línea
+            result["rows"] = max(newlines - 1, 0)
+        return result
 
     def get_card_info(self, card_id: int) -> Optional[Dict]:
-        """Obtiene información de una card específica."""
+        """Obtiene información de una card (desde el caché de la ejecución si ya se leyó)."""
+        if card_id in self._card_cache:
+            return self._card_cache[card_id]
         r = self._get(f"/api/card/{card_id}")
         if r and r.status_code == 200:
-            return r.json()
+            self._card_cache[card_id] = decode_json(r)
+            return self._card_cache[card_id]
         return None
 
     # ── Búsqueda de dashboard por nombre ──────────────────────────────────
@@ -273,7 +634,7 @@ class MetabaseClient:
         """Busca un dashboard por nombre y retorna su ID."""
         r = self._get("/api/dashboard", params={"f": "all"})
         if r and r.status_code == 200:
-            dashboards = r.json()
+            dashboards = decode_json(r)
             if isinstance(dashboards, dict):
                 dashboards = dashboards.get("data", [])
             for d in dashboards:
@@ -282,6 +643,91 @@ class MetabaseClient:
         return None
 
 
+class QueryDeadlineExceeded(Exception):
+    """El resultado de una query no terminó de llegar dentro de su plazo."""
+
+
+class _DeadlineReader:
+    """
+    Envuelve el stream de una respuesta y corta la lectura al vencer el plazo.
+    Usa read1() (urllib3 2.x), que retorna lo que ya llegó en lugar de esperar
+    el bloque completo: los keepalives de Metabase despiertan la lectura cada
+    pocos segundos y el plazo se revisa entre lecturas.
+
+    Sin read1() (urllib3 1.x), read(n) espera los n bytes completos y solo
+    keepalives llegan mientras la query corre, así que hasta el inicio del
+    resultado se lee de a un byte, revisando el plazo en cada keepalive.
+    Después el resultado llega de corrido y se lee por bloques.
+    """
+
+    def __init__(self, raw, deadline: Optional[float]):
+        self._raw     = raw
+        self._read1   = getattr(raw, "read1", None)
+        self.deadline = deadline
+        self._started = False  # Ya llegó el primer byte del JSON (tras los keepalives)
+
+    def _check(self) -> None:
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise QueryDeadlineExceeded()
+
+    def read(self, size: int = -1) -> bytes:
+        self._check()
+        if self._read1 is not None:
+            return self._read1(size)
+        if self._started or self.deadline is None:
+            return self._raw.read(size)
+        while True:
+            byte = self._raw.read(1)
+            if not byte or not byte.isspace():
+                self._started = True
+                return byte
+            self._check()
+
+
+# Cortes del stream mientras se lee el resultado (timeout de lectura, conexión
+# cerrada, JSON truncado)
+QUERY_STREAM_ERRORS = (requests.exceptions.RequestException, Urllib3HTTPError, ValueError)
+if ijson is not None:
+    QUERY_STREAM_ERRORS += (ijson.JSONError,)
+
+
+def summarize_query_result(response: requests.Response,
+                           deadline: Optional[float] = None) -> Dict:
+    """
+    Extrae el número de filas, running_time, status y error del resultado de
+    una query. Con ijson instalado la respuesta se recorre como stream de
+    eventos (memoria constante, sin construir las filas); sin ijson se lee por
+    bloques y se decodifica completa con el codec (orjson si está instalado).
+    Con `deadline` (time.monotonic()) lanza QueryDeadlineExceeded si el
+    cuerpo no terminó de llegar a tiempo.
+    """
+    reader = _DeadlineReader(response.raw, deadline)
+    response.raw.decode_content = True
+    if ijson is None:
+        chunks = []
+        while True:
+            chunk = reader.read(QUERY_READ_CHUNK)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = loads(b"".join(chunks)) if chunks else {}
+        rows = len((data.get("data") or {}).get("rows", []))
+        return {"rows": rows, "running_time": data.get("running_time"),
+                "status": data.get("status"), "error": data.get("error")}
+
+    stats = {"rows": 0, "running_time": None, "status": None, "error": None}
+    for prefix, event, value in ijson.parse(reader):
+        if prefix == "data.rows.item" and event == "start_array":
+            stats["rows"] += 1
+        elif (prefix in ("running_time", "status", "row_count", "error")
+              and event in ("number", "string")):
+            stats[prefix] = value
+    # row_count (si Metabase lo envía) es autoritativo frente al conteo local
+    if stats.get("row_count") is not None:
+        stats["rows"] = int(stats["row_count"])
+    return stats
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # OPERACIONES PRINCIPALES
 # ══════════════════════════════════════════════════════════════════════════════
@@ -298,42 +744,171 @@ def authenticate(client: MetabaseClient) -> bool:
         return False
 
 
-def resolve_ids(client: MetabaseClient) -> tuple:
+DASHBOARD_NAME = "Emails Críticos — ImagineCRM"
+
+
+def _find_database_id(client: MetabaseClient) -> Optional[int]:
+    """Recorre /api/database buscando la BD de ImagineCRM (búsqueda completa)."""
+    r = client._get("/api/database")
+    if r and r.status_code == 200:
+        dbs = decode_json(r)
+        if isinstance(dbs, dict):
+            dbs = dbs.get("data", [])
+        for db in dbs:
+            if "imaginecrm" in db.get("name", "").lower():
+                return db["id"]
+    return None
+
+
+def resolve_ids(client: MetabaseClient, state: StateStore) -> tuple:
     """
-    Resuelve el dashboard_id y database_id desde las variables de entorno
-    o buscando por nombre si no están configurados.
+    Resuelve el dashboard_id y database_id desde las variables de entorno,
+    el estado local o, si este está vencido y ya no es válido, buscando por
+    nombre en Metabase. Las búsquedas completas se guardan en el estado.
     """
     dashboard_id = METABASE_DASHBOARD_ID
     database_id  = METABASE_DATABASE_ID
 
     if not dashboard_id:
-        log.info("METABASE_DASHBOARD_ID no configurado. Buscando por nombre...")
-        dashboard_id = client.find_dashboard_by_name("Emails Críticos — ImagineCRM")
-        if dashboard_id:
-            log.info(f"Dashboard encontrado con ID: {dashboard_id}")
-            log.info(f"Tip: Agrega METABASE_DASHBOARD_ID={dashboard_id} a tu .env")
+        cached = state.get("dashboard_id")
+        if cached and state.is_fresh("dashboard_id"):
+            dashboard_id = cached
+        elif cached and (client.get_dashboard(cached) or {}).get("name") == DASHBOARD_NAME:
+            # Estado vencido pero aún válido: una sola consulta en vez de listar todo
+            state.touch("dashboard_id")
+            dashboard_id = cached
         else:
-            log.error("No se encontró el dashboard. Ejecuta primero setup_metabase_dashboard.py")
+            log.info("METABASE_DASHBOARD_ID no configurado. Buscando por nombre...")
+            dashboard_id = client.find_dashboard_by_name(DASHBOARD_NAME)
+            if dashboard_id:
+                state.set("dashboard_id", dashboard_id)
+                log.info(f"Dashboard encontrado con ID: {dashboard_id}")
+                log.info(f"Tip: Agrega METABASE_DASHBOARD_ID={dashboard_id} a tu .env")
+            else:
+                log.error("No se encontró el dashboard. Ejecuta primero setup_metabase_dashboard.py")
 
     if not database_id:
-        log.info("METABASE_DATABASE_ID no configurado. Buscando base de datos...")
-        r = client._get("/api/database")
-        if r and r.status_code == 200:
-            dbs = r.json()
-            if isinstance(dbs, dict):
-                dbs = dbs.get("data", [])
-            for db in dbs:
-                if "imaginecrm" in db.get("name", "").lower():
-                    database_id = db["id"]
-                    log.info(f"Base de datos encontrada con ID: {database_id}")
-                    log.info(f"Tip: Agrega METABASE_DATABASE_ID={database_id} a tu .env")
-                    break
+        cached = state.get("database_id")
+        if cached and state.is_fresh("database_id"):
+            database_id = cached
+        elif cached and "imaginecrm" in (
+                (client.get_database_status(cached) or {}).get("name", "").lower()):
+            state.touch("database_id")
+            database_id = cached
+        else:
+            log.info("METABASE_DATABASE_ID no configurado. Buscando base de datos...")
+            database_id = _find_database_id(client)
+            if database_id:
+                state.set("database_id", database_id)
+                log.info(f"Base de datos encontrada con ID: {database_id}")
+                log.info(f"Tip: Agrega METABASE_DATABASE_ID={database_id} a tu .env")
 
     return dashboard_id, database_id
 
 
-def sync_database(client: MetabaseClient, database_id: int) -> Dict:
-    """Re-sincroniza el esquema de la base de datos."""
+def save_state(state: StateStore, client: MetabaseClient) -> None:
+    """Persiste el estado local junto con la metadata de cards leída en esta ejecución."""
+    if client._card_cache:
+        state.remember_cards(list(client._card_cache.values()))
+    try:
+        state.save()
+    except OSError as e:
+        log.warning(f"No se pudo guardar el estado local en {state.path}: {e}")
+    try:
+        client.cache.save()
+    except OSError as e:
+        log.warning(f"No se pudo guardar el caché de respuestas en {client.cache.path}: {e}")
+
+
+SCHEMA_FINGERPRINT_SQL = """
+SELECT COUNT(DISTINCT TABLE_NAME), COUNT(*),
+       COALESCE(BIT_XOR(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION,
+                                         COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY))), 0)
+FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({tables})
+"""
+
+
+def dashboard_source_tables(client: MetabaseClient, dashboard_id: int) -> Optional[set]:
+    """Unión de las tablas que leen las cards nativas del dashboard (None si no hay ninguna)."""
+    if not dashboard_id:
+        return None
+    tables = set()
+    for dc in client.get_dashboard_cards(dashboard_id):
+        tables |= card_source_tables(dc.get("card")) or set()
+    return tables or None
+
+
+def schema_fingerprint(client: MetabaseClient, database_id: int,
+                       tables: set) -> Optional[str]:
+    """
+    Huella del esquema de las tablas dadas (columnas, tipos, nulabilidad,
+    claves y orden) con una sola query sobre information_schema.COLUMNS.
+    Retorna "tablas:columnas:crc" o None si la query falla.
+    """
+    in_list = ", ".join(f"'{t}'" for t in sorted(tables))
+    rows = client.run_native_query(database_id, SCHEMA_FINGERPRINT_SQL.format(tables=in_list))
+    if not rows:
+        log.warning("No se pudo calcular la huella del esquema")
+        return None
+    return ":".join(str(v) for v in rows[0])
+
+
+def resolve_filter_fields(client: MetabaseClient, state: StateStore, database_id: int,
+                          tables: set) -> Dict[str, int]:
+    """
+    IDs de Metabase de las columnas de FILTER_FIELDS ("tabla.columna" → id)
+    para las tablas dadas. Se guardan en el estado local hasta que cambie el
+    esquema o venza la entrada.
+    """
+    wanted = {f"{t}.{c}" for t, cols in FILTER_FIELDS.items() if t in tables for c in cols}
+    cached = state.get("filter_fields") or {}
+    if wanted.issubset(cached) and state.is_fresh("filter_fields"):
+        return {k: cached[k] for k in wanted}
+
+    db = client.get_database_status(database_id, include_tables=True) or {}
+    table_ids = {t.get("name"): t.get("id") for t in db.get("tables", [])}
+    fields = {}
+    for table, columns in FILTER_FIELDS.items():
+        if table not in tables or not table_ids.get(table):
+            continue
+        for field in client.get_table_fields(table_ids[table]):
+            if field.get("name") in columns:
+                fields[f"{table}.{field['name']}"] = field["id"]
+    missing = wanted - set(fields)
+    if missing:
+        log.warning(f"Campos de filtro no encontrados en Metabase: {', '.join(sorted(missing))}")
+    state.set("filter_fields", fields)
+    return fields
+
+
+def rescan_filter_fields(client: MetabaseClient, state: StateStore, database_id: int,
+                         tables: set) -> int:
+    """Re-escanea los valores de las columnas de filtro. Retorna cuántas se re-escanearon."""
+    fields = resolve_filter_fields(client, state, database_id, tables)
+    done = 0
+    for name, field_id in sorted(fields.items()):
+        if client.rescan_field_values(field_id):
+            done += 1
+        else:
+            # El ID puede haber cambiado (columna recreada): re-resolver la próxima vez
+            state.set("filter_fields", {})
+    if fields:
+        log.info(f"Re-escaneo de valores iniciado en {done}/{len(fields)} campos de filtro "
+                 f"({', '.join(sorted(fields))})")
+    return done
+
+
+def sync_database(client: MetabaseClient, state: StateStore, database_id: int,
+                  dashboard_id: int = 0, full: bool = False, rescan: bool = True) -> Dict:
+    """
+    Re-sincroniza la metadata de la BD en Metabase de forma incremental:
+    sync_schema solo si cambió la huella del esquema de las tablas que leen
+    las cards, y rescan_values solo sobre las columnas de filtro. Con
+    full=True (o si no se conocen las tablas de las cards) sincroniza y
+    re-escanea la BD completa, como antes. Solo espera a Metabase
+    (wait_for_sync) si esta llamada lanzó un sync_schema o un re-escaneo.
+    """
     results = {"sync_schema": False, "rescan_values": False}
 
     if not database_id:
@@ -346,27 +921,306 @@ def sync_database(client: MetabaseClient, database_id: int) -> Dict:
         initial_sync = db_status.get("initial_sync_status", "unknown")
         log.info(f"Estado actual de la BD: {initial_sync}")
 
-    results["sync_schema"]    = client.sync_database_schema(database_id)
-    results["rescan_values"]  = client.rescan_database_values(database_id)
+    tables = dashboard_source_tables(client, dashboard_id)
+    fingerprint = schema_fingerprint(client, database_id, tables) if tables else None
+    previous = state.get("schema_fingerprint") or {}
+    current = {"tables": sorted(tables or ()), "fingerprint": fingerprint}
+
+    if not tables:
+        log.info("Sin tablas fuente conocidas: sincronización completa de la BD")
+        full = True
+    changed = full or fingerprint is None or previous != current
+    results["fingerprint"] = fingerprint
+    results["schema_changed"] = changed
+    SCHEMA_CHECKS.inc(result="full" if full else ("changed" if changed else "unchanged"))
+
+    if changed:
+        if not full:
+            log.info(f"Huella del esquema: {previous.get('fingerprint') or 'sin registro'} "
+                     f"→ {fingerprint or 'desconocida'}")
+        results["sync_schema"] = client.sync_database_schema(database_id)
+    else:
+        log.info(f"Esquema sin cambios en {len(tables)} tablas ({fingerprint}): "
+                 f"se omite sync_schema")
 
     if results["sync_schema"]:
-        # Esperar a que la sincronización se complete antes de re-ejecutar cards
-        log.info("Esperando que la sincronización se complete (10s)...")
-        time.sleep(10)
+        # Esperar a que la sincronización se complete antes de re-escanear y re-ejecutar cards
+        log.info("Esperando que la sincronización se complete...")
+        results["synced"] = client.wait_for_sync(database_id)
+        if results["synced"] and fingerprint is not None:
+            # Solo se registra la huella de un esquema que Metabase ya terminó de leer
+            state.set("schema_fingerprint", current)
+        state.set("filter_fields", {})  # Columnas recreadas cambian de ID
+
+    if rescan:
+        if full:
+            results["rescan_values"] = client.rescan_database_values(database_id)
+        else:
+            results["rescan_values"] = rescan_filter_fields(
+                client, state, database_id, tables) > 0
+        if results["rescan_values"] and not results["sync_schema"]:
+            # Solo se espera si esta ejecución lanzó trabajo en Metabase
+            log.info("Esperando que el re-escaneo se complete...")
+            results["synced"] = client.wait_for_sync(database_id)
 
     return results
 
 
-def refresh_dashboard_cards(client: MetabaseClient, dashboard_id: int) -> Dict:
-    """Re-ejecuta todas las cards del dashboard."""
-    results = {
+SOURCE_TABLE_RE = re.compile(r"\b(?:FROM|JOIN)\s+`?(\w+)`?", re.IGNORECASE)
+
+
+def card_source_tables(card: Optional[Dict]) -> Optional[set]:
+    """Tablas leídas por el SQL nativo de una card (None si no se puede determinar)."""
+    native = ((card or {}).get("dataset_query") or {}).get("native") or {}
+    tables = set(SOURCE_TABLE_RE.findall(native.get("query", "")))
+    return tables or None
+
+
+class WatermarkGate:
+    """
+    Decide qué cards hace falta re-ejecutar comparando la marca de agua actual
+    de sus tablas fuente (una sola query nativa barata) con la registrada en el
+    estado local la última vez que cada card se refrescó con éxito.
+    """
+
+    def __init__(self, client: MetabaseClient, state: StateStore, database_id: int,
+                 max_age: float = WATERMARK_MAX_AGE):
+        self.client      = client
+        self.state       = state
+        self.database_id = database_id
+        self.max_age     = max_age
+        self.marks: Optional[Dict[str, str]] = None
+
+    def probe(self) -> Optional[Dict[str, str]]:
+        """Lee la marca de agua de todas las tablas conocidas en una única query."""
+        self.marks = None
+        if not self.database_id:
+            return None
+        sql = "\nUNION ALL\n".join(
+            f"SELECT '{table}' AS tabla, {expr} AS marca FROM {table}"
+            for table, expr in WATERMARK_EXPRESSIONS.items()
+        )
+        rows = self.client.run_native_query(self.database_id, sql)
+        if rows is None:
+            log.warning("No se pudo leer la marca de agua; se refrescarán todas las cards")
+            return None
+        self.marks = {row[0]: str(row[1]) for row in rows}
+        self.state.set("watermarks", self.marks)
+        self._record_changes(self.marks)
+        return self.marks
+
+    def _record_changes(self, marks: Dict[str, str]) -> None:
+        """Registra cuándo cambió la marca de cada tabla y el intervalo medio entre cambios."""
+        now = time.time()
+        changes = dict(self.state.get("table_changes", {}))
+        for table, mark in marks.items():
+            previous = changes.get(table)
+            if previous is None:
+                changes[table] = {"mark": mark, "changed_at": now, "interval": None}
+            elif previous["mark"] != mark:
+                gap = now - previous["changed_at"]
+                interval = previous["interval"]
+                if interval is not None:
+                    gap = interval + (gap - interval) * TTL_EWMA_ALPHA
+                changes[table] = {"mark": mark, "changed_at": now, "interval": round(gap, 1)}
+        self.state.set("table_changes", changes)
+
+    def _marks_for(self, tables: Optional[set]) -> Optional[Dict[str, str]]:
+        if self.marks is None or not tables or not tables.issubset(self.marks):
+            return None
+        return {t: self.marks[t] for t in sorted(tables)}
+
+    def select(self, dashboard_cards: List[Dict]) -> List[int]:
+        """Filtra los dashcards y retorna los IDs de cards con datos fuente nuevos."""
+        history = self.state.get("card_watermarks", {})
+        selected = []
+        for dc in dashboard_cards:
+            card_id = dc["card_id"]
+            marks = self._marks_for(card_source_tables(dc.get("card")))
+            previous = history.get(str(card_id))
+            if (marks is not None and previous and previous["marks"] == marks
+                    and time.time() - previous["at"] < self.max_age):
+                log.info(f"  Card {card_id}: sin datos nuevos, se omite")
+                continue
+            selected.append(card_id)
+        return selected
+
+    def commit(self, dashboard_cards: List[Dict], entries: List[Dict]) -> None:
+        """Registra la marca de agua usada por cada card refrescada con éxito."""
+        cards = {dc["card_id"]: dc.get("card") for dc in dashboard_cards}
+        history = dict(self.state.get("card_watermarks", {}))
+        for entry in entries:
+            marks = self._marks_for(card_source_tables(cards.get(entry["card_id"])))
+            if marks is not None and entry.get("status") == "ok":
+                history[str(entry["card_id"])] = {"marks": marks, "at": time.time()}
+        self.state.set("card_watermarks", history)
+
+
+class CardTTLPolicy:
+    """
+    Calcula el cache_ttl de cada card con el historial de refrescos, al estilo
+    del multiplicador de duración de Metabase:
+
+      ttl = costo medio de la card × TTL_MULTIPLIER
+            acotado por el intervalo medio entre cambios de sus tablas fuente
+
+    Las cards caras sobre datos que cambian poco quedan en caché más tiempo y
+    las baratas (costo < TTL_MIN_COST) no reciben TTL propio, así que siguen
+    frescas. El costo es el running_time del servidor (o la latencia de
+    extremo a extremo) promediado con EWMA; la frecuencia de cambio la
+    registra WatermarkGate en el estado local. Con menos de min_samples
+    mediciones de una card el TTL propuesto solo se registra en el log.
+    """
+
+    def __init__(self, client: MetabaseClient, state: StateStore,
+                 multiplier: float = TTL_MULTIPLIER, min_cost: float = TTL_MIN_COST,
+                 max_hours: int = TTL_MAX_HOURS, min_samples: int = TTL_MIN_SAMPLES):
+        self.client      = client
+        self.state       = state
+        self.multiplier  = multiplier
+        self.min_cost    = min_cost
+        self.max_hours   = max_hours
+        self.min_samples = min_samples
+
+    def record(self, entries: List[Dict]) -> None:
+        """Acumula el costo de las cards refrescadas con éxito."""
+        costs = dict(self.state.get("card_costs", {}))
+        for entry in entries:
+            if entry.get("status") != "ok":
+                continue
+            running = entry.get("running_time_ms")
+            cost = running / 1000 if running else entry.get("elapsed", 0.0)
+            previous = costs.get(str(entry["card_id"]))
+            if previous is not None:
+                cost = previous["avg"] + (cost - previous["avg"]) * TTL_EWMA_ALPHA
+            costs[str(entry["card_id"])] = {"avg": round(cost, 3),
+                                            "runs": (previous or {}).get("runs", 0) + 1}
+        self.state.set("card_costs", costs)
+
+    def change_interval(self, tables: Optional[set]) -> Optional[float]:
+        """Segundos esperados entre cambios de datos (los de la tabla más activa)."""
+        if not tables:
+            return None
+        changes = self.state.get("table_changes", {})
+        if not tables.issubset(changes):
+            return None
+        now = time.time()
+        # Si una tabla lleva sin cambiar más que su intervalo medio, cambia más lento
+        return min(max(changes[t]["interval"] or 0.0, now - changes[t]["changed_at"])
+                   for t in tables)
+
+    def ttl_hours(self, card_id: int, card: Optional[Dict]) -> tuple:
+        """Retorna (cache_ttl en horas o None, motivo) para una card."""
+        cost = self.state.get("card_costs", {}).get(str(card_id))
+        if cost is None:
+            return None, "sin mediciones"
+        if cost["avg"] < self.min_cost:
+            return None, f"barata ({cost['avg']:.2f}s)"
+        ttl = cost["avg"] * self.multiplier
+        interval = self.change_interval(card_source_tables(card))
+        limit = TTL_UNKNOWN_CHANGE if interval is None else interval
+        hours = min(int(min(ttl, limit) // 3600), self.max_hours)
+        changes = "desconocido" if interval is None else f"{interval / 3600:.1f}h"
+        reason = f"costo {cost['avg']:.1f}s, cambio de datos cada {changes}"
+        return hours or None, reason
+
+    def apply(self, dashboard_id: int) -> Dict:
+        """
+        Calcula el TTL de cada card del dashboard y actualiza las que cambiaron.
+        Las cards con historial corto (< min_samples) no se modifican.
+        """
+        results = {"updated": 0, "unchanged": 0, "pending": 0, "errors": 0}
+        costs = self.state.get("card_costs", {})
+        for dc in self.client.get_dashboard_cards(dashboard_id):
+            card_id = dc["card_id"]
+            card = dc.get("card") or self.client.get_card_info(card_id) or {}
+            hours, reason = self.ttl_hours(card_id, card)
+            runs = (costs.get(str(card_id)) or {}).get("runs", 0)
+            if runs < self.min_samples:
+                results["pending"] += 1
+                if runs and card.get("cache_ttl") != hours:
+                    log.info(f"  Card {card_id}: cache_ttl propuesto {hours or '—'} h ({reason}); "
+                             f"no se aplica con {runs}/{self.min_samples} mediciones")
+                continue
+            CARD_CACHE_TTL.set(hours or 0, card_id=card_id)
+            if card.get("cache_ttl") == hours:
+                results["unchanged"] += 1
+                continue
+            if self.client.set_card_cache_ttl(card_id, hours):
+                results["updated"] += 1
+                log.info(f"  Card {card_id}: cache_ttl {card.get('cache_ttl') or '—'} → "
+                         f"{hours or '—'} h ({reason})")
+            else:
+                results["errors"] += 1
+                log.warning(f"  Card {card_id}: no se pudo actualizar cache_ttl")
+        return results
+
+
+def refresh_base_model(client: MetabaseClient, state: StateStore) -> None:
+    """Recalcula el modelo base compartido (si setup lo creó) antes de las cards."""
+    model_id = state.get("model_id")
+    if model_id:
+        log.info(f"Recalculando el modelo base compartido (ID: {model_id})...")
+        client.refresh_persisted_model(model_id)
+
+
+def _refresh_card(client: MetabaseClient, card_id: int) -> Dict:
+    """Re-ejecuta una card y retorna su entrada para el resumen."""
+    # Obtener nombre de la card para el log
+    card_info = client.get_card_info(card_id)
+    card_name = card_info.get("name", f"Card {card_id}") if card_info else f"Card {card_id}"
+    log.info(f"  Ejecutando: {card_name[:50]}...")
+
+    result = client.execute_card(card_id)
+    return {"card_id": card_id, "name": card_name, **(result or {"status": "error"})}
+
+
+def _new_refresh_results(concurrency: int) -> Dict:
+    return {
         "total": 0,
         "success": 0,
         "errors": 0,
         "total_elapsed": 0.0,
+        "wall_elapsed": 0.0,
+        "concurrency": max(concurrency, 1),
+        "skipped": 0,
+        "async": 0,
+        "timeouts": 0,
         "cards": []
     }
 
+
+def _tally_refresh(results: Dict, entries: List[Dict]) -> Dict:
+    """Acumula las entradas de cada card en el resumen del refresco."""
+    CARDS_SKIPPED.inc(results.get("skipped", 0))
+    for entry in entries:
+        results["cards"].append(entry)
+        CARD_SECONDS.observe(entry.get("elapsed", 0), card_id=entry["card_id"],
+                             card_name=entry.get("name", ""), status=entry.get("status"))
+        if entry.get("status") == "ok":
+            results["success"] += 1
+        else:
+            results["errors"] += 1
+        results["async"] += 1 if entry.get("async") else 0
+        results["timeouts"] += 1 if entry.get("status") == "timeout" else 0
+        results["total_elapsed"] += entry.get("elapsed", 0)
+
+    results["total_elapsed"] = round(results["total_elapsed"], 2)
+    log.info(f"Cards refrescadas en {results['wall_elapsed']}s de reloj "
+             f"(suma de queries: {results['total_elapsed']}s)")
+    return results
+
+
+def refresh_dashboard_cards(client: MetabaseClient, dashboard_id: int,
+                            concurrency: int = CARD_CONCURRENCY,
+                            gate: Optional[WatermarkGate] = None) -> Dict:
+    """
+    Re-ejecuta todas las cards del dashboard.
+    Con concurrency > 1 las cards se ejecutan en un pool acotado de workers;
+    con concurrency = 1, una tras otra. El ritmo lo marca el limitador del cliente.
+    """
+    results = _new_refresh_results(concurrency)
+
     if not dashboard_id:
         log.warning("No se puede refrescar: dashboard_id no configurado")
         return results
@@ -378,38 +1232,110 @@ def refresh_dashboard_cards(client: MetabaseClient, dashboard_id: int) -> Dict:
         log.warning("No se encontraron cards en el dashboard")
         return results
 
+    card_ids = [dc["card_id"] for dc in dashboard_cards if dc.get("card_id")]
     results["total"] = len(dashboard_cards)
-    log.info(f"Refrescando {results['total']} cards...")
+    if gate:
+        card_ids = gate.select(dashboard_cards)
+        results["skipped"] = results["total"] - len(card_ids)
+    log.info(f"Refrescando {len(card_ids)} de {results['total']} cards "
+             f"(concurrencia: {results['concurrency']})...")
+
+    wall_start = time.time()
+    if results["concurrency"] == 1:
+        entries = []
+        for card_id in card_ids:
+            entries.append(_refresh_card(client, card_id))
+    else:
+        # El tamaño del pool acota la carga simultánea sobre Metabase
+        with ThreadPoolExecutor(max_workers=results["concurrency"]) as pool:
+            entries = list(pool.map(lambda cid: _refresh_card(client, cid), card_ids))
+    results["wall_elapsed"] = round(time.time() - wall_start, 2)
 
-    for dc in dashboard_cards:
-        card_id = dc.get("card_id")
-        if not card_id:
-            continue
+    if gate:
+        gate.commit(dashboard_cards, entries)
+    return _tally_refresh(results, entries)
 
-        # Obtener nombre de la card para el log
-        card_info = client.get_card_info(card_id)
-        card_name = card_info.get("name", f"Card {card_id}") if card_info else f"Card {card_id}"
-        log.info(f"  Ejecutando: {card_name[:50]}...")
-
-        result = client.execute_card(card_id)
-        if result:
-            results["cards"].append({
-                "card_id": card_id,
-                "name": card_name,
-                **result
-            })
-            if result.get("status") in ("ok", "async"):
-                results["success"] += 1
-            else:
-                results["errors"] += 1
-            results["total_elapsed"] += result.get("elapsed", 0)
-        else:
-            results["errors"] += 1
 
-        # Pausa entre cards para no saturar la API
-        time.sleep(CARD_EXEC_DELAY)
+async def refresh_dashboard_cards_async(client: AsyncMetabaseClient, dashboard_id: int,
+                                        concurrency: int = CARD_CONCURRENCY,
+                                        gate: Optional[WatermarkGate] = None) -> Dict:
+    """
+    Variante asyncio de refresh_dashboard_cards: todas las cards comparten el
+    pool keep-alive del cliente y un semáforo acota las queries simultáneas.
+    """
+    results = _new_refresh_results(concurrency)
 
-    return results
+    if not dashboard_id:
+        log.warning("No se puede refrescar: dashboard_id no configurado")
+        return results
+
+    log.info(f"Obteniendo cards del dashboard {dashboard_id}...")
+    dashboard_cards = await client.get_dashboard_cards(dashboard_id)
+
+    if not dashboard_cards:
+        log.warning("No se encontraron cards en el dashboard")
+        return results
+
+    card_ids = [dc["card_id"] for dc in dashboard_cards if dc.get("card_id")]
+    results["total"] = len(dashboard_cards)
+    if gate:
+        card_ids = gate.select(dashboard_cards)
+        results["skipped"] = results["total"] - len(card_ids)
+    log.info(f"Refrescando {len(card_ids)} de {results['total']} cards (asyncio, concurrencia: "
+             f"{results['concurrency']})...")
+
+    semaphore = asyncio.Semaphore(results["concurrency"])
+
+    async def refresh_one(card_id: int) -> Dict:
+        async with semaphore:
+            card_info = await client.get_card_info(card_id)
+            card_name = card_info.get("name", f"Card {card_id}") if card_info else f"Card {card_id}"
+            log.info(f"  Ejecutando: {card_name[:50]}...")
+            result = await client.execute_card(card_id, timeout=QUERY_TIMEOUT)
+            return {"card_id": card_id, "name": card_name, **result}
+
+    wall_start = time.time()
+    entries = await asyncio.gather(*(refresh_one(cid) for cid in card_ids))
+    results["wall_elapsed"] = round(time.time() - wall_start, 2)
+
+    if gate:
+        gate.commit(dashboard_cards, list(entries))
+    return _tally_refresh(results, list(entries))
+
+
+def refresh_cards_direct(concurrency: int = CARD_CONCURRENCY) -> Dict:
+    """
+    Variante --direct: ejecuta el SQL de las cards en la read replica de MySQL
+    y guarda los resultados en critical_email_card_snapshot, sin pasar por el
+    procesador de queries de Metabase (ver snapshot_critical_emails.py).
+    """
+    from snapshot_critical_emails import run_snapshots, select_cards
+
+    results = _new_refresh_results(concurrency)
+    cards = select_cards()
+    log.info(f"Ejecutando {len(cards)} cards en la réplica MySQL "
+             f"(concurrencia: {results['concurrency']})...")
+    wall_start = time.time()
+    entries = run_snapshots(cards, [int(DIRECT_PERIOD)], results["concurrency"])
+    results["total"] = len(entries)
+    results["wall_elapsed"] = round(time.time() - wall_start, 2)
+    return _tally_refresh(results, entries)
+
+
+def run_async(client: MetabaseClient, pool_size: int, job):
+    """
+    Ejecuta job(async_client) en un event loop, reutilizando la autenticación
+    ya establecida por el cliente síncrono (API Key o session token).
+    """
+    async def runner():
+        async with AsyncMetabaseClient(client.base_url, pool_size=pool_size) as async_client:
+            for header in ("x-api-key", "X-Metabase-Session"):
+                if header in client.session.headers:
+                    async_client.headers[header] = client.session.headers[header]
+            result = await job(async_client)
+            client._card_cache.update(async_client._card_cache)
+            return result
+    return asyncio.run(runner())
 
 
 def configure_auto_refresh(client: MetabaseClient, dashboard_id: int,
@@ -430,49 +1356,205 @@ def configure_auto_refresh(client: MetabaseClient, dashboard_id: int,
     return client.set_dashboard_auto_refresh(dashboard_id, interval_seconds)
 
 
-def show_status(client: MetabaseClient, dashboard_id: int, database_id: int):
-    """Muestra el estado actual del dashboard y la base de datos."""
+def _print_status(db: Optional[Dict], dashboard: Optional[Dict],
+                  dashboard_id: int, card_infos: Dict[int, Dict]):
     print("\n" + "═" * 60)
     print("  Estado del Dashboard de Emails Críticos")
     print("═" * 60)
 
     # Estado de la base de datos
-    if database_id:
-        db = client.get_database_status(database_id)
-        if db:
-            print(f"\n  Base de datos: {db.get('name', 'N/A')}")
-            print(f"  Motor: {db.get('engine', 'N/A')}")
-            print(f"  Estado de sync: {db.get('initial_sync_status', 'N/A')}")
-            print(f"  Último sync: {db.get('updated_at', 'N/A')}")
+    if db:
+        print(f"\n  Base de datos: {db.get('name', 'N/A')}")
+        print(f"  Motor: {db.get('engine', 'N/A')}")
+        print(f"  Estado de sync: {db.get('initial_sync_status', 'N/A')}")
+        print(f"  Último sync: {db.get('updated_at', 'N/A')}")
 
     # Estado del dashboard
-    if dashboard_id:
-        dashboard = client.get_dashboard(dashboard_id)
-        if dashboard:
-            print(f"\n  Dashboard: {dashboard.get('name', 'N/A')}")
-            print(f"  ID: {dashboard_id}")
-            cache_ttl = dashboard.get("cache_ttl")
-            if cache_ttl:
-                print(f"  Auto-refresh: cada {cache_ttl // 60} minutos")
-            else:
-                print(f"  Auto-refresh: no configurado")
+    if dashboard:
+        print(f"\n  Dashboard: {dashboard.get('name', 'N/A')}")
+        print(f"  ID: {dashboard_id}")
+        cache_ttl = dashboard.get("cache_ttl")
+        if cache_ttl:
+            print(f"  Auto-refresh: cada {cache_ttl // 60} minutos")
+        else:
+            print(f"  Auto-refresh: no configurado")
 
-            cards = dashboard.get("ordered_cards", dashboard.get("dashcards", []))
-            real_cards = [c for c in cards if c.get("card_id")]
-            print(f"  Cards: {len(real_cards)}")
+        cards = dashboard.get("ordered_cards", dashboard.get("dashcards", []))
+        real_cards = [c for c in cards if c.get("card_id")]
+        print(f"  Cards: {len(real_cards)}")
 
-            for dc in real_cards:
-                card_id = dc.get("card_id")
-                if card_id:
-                    info = client.get_card_info(card_id)
-                    if info:
-                        name = info.get("name", f"Card {card_id}")[:45]
-                        updated = info.get("updated_at", "N/A")[:19]
-                        print(f"    [{card_id}] {name:<45} | Actualizada: {updated}")
+        for dc in real_cards:
+            card_id = dc.get("card_id")
+            info = card_infos.get(card_id)
+            if info:
+                name = info.get("name", f"Card {card_id}")[:45]
+                updated = info.get("updated_at", "N/A")[:19]
+                print(f"    [{card_id}] {name:<45} | Actualizada: {updated}")
 
     print("\n" + "═" * 60 + "\n")
 
 
+def _status_card_ids(client, dashboard: Optional[Dict]) -> List[int]:
+    """IDs de las cards del dashboard; su metadata embebida queda en el caché del cliente."""
+    if not dashboard:
+        return []
+    cards = dashboard.get("ordered_cards", dashboard.get("dashcards", []))
+    cards = [c for c in cards if c.get("card_id")]
+    client.remember_cards(cards)
+    return [c["card_id"] for c in cards]
+
+
+def show_status(client: MetabaseClient, dashboard_id: int, database_id: int):
+    """Muestra el estado actual del dashboard y la base de datos."""
+    db = client.get_database_status(database_id) if database_id else None
+    dashboard = client.get_dashboard(dashboard_id) if dashboard_id else None
+
+    card_infos = {}
+    for card_id in _status_card_ids(client, dashboard):
+        info = client.get_card_info(card_id)
+        if info:
+            card_infos[card_id] = info
+
+    _print_status(db, dashboard, dashboard_id, card_infos)
+
+
+async def show_status_async(client: AsyncMetabaseClient, dashboard_id: int, database_id: int):
+    """Variante asyncio de show_status: BD, dashboard y cards se consultan en paralelo."""
+    async def nothing():
+        return None
+
+    db, dashboard = await asyncio.gather(
+        client.get_database_status(database_id) if database_id else nothing(),
+        client.get_dashboard(dashboard_id) if dashboard_id else nothing()
+    )
+
+    card_ids = _status_card_ids(client, dashboard)
+    infos = await asyncio.gather(*(client.get_card_info(cid) for cid in card_ids))
+    card_infos = {cid: info for cid, info in zip(card_ids, infos) if info}
+
+    _print_status(db, dashboard, dashboard_id, card_infos)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# MODO DAEMON (SCHEDULER EN PROCESO)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class ScheduledJob:
+    """Tarea periódica del daemon con intervalo, jitter y protección de solapamiento."""
+
+    def __init__(self, name: str, interval: float, func, jitter: float = DAEMON_JITTER):
+        self.name     = name
+        self.interval = interval
+        self.func     = func
+        self.jitter   = jitter
+        self.next_run = time.time()
+        self.future   = None
+        self.metrics_file = METRICS_FILE
+
+    def schedule_next(self, now: float) -> None:
+        spread = self.interval * self.jitter
+        self.next_run = now + self.interval + random.uniform(-spread, spread)
+
+    def run(self) -> None:
+        start = time.time()
+        try:
+            self.func()
+            log.info(f"[daemon] {self.name}: completado en {time.time() - start:.1f}s")
+        except Exception:
+            log.exception(f"[daemon] {self.name}: falló")
+        finally:
+            JOB_SECONDS.observe(time.time() - start, job=self.name)
+            write_metrics(self.metrics_file)
+
+
+def write_metrics(path: str) -> None:
+    """Vuelca las métricas al archivo .prom del textfile collector (si está configurado)."""
+    if not path:
+        return
+    try:
+        REGISTRY.write_textfile(path)
+    except OSError as e:
+        log.warning(f"No se pudieron escribir las métricas en {path}: {e}")
+
+
+def run_daemon(client: MetabaseClient, state: StateStore, dashboard_id: int,
+               database_id: int, args) -> None:
+    """
+    Mantiene un único cliente autenticado (con su pool keep-alive) y ejecuta
+    refresco de cards, sync de esquema y re-escaneo de valores con intervalos
+    propios. Una tarea no se vuelve a lanzar mientras su ejecución anterior
+    siga en curso. SIGTERM/SIGINT detienen el daemon tras las tareas activas.
+    """
+    client.reauth = lambda: authenticate(client)
+
+    gate = None if args.force else WatermarkGate(client, state, database_id)
+    ttl_policy = CardTTLPolicy(client, state) if args.adaptive_ttl else None
+
+    def refresh():
+        if gate:
+            gate.probe()
+        refresh_base_model(client, state)
+        results = refresh_dashboard_cards(client, dashboard_id, args.concurrency, gate)
+        if ttl_policy:
+            ttl_policy.record(results["cards"])
+            ttl_policy.apply(dashboard_id)
+        save_state(state, client)
+
+    def sync():
+        sync_database(client, state, database_id, dashboard_id, full=args.full_sync,
+                      rescan=False)
+        save_state(state, client)
+
+    def rescan():
+        tables = None if args.full_sync else dashboard_source_tables(client, dashboard_id)
+        if tables:
+            rescan_filter_fields(client, state, database_id, tables)
+            save_state(state, client)
+        else:
+            client.rescan_database_values(database_id)
+
+    jobs = []
+    if dashboard_id and args.refresh_every > 0:
+        jobs.append(ScheduledJob("refresh", args.refresh_every, refresh))
+    if database_id and args.sync_every > 0:
+        jobs.append(ScheduledJob("sync_schema", args.sync_every, sync))
+    if database_id and args.rescan_every > 0:
+        jobs.append(ScheduledJob("rescan_values", args.rescan_every, rescan))
+    if not jobs:
+        log.error("[daemon] No hay tareas configuradas. Abortando.")
+        sys.exit(1)
+    for job in jobs:
+        job.metrics_file = args.metrics_file
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = REGISTRY.serve(args.metrics_port, args.metrics_host)
+        log.info(f"[daemon] Métricas disponibles en "
+                 f"{args.metrics_host}:{args.metrics_port}/metrics")
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    log.info("[daemon] Iniciado: " + ", ".join(f"{j.name} cada {j.interval}s" for j in jobs))
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        while not stop.is_set():
+            now = time.time()
+            for job in jobs:
+                if job.next_run > now:
+                    continue
+                if job.future and not job.future.done():
+                    log.warning(f"[daemon] {job.name}: ejecución anterior aún en curso, se omite")
+                else:
+                    job.future = pool.submit(job.run)
+                job.schedule_next(now)
+            stop.wait(max(min(j.next_run for j in jobs) - time.time(), 0.5))
+        log.info("[daemon] Deteniendo: esperando las tareas en curso...")
+    if metrics_server:
+        metrics_server.shutdown()
+    log.info("[daemon] Detenido")
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # FUNCIÓN PRINCIPAL
 # ══════════════════════════════════════════════════════════════════════════════
@@ -487,20 +1569,62 @@ Ejemplos:
   python update_metabase_dashboard.py              # Actualización completa
   python update_metabase_dashboard.py --cards-only # Solo re-ejecutar cards
   python update_metabase_dashboard.py --sync-only  # Solo re-sincronizar BD
+  python update_metabase_dashboard.py --sync-only --full-sync  # Sync y rescan de toda la BD
   python update_metabase_dashboard.py --status     # Ver estado actual
   python update_metabase_dashboard.py --refresh-interval 1800  # Auto-refresh cada 30min
+  python update_metabase_dashboard.py --concurrency 8          # 8 cards en paralelo
         """
     )
     parser.add_argument("--cards-only",       action="store_true",
                         help="Solo re-ejecutar las cards (sin sync de BD)")
     parser.add_argument("--sync-only",        action="store_true",
                         help="Solo re-sincronizar la base de datos (sin ejecutar cards)")
+    parser.add_argument("--full-sync",        action="store_true",
+                        help="Sincronizar esquema y re-escanear valores de toda la BD, "
+                             "sin comparar la huella del esquema")
     parser.add_argument("--status",           action="store_true",
                         help="Mostrar el estado actual del dashboard y salir")
     parser.add_argument("--refresh-interval", type=int, default=3600,
                         help="Intervalo de auto-refresh en segundos (default: 3600 = 1h)")
     parser.add_argument("--no-auto-refresh",  action="store_true",
                         help="No configurar auto-refresh del dashboard")
+    parser.add_argument("--concurrency",      type=int, default=CARD_CONCURRENCY,
+                        help=f"Cards a ejecutar en paralelo (default: {CARD_CONCURRENCY}; "
+                             "1 = secuencial)")
+    parser.add_argument("--async",            action="store_true", dest="async_mode",
+                        help="Usar el cliente asyncio (requiere aiohttp) para refresco y estado")
+    parser.add_argument("--export-card",      type=int, metavar="CARD_ID",
+                        help="Exportar el resultado completo de una card y salir")
+    parser.add_argument("--export-format",    choices=("csv", "json"), default="csv",
+                        help="Formato de la exportación (default: csv)")
+    parser.add_argument("--output",           default="-",
+                        help="Archivo destino de la exportación (default: stdout)")
+    parser.add_argument("--force",            action="store_true",
+                        help="Re-ejecutar todas las cards aunque sus tablas fuente no cambiaron")
+    parser.add_argument("--direct",           action="store_true",
+                        help="Ejecutar el SQL de las cards en la réplica MySQL y guardar "
+                             "snapshots, sin el procesador de queries de Metabase")
+    parser.add_argument("--adaptive-ttl",     action="store_true", dest="adaptive_ttl",
+                        default=ADAPTIVE_TTL,
+                        help="Ajustar el cache_ttl de cada card según su costo medido "
+                             f"(tras {TTL_MIN_SAMPLES} mediciones; METABASE_ADAPTIVE_TTL=1)")
+    parser.add_argument("--no-adaptive-ttl",  action="store_false", dest="adaptive_ttl",
+                        help="No ajustar el cache_ttl aunque METABASE_ADAPTIVE_TTL=1")
+    parser.add_argument("--metrics-file",     default=METRICS_FILE,
+                        help="Escribir métricas Prometheus en este archivo .prom (textfile collector)")
+    parser.add_argument("--metrics-port",     type=int, default=METRICS_PORT,
+                        help="Daemon: servir métricas Prometheus en :PUERTO/metrics")
+    parser.add_argument("--metrics-host",     default=METRICS_HOST,
+                        help=f"Interfaz de --metrics-port (default: {METRICS_HOST}; "
+                             "0.0.0.0 expone las métricas en todas las interfaces)")
+    parser.add_argument("--daemon",           action="store_true",
+                        help="Quedar residente y ejecutar las tareas con el scheduler interno")
+    parser.add_argument("--refresh-every",    type=int, default=DAEMON_REFRESH_EVERY,
+                        help=f"Daemon: segundos entre refrescos de cards (default: {DAEMON_REFRESH_EVERY}; 0 = desactivar)")
+    parser.add_argument("--sync-every",       type=int, default=DAEMON_SYNC_EVERY,
+                        help=f"Daemon: segundos entre sync de esquema (default: {DAEMON_SYNC_EVERY}; 0 = desactivar)")
+    parser.add_argument("--rescan-every",     type=int, default=DAEMON_RESCAN_EVERY,
+                        help=f"Daemon: segundos entre re-escaneos de valores (default: {DAEMON_RESCAN_EVERY}; 0 = desactivar)")
     args = parser.parse_args()
 
     # ── Inicio ─────────────────────────────────────────────────────────────
@@ -511,12 +1635,27 @@ Ejemplos:
     log.info("=" * 60)
 
     # ── Autenticación ──────────────────────────────────────────────────────
-    client = MetabaseClient(METABASE_URL)
+    # En modo daemon, sync y rescan comparten el pool con los workers de refresco
+    client = MetabaseClient(METABASE_URL,
+                            pool_size=args.concurrency + (2 if args.daemon else 0))
     if not authenticate(client):
         sys.exit(1)
 
+    # ── Modo: exportar una card ────────────────────────────────────────────
+    if args.export_card:
+        if args.output == "-":
+            export = client.export_card(args.export_card, sys.stdout.buffer, args.export_format)
+        else:
+            with open(args.output, "wb") as sink:
+                export = client.export_card(args.export_card, sink, args.export_format)
+        if not export:
+            sys.exit(1)
+        log.info(f"Exportación completada: {export}")
+        sys.exit(0)
+
     # ── Resolver IDs ───────────────────────────────────────────────────────
-    dashboard_id, database_id = resolve_ids(client)
+    state = StateStore()
+    dashboard_id, database_id = resolve_ids(client, state)
 
     if not dashboard_id and not args.sync_only:
         log.error("No se pudo resolver el dashboard_id. Abortando.")
@@ -524,7 +1663,18 @@ Ejemplos:
 
     # ── Modo: solo mostrar estado ──────────────────────────────────────────
     if args.status:
-        show_status(client, dashboard_id, database_id)
+        if args.async_mode:
+            run_async(client, args.concurrency,
+                      lambda ac: show_status_async(ac, dashboard_id, database_id))
+        else:
+            show_status(client, dashboard_id, database_id)
+        save_state(state, client)
+        sys.exit(0)
+
+    # ── Modo: daemon ───────────────────────────────────────────────────────
+    if args.daemon:
+        run_daemon(client, state, dashboard_id, database_id, args)
+        save_state(state, client)
         sys.exit(0)
 
     # ── Modo: solo sincronizar BD ──────────────────────────────────────────
@@ -532,8 +1682,10 @@ Ejemplos:
         if not database_id:
             log.error("No se pudo resolver el database_id. Abortando.")
             sys.exit(1)
-        sync_results = sync_database(client, database_id)
+        sync_results = sync_database(client, state, database_id, dashboard_id,
+                                     full=args.full_sync)
         log.info(f"Sync completado: {sync_results}")
+        save_state(state, client)
         sys.exit(0)
 
     # ── Actualización completa o solo cards ───────────────────────────────
@@ -543,21 +1695,39 @@ Ejemplos:
         "database_id": database_id,
         "sync": {},
         "cards": {},
+        "cache_ttl": {},
         "auto_refresh": False
     }
 
     # Paso 1: Sincronizar BD (si no es --cards-only)
     if not args.cards_only and database_id:
         log.info("─── Paso 1/3: Sincronizando base de datos ───")
-        summary["sync"] = sync_database(client, database_id)
+        summary["sync"] = sync_database(client, state, database_id, dashboard_id,
+                                        full=args.full_sync)
     else:
         log.info("─── Paso 1/3: Sincronización de BD omitida ───")
 
     # Paso 2: Re-ejecutar cards del dashboard
     log.info("─── Paso 2/3: Refrescando cards del dashboard ───")
-    summary["cards"] = refresh_dashboard_cards(client, dashboard_id)
+    gate = None
+    if not args.force and not args.direct:
+        # Una sola query barata decide qué cards tienen datos fuente nuevos
+        gate = WatermarkGate(client, state, database_id)
+        gate.probe()
+    if args.direct:
+        # Metabase queda solo para mostrar: las queries van a la réplica
+        summary["cards"] = refresh_cards_direct(args.concurrency)
+    elif args.async_mode:
+        refresh_base_model(client, state)
+        summary["cards"] = run_async(
+            client, args.concurrency,
+            lambda ac: refresh_dashboard_cards_async(ac, dashboard_id, args.concurrency, gate)
+        )
+    else:
+        refresh_base_model(client, state)
+        summary["cards"] = refresh_dashboard_cards(client, dashboard_id, args.concurrency, gate)
 
-    # Paso 3: Configurar auto-refresh
+    # Paso 3: Configurar auto-refresh y TTL de caché por card
     if not args.no_auto_refresh:
         log.info("─── Paso 3/3: Configurando auto-refresh ───")
         summary["auto_refresh"] = configure_auto_refresh(
@@ -565,6 +1735,12 @@ Ejemplos:
         )
     else:
         log.info("─── Paso 3/3: Auto-refresh omitido ───")
+    if args.adaptive_ttl and not args.direct:
+        ttl_policy = CardTTLPolicy(client, state)
+        ttl_policy.record(summary["cards"].get("cards", []))
+        summary["cache_ttl"] = ttl_policy.apply(dashboard_id)
+
+    save_state(state, client)
 
     # ── Resumen final ──────────────────────────────────────────────────────
     elapsed_total = (datetime.now() - start_time).total_seconds()
@@ -576,9 +1752,23 @@ Ejemplos:
     log.info(f"  Dashboard ID:      {dashboard_id}")
     log.info(f"  Cards procesadas:  {cards.get('total', 0)}")
     log.info(f"  Exitosas:          {cards.get('success', 0)}")
-    log.info(f"  Con errores:       {cards.get('errors', 0)}")
+    log.info(f"  Con errores:       {cards.get('errors', 0)}"
+             f" (sin terminar a tiempo: {cards.get('timeouts', 0)})")
+    log.info(f"  Asíncronas (202):  {cards.get('async', 0)}")
+    log.info(f"  Sin datos nuevos:  {cards.get('skipped', 0)}")
+    log.info(f"  Tiempo de cards:   {cards.get('wall_elapsed', 0.0):.1f}s reloj / "
+             f"{cards.get('total_elapsed', 0.0):.1f}s queries "
+             f"(concurrencia {cards.get('concurrency', 1)})")
     log.info(f"  Tiempo total:      {elapsed_total:.1f}s")
     log.info(f"  Auto-refresh:      {'Configurado' if summary['auto_refresh'] else 'No configurado'}")
+    if summary["cache_ttl"]:
+        log.info(f"  TTL por card:      {summary['cache_ttl']['updated']} actualizadas, "
+                 f"{summary['cache_ttl']['unchanged']} sin cambios, "
+                 f"{summary['cache_ttl']['pending']} con historial insuficiente")
+
+    RUN_SECONDS.set(round(elapsed_total, 3))
+    RUN_TIMESTAMP.set(time.time(), result="errors" if cards.get("errors", 0) else "success")
+    write_metrics(args.metrics_file)
 
     if cards.get("errors", 0) > 0:
         log.warning("Algunas cards tuvieron errores. Revisa los logs anteriores.")